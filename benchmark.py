@@ -0,0 +1,254 @@
+''' Benchmarks of image_thumbnail, run: python3 benchmark.py --help '''
+import io
+import os
+import sys
+import time
+import subprocess
+import shutil
+import tempfile
+import contextlib
+from pathlib import Path
+
+import click
+from PIL import Image as PILImage
+
+from image_thumbnail import (
+    utils,
+    constants
+)
+
+
+def make_images(folder: Path, count: int, side: int, seed: int = 0):
+    ''' Create count noisy JPEG images of side x side pixels in folder '''
+    folder.mkdir(parents=True, exist_ok=True)
+    for idx in range(count):
+        im = PILImage.effect_noise((side, side), 32 + (seed + idx) % 64).convert('RGB')
+        im = PILImage.merge('RGB', [im.getchannel(0), im.getchannel(1).rotate(90), im.getchannel(2).transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)])
+        im.save(folder.joinpath(f'img_{idx:05d}.jpg'), 'JPEG', quality=constants.JpegImageQuality.JPEG_BEST)
+
+
+@contextlib.contextmanager
+def quiet_workers():
+    ''' Silence the stdout of this process and of the workers it starts (spawn, forkserver) '''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def timed_scan(src: Path, method_name: str, config: dict, executor: str, **run_options) -> float:
+    ''' Run scan_multi into a fresh temp folder, return seconds spent '''
+    dst = Path(tempfile.mkdtemp(prefix='bench_dst_'))
+    try:
+        start = time.perf_counter()
+        with quiet_workers():
+            for _ in utils.scan_multi(src, dst, constants.IMAGE_SUFFIX, method_name, config, executor, **run_options):
+                pass
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(dst, ignore_errors=True)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@click.command()
+@click.option('-n', '--count', type=int, default=48, show_default=True, help='Images per size')
+@click.option('-s', '--side', type=int, multiple=True, default=[128, 384, 1024, 2048, 3072], show_default=True, help='Image side in pixels, can use -s multiple times')
+def executor(count, side):
+    '''
+        Files/s of threads vs processes vs hybrid executor, by image size.
+
+        Shows where processes start to beat threads (the crossover).
+    '''
+    from image_thumbnail.executor import choose_executor, SMALL_FILE_BYTES
+
+    print(f'{"side":>6} {"avg KB":>8} {"threads":>9} {"processes":>9} {"hybrid":>9}  best       auto')
+    crossover = None
+    for each_side in side:
+        root = Path(tempfile.mkdtemp(prefix='bench_src_'))
+        try:
+            src = root.joinpath('src')
+            make_images(src, count, each_side)
+            files = sorted(src.iterdir())
+            average_kb = sum([x.stat().st_size for x in files]) / len(files) / 1024
+            config = {'max_dimension': max(each_side // 2, 1), 'quality': constants.JpegImageQuality.JPEG_GOOD, 'skip_under_mb': 0.0001}
+
+            speeds = {}
+            for name in ['threads', 'processes', 'hybrid']:
+                speeds[name] = count / timed_scan(src, 'down_scale', config, name)
+            best = max(speeds, key=speeds.get)
+            if crossover is None and speeds['processes'] > speeds['threads']:
+                crossover = average_kb
+            auto = choose_executor(files, utils.max_process_count())
+            print(f'{each_side:>6} {average_kb:>8.0f} {speeds["threads"]:>9.1f} {speeds["processes"]:>9.1f} {speeds["hybrid"]:>9.1f}  {best:<10} {auto}')
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(f'files/s, {count} files per size. auto threshold: {SMALL_FILE_BYTES / 1024:.0f} KB')
+    if crossover is None:
+        print('processes never beat threads in this range')
+    else:
+        print(f'crossover: processes beat threads from ~{crossover:.0f} KB per file')
+
+
+def make_detailed_image(side: int) -> PILImage.Image:
+    ''' A side x side RGB image with fine detail at every scale (fractal edges), hard to resample '''
+    channels = [
+        PILImage.effect_mandelbrot((side, side), (-0.75, -0.1, -0.7, -0.05), 256),
+        PILImage.effect_mandelbrot((side, side), (-2.0, -1.2, 0.6, 1.2), 128),
+        PILImage.linear_gradient('L').resize((side, side)),
+    ]
+    return PILImage.merge('RGB', channels)
+
+
+@click.command()
+@click.option('-s', '--side', type=int, default=4000, show_default=True, help='Source image side in pixels')
+@click.option('-t', '--target', type=int, multiple=True, default=[2000, 800, 200], show_default=True, help='Target side in pixels, can use -t multiple times')
+@click.option('-n', '--repeat', type=int, default=3, show_default=True, help='Runs per measure, the best one is kept')
+def resample(side, target, repeat):
+    '''
+        Speed vs quality of the resample strategies (see image_thumbnail/resample.py).
+
+        Quality is PSNR (dB) and SSIM against pure LANCZOS from the full resolution.
+    '''
+    from image_thumbnail import resample as strategies
+    from image_thumbnail.metrics import psnr, ssim
+
+    source = make_detailed_image(side)
+    print(f'source: {side}x{side}')
+    print(f'{"target":>6} {"strategy":<10} {"ms":>8} {"speedup":>8} {"PSNR dB":>8} {"SSIM":>7}')
+    for each_target in target:
+        outputs, times = {}, {}
+        for name in strategies.STRATEGIES:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                outputs[name] = strategies.resize(source, (each_target, each_target), name)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            times[name] = best
+
+        reference = outputs['lanczos']
+        for name in strategies.STRATEGIES:
+            try:
+                similarity = f'{ssim(outputs[name], reference):>7.4f}'
+            except Exception:
+                similarity = f'{"n/a":>7}'
+            print(f'{each_target:>6} {name:<10} {times[name] * 1000:>8.1f} {times["lanczos"] / times[name]:>7.1f}x {psnr(outputs[name], reference):>8.1f} {similarity}')
+
+
+@click.command()
+@click.option('-s', '--side', type=int, default=2000, show_default=True, help='Source image side in pixels')
+@click.option('-i', '--image', type=click.Path(exists=True, dir_okay=False), default=None, help='Use this image instead of a generated one')
+@click.option('-q', '--quality', type=int, multiple=True, default=[75, 90], show_default=True, help='Quality to encode at, can use -q multiple times')
+@click.option('-b', '--budget', type=float, default=0, show_default=True, help='Also search the best quality under this many KB, per encoder (0 = skip)')
+@click.option('-n', '--repeat', type=int, default=3, show_default=True, help='Runs per measure, the best one is kept')
+def encoders(side, image, quality, budget, repeat):
+    '''
+        Encode time vs bytes of every output encoder available here (see image_thumbnail/encoders.py).
+
+        Quality is SSIM against the source. With -b, the down_size quality search runs per encoder.
+    '''
+    from image_thumbnail.encoders import ENCODERS, available, encoder_for
+    from image_thumbnail.metrics import ssim
+    from image_thumbnail.utils import _search_quality
+
+    source = PILImage.open(image).convert('RGB') if image else make_detailed_image(side)
+    print(f'source: {source.width}x{source.height}, not available: {[x for x in ENCODERS if not available(x)]}')
+    print(f'{"encoder":<9} {"quality":>7} {"ms":>8} {"KB":>9} {"bpp":>6} {"SSIM":>7}')
+    for name in ENCODERS:
+        if not available(name):
+            continue
+        encode, _ = encoder_for(name)
+        for each_quality in quality:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = encode(source, each_quality)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            try:
+                similarity = f'{ssim(PILImage.open(io.BytesIO(data)), source):>7.4f}'
+            except Exception:
+                similarity = f'{"n/a":>7}'
+            bpp = len(data) * 8 / (source.width * source.height)
+            print(f'{name:<9} {each_quality:>7} {best * 1000:>8.1f} {len(data) / 1024:>9.1f} {bpp:>6.2f} {similarity}')
+
+        if budget > 0:
+            start = time.perf_counter()
+            found, data, encodes = _search_quality(source, None, budget * 1024, 1, 100, 1, encode)
+            seconds = time.perf_counter() - start
+            if found is None:
+                print(f'{name:<9} budget {budget} KB: too big even at quality 1')
+            else:
+                print(f'{name:<9} budget {budget} KB: quality {found}, {len(data) / 1024:.1f} KB, {encodes} encodes in {seconds * 1000:.0f} ms')
+
+
+def timed_command(args: list, repeat: int) -> float:
+    ''' Best wall time (s) of a command run repeat times '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, cwd=Path(__file__).parent)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+@click.command()
+@click.option('-n', '--count', type=int, default=16, show_default=True, help='Images of the small tree')
+@click.option('-s', '--side', type=int, default=256, show_default=True, help='Image side in pixels')
+@click.option('-r', '--repeat', type=int, default=3, show_default=True, help='Runs per measure, the best one is kept')
+def startup(count, side, repeat):
+    '''
+        Fixed costs of a run: CLI start, imports, worker start per start method.
+
+        A small tree is processed with each start method, to see what dominates short jobs.
+    '''
+    import multiprocessing
+    from image_thumbnail.executor import START_METHODS
+
+    python = sys.executable
+    bare = timed_command([python, '-c', 'pass'], repeat)
+    print(f'{"python -c pass":<34} {bare * 1000:>8.0f} ms')
+    print(f'{"process.py --help":<34} {timed_command([python, "process.py", "--help"], repeat) * 1000:>8.0f} ms')
+    for module in ['click', 'PIL.Image', 'exif', 'numpy', 'image_thumbnail.utils']:
+        try:
+            seconds = timed_command([python, '-c', f'import {module}'], repeat) - bare
+            print(f'{"import " + module:<34} {seconds * 1000:>8.0f} ms')
+        except subprocess.CalledProcessError:
+            print(f'{"import " + module:<34} {"n/a":>8}')
+
+    root = Path(tempfile.mkdtemp(prefix='bench_src_'))
+    try:
+        src = root.joinpath('src')
+        make_images(src, count, side)
+        config = {'max_dimension': max(side // 2, 1), 'quality': constants.JpegImageQuality.JPEG_GOOD, 'skip_under_mb': 0.0001}
+        print(f'{count} images of {side}px, {utils.max_process_count()} workers:')
+        print(f'{"threads":<34} {min([timed_scan(src, "down_scale", config, "threads") for _ in range(repeat)]) * 1000:>8.0f} ms')
+        for method in START_METHODS[1:]:
+            if method not in multiprocessing.get_all_start_methods():
+                continue
+            # The fork server stays up once started, the first run pays for it
+            seconds = [timed_scan(src, 'down_scale', config, 'processes', start_method=method) for _ in range(repeat)]
+            print(f'{"processes, " + method:<34} {min(seconds) * 1000:>8.0f} ms (first run {seconds[0] * 1000:.0f} ms)')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+cli.add_command(executor)
+cli.add_command(resample)
+cli.add_command(encoders)
+cli.add_command(startup)
+
+if __name__ == '__main__':
+    cli()
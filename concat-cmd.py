@@ -10,10 +10,15 @@
         -t 2 \
         -o output.jpg
 
+    Grid mode (rows x columns), streamed into a PNG strip by strip:
+        python concat-cmd.py \
+        -c 4 \
+        -i image1.jpg image2.jpg image3.jpg ... \
+        -o output.png
 
 '''
 import argparse
-from image_thumbnail import utils
+from image_thumbnail import utils, contact_sheet
 
 def main():
     # Set up argument parser
@@ -43,6 +48,12 @@ def main():
         default=2, 
         help="Height aspect ratio (default: 2)."
     )
+    parser.add_argument(
+        '-c', '--columns', 
+        type=int, 
+        default=0, 
+        help="Arrange images in a grid of this many columns, streamed into a PNG output (direction is ignored)."
+    )
     parser.add_argument(
         '-o', '--output', 
         type=str, 
@@ -56,13 +67,22 @@ def main():
     # Determine direction
     direction = True if args.direction == 'horizontal' else False
 
-    # Open images
-    imgs = [utils.open_img(x) for x in args.images]
-
-    if len(imgs) < 2:
+    if len(args.images) < 2:
         print("Error: At least two images are required for concatenation.")
         exit(1)
 
+    # Grid mode, never holds the whole output in memory
+    if args.columns > 0:
+        if not args.output.lower().endswith('.png'):
+            print("Error: Grid mode writes PNG, output must end with .png")
+            exit(1)
+        contact_sheet.concat_grid(args.images, args.output, args.columns, args.width_aspect_ratio, args.height_aspect_ratio)
+        print(f"Concatenated image saved to {args.output}")
+        return
+
+    # Open images
+    imgs = [utils.open_img(x) for x in args.images]
+
     # Concatenate images
     big_img = utils.concat_imgs_2(imgs, direction, args.width_aspect_ratio, args.height_aspect_ratio)
 
@@ -9,6 +9,9 @@
         -w 3 \
         -t 2 \
         --skip-exist
+
+    With -v (--only-vertical), a header index (python process.py index ...) given by
+    --index decides without opening the images.
 '''
 import os
 import json
@@ -54,9 +57,21 @@ def main():
         help="If set, only process images that are vertical (taller than wider) do the concatenation."
     )
 
+    parser.add_argument(
+        '-i', '--index', 
+        type=str, 
+        default=None, 
+        help="Path of a header index (built by: process.py index), used to skip non-vertical images without opening them."
+    )
+
     # Parse arguments
     args = parser.parse_args()
 
+    image_index = None
+    if args.index:
+        from image_thumbnail.index import ImageIndex, oriented_size
+        image_index = ImageIndex(args.index)
+
     # Determine direction
     direction = True if args.direction == 'horizontal' else False
 
@@ -67,6 +82,15 @@ def main():
 
     for video_path, image_paths in json_data.items():
         try:
+            # Decide from the index first, without opening any image
+            if image_index and args.only_vertical and len(image_paths) >= 2:
+                row = image_index.lookup(image_paths[0])
+                if row and not row['error']:
+                    _width, _height = oriented_size(row)
+                    if _width > _height:
+                        print(f"Skipping concat imgs of {video_path}: Image is wider than taller and --only-vertical is set.")
+                        continue
+
             # Open images
             imgs = [utils.open_img(img_path) for img_path in image_paths]
 
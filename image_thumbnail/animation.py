@@ -0,0 +1,228 @@
+'''
+    Animated GIF / WebP, resized frame by frame.
+
+    Frames are read one at a time (ImageSequence), resized, encoded on their own and
+    appended to the output, so memory is a couple of frames plus the output bytes, not the
+    whole decoded clip. Pillow's own animated writers collect every frame first (GIF) or
+    need them all as images, so the containers are written here:
+
+        GIF:    header without a global palette, NETSCAPE loop (if the source has one), then per frame a graphic
+                control extension (duration, disposal, transparency) and the image with its
+                own palette, taken from a single frame GIF that Pillow encoded.
+        WebP:   RIFF / VP8X / ANIM, then an ANMF chunk per frame holding the VP8 (+ALPH) or
+                VP8L data of a single frame WebP that Pillow encoded.
+
+    Pillow gives every frame composited on the canvas, so all output frames are full size
+    and replace the previous one.
+
+    Decimation: keep 1 frame out of step, the durations of the dropped frames go to the
+    kept one, so the clip plays at the same speed.
+'''
+import io
+import math
+import struct
+from typing import Iterator, Tuple, Union
+
+from PIL import (
+    Image as PILImage,
+    ImageSequence
+)
+
+from . import resample
+from .banded import fit_size
+
+# Source format -> output suffix
+ANIMATED_FORMATS = {'GIF': '.gif', 'WEBP': '.webp'}
+
+# Budget: frames are decimated up to 1 of MAX_FRAME_STEP, then the dimensions shrink
+MAX_FRAME_STEP = 4
+SHRINK_FACTOR = 0.9
+MAX_BUDGET_PASSES = 24
+
+# Duration of frames that don't say (ms)
+DEFAULT_DURATION = 100
+
+# Alpha under this is a transparent GIF pixel
+GIF_ALPHA_THRESHOLD = 128
+
+
+def is_animated(im: PILImage.Image) -> bool:
+    ''' If the image is an animated GIF or WebP '''
+    return im.format in ANIMATED_FORMATS and getattr(im, 'n_frames', 1) > 1
+
+
+def iter_frames(im: PILImage.Image, size: Tuple[int, int], strategy: Union[str, None] = None, step: int = 1) -> Iterator[Tuple[PILImage.Image, bool, int]]:
+    ''' Yield (resized frame, has alpha, duration ms) of 1 in step frames, one at a time '''
+    kept, duration = None, 0
+    for idx, frame in enumerate(ImageSequence.Iterator(im)):
+        frame.load() # WebP sets the duration of a frame when loading it
+        if idx % step == 0 and kept is not None:
+            yield (*kept, duration)
+            kept, duration = None, 0
+        duration += frame.info.get('duration', DEFAULT_DURATION) or DEFAULT_DURATION
+        if idx % step == 0:
+            has_alpha = frame.mode in ('RGBA', 'LA', 'PA') or 'transparency' in frame.info
+            frame = frame.convert('RGBA' if has_alpha else 'RGB')
+            if frame.size != size:
+                frame = resample.resize(frame, size, strategy)
+            kept = (frame, has_alpha)
+    if kept is not None:
+        yield (*kept, duration)
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    ''' Position after the data sub-blocks starting at pos '''
+    while data[pos] != 0:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+class GifWriter:
+    ''' Animated GIF, frames appended one by one. loop None: no NETSCAPE block, plays once '''
+    def __init__(self, size: Tuple[int, int], loop: Union[int, None] = 0):
+        self.buffer = io.BytesIO()
+        self.buffer.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0, 0, 0))
+        if loop is not None:
+            self.buffer.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def add(self, frame: PILImage.Image, duration: int, has_alpha: bool, quality: int = 0):
+        if has_alpha:
+            alpha = frame.getchannel('A')
+            paletted = frame.convert('RGB').quantize(255)
+            paletted.paste(255, mask=alpha.point(lambda x: 255 if x < GIF_ALPHA_THRESHOLD else 0))
+            single = io.BytesIO()
+            paletted.save(single, 'GIF', transparency=255)
+        else:
+            single = io.BytesIO()
+            frame.quantize(256).save(single, 'GIF')
+        data = single.getvalue()
+
+        # Global palette of the single frame GIF, becomes the local one
+        packed = data[10]
+        pos = 13
+        global_palette = b''
+        if packed & 0x80:
+            global_palette = data[pos:pos + 3 * (2 << (packed & 7))]
+            pos += len(global_palette)
+
+        transparency = None
+        while data[pos] == 0x21: # extensions
+            if data[pos + 1] == 0xF9 and data[pos + 3] & 1:
+                transparency = data[pos + 6]
+            pos = _skip_sub_blocks(data, pos + 2)
+        if data[pos] != 0x2C:
+            raise Exception('Unexpected GIF frame layout')
+
+        descriptor = bytearray(data[pos:pos + 10])
+        pos += 10
+        palette = b''
+        if descriptor[9] & 0x80:
+            # Has a local palette already
+            palette = data[pos:pos + 3 * (2 << (descriptor[9] & 7))]
+            pos += len(palette)
+        elif global_palette:
+            palette = global_palette
+            descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (packed & 7) # keep the interlace flag
+        # LZW code size, then the data sub-blocks
+        image_data = data[pos:_skip_sub_blocks(data, pos + 1)]
+
+        disposal = 2 if transparency is not None else 1
+        flags = (disposal << 2) | (1 if transparency is not None else 0)
+        self.buffer.write(b'!\xf9\x04' + struct.pack('<BHB', flags, round(duration / 10), transparency or 0) + b'\x00')
+        self.buffer.write(bytes(descriptor) + palette + image_data)
+
+    def finish(self) -> bytes:
+        self.buffer.write(b';')
+        return self.buffer.getvalue()
+
+
+def _chunk(fourcc: bytes, payload: bytes) -> bytes:
+    return fourcc + struct.pack('<I', len(payload)) + payload + (b'\x00' if len(payload) % 2 else b'')
+
+
+def _uint24(x: int) -> bytes:
+    return struct.pack('<I', x)[:3]
+
+
+class WebPWriter:
+    ''' Animated WebP, frames appended one by one. loop None: plays once (the ANIM chunk always has a count) '''
+    def __init__(self, size: Tuple[int, int], loop: Union[int, None] = 0):
+        self.size = size
+        self.has_alpha = False
+        self.buffer = io.BytesIO()
+        self.buffer.write(b'RIFF\x00\x00\x00\x00WEBP')
+        self.buffer.write(_chunk(b'VP8X', b'\x02\x00\x00\x00' + _uint24(size[0] - 1) + _uint24(size[1] - 1)))
+        self.buffer.write(_chunk(b'ANIM', struct.pack('<IH', 0, 1 if loop is None else loop)))
+
+    def add(self, frame: PILImage.Image, duration: int, has_alpha: bool, quality: int = 80):
+        single = io.BytesIO()
+        frame.save(single, 'WEBP', quality=quality, method=4)
+        data = single.getvalue()
+
+        # Keep the bitstream chunks of the single frame WebP
+        frame_data = b''
+        pos = 12
+        while pos + 8 <= len(data):
+            fourcc = data[pos:pos + 4]
+            length = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+            end = pos + 8 + length + (length % 2)
+            if fourcc in (b'ALPH', b'VP8 ', b'VP8L'):
+                frame_data += data[pos:end]
+            pos = end
+
+        self.has_alpha = self.has_alpha or has_alpha
+        width, height = frame.size
+        header = _uint24(0) + _uint24(0) + _uint24(width - 1) + _uint24(height - 1) + _uint24(min(duration, 0xFFFFFF))
+        # No blending, no disposal: every frame is the whole canvas
+        self.buffer.write(_chunk(b'ANMF', header + b'\x02' + frame_data))
+
+    def finish(self) -> bytes:
+        data = bytearray(self.buffer.getvalue())
+        struct.pack_into('<I', data, 4, len(data) - 8)
+        if self.has_alpha:
+            data[20] |= 0x10
+        return bytes(data)
+
+
+def resize_animation(im: PILImage.Image, max_dimension: int, output_format: str, quality: int = 80, step: int = 1, strategy: Union[str, None] = None) -> bytes:
+    '''
+    Resize every frame of an animated image to fit max_dimension, stream them into an
+    animated GIF or WebP.
+
+    Args:
+        im: an animated image, opened (not loaded).
+        max_dimension: the longer side of the output, 0 means unchanged.
+        output_format: 'GIF' or 'WEBP'.
+        quality: WebP quality, GIF ignores it.
+        step: keep 1 of step frames.
+        strategy: resample strategy.
+
+    Returns:
+        bytes: the animated file.
+    '''
+    if output_format not in ANIMATED_FORMATS:
+        raise Exception(f'Unknown animated format {output_format}, choose from {list(ANIMATED_FORMATS)}')
+    size = fit_size(im.size, max_dimension) if max_dimension > 0 else im.size
+    # A GIF without a NETSCAPE block plays once, None keeps it that way
+    loop = im.info.get('loop', None)
+    writer = GifWriter(size, loop) if output_format == 'GIF' else WebPWriter(size, loop)
+    for frame, has_alpha, duration in iter_frames(im, size, strategy, step):
+        writer.add(frame, duration, has_alpha, quality)
+    return writer.finish()
+
+
+def fit_animation(im: PILImage.Image, max_bytes: float, output_format: str, quality: int = 80, strategy: Union[str, None] = None) -> bytes:
+    ''' Animated output under max_bytes: drop frames first (up to 1 of MAX_FRAME_STEP), then shrink the dimensions '''
+    longer_side = max(im.size)
+    step = 1
+    for _ in range(MAX_BUDGET_PASSES):
+        data = resize_animation(im, longer_side, output_format, quality, step, strategy)
+        if len(data) <= max_bytes:
+            return data
+        # Bytes go roughly with the number of frames
+        wanted_step = math.ceil(step * len(data) / max_bytes)
+        if step < MAX_FRAME_STEP:
+            step = min(wanted_step, MAX_FRAME_STEP)
+        else:
+            longer_side = max(int(longer_side * SHRINK_FACTOR), 1)
+    raise Exception(f'Animation still over {max_bytes} bytes after {MAX_BUDGET_PASSES} passes')
@@ -0,0 +1,261 @@
+'''
+    Process the images of a tar or zip archive in one streaming pass, without extracting it.
+
+    Members are read in archive order. Images are sent to workers as bytes (the operation
+    cores of BytesHelper), at most a window of them in flight, so memory stays bounded by
+    the window and not by the archive. Other members are copied through as they are read.
+    Results are written as they complete, into an output archive or a folder.
+
+    Input: .tar (also .tar.gz, .tgz, .tar.bz2, .tar.xz, read as a stream) or .zip.
+    Output: same kinds of archive, or a folder. Images are stored (not deflated) in a zip,
+    they are compressed already.
+'''
+import io
+import os
+import time
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait
+)
+from typing import BinaryIO, List, Union
+
+from .utils import (
+    OpResult,
+    BytesHelper,
+    max_process_count
+)
+
+ARCHIVE_SUFFIXES = ['.tar', '.tgz', '.tar.gz', '.tar.bz2', '.tar.xz', '.zip']
+
+# Images in flight per worker.
+WINDOW_PER_WORKER = 4
+
+
+def archive_kind(path: Union[str, Path]) -> Union[str, None]:
+    ''' 'tar', 'zip' or None, from the file name '''
+    name = str(path).lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if any([name.endswith(x) for x in ARCHIVE_SUFFIXES]):
+        return 'tar'
+    return None
+
+
+def _tar_write_mode(path: Union[str, Path]) -> str:
+    name = str(path).lower()
+    if name.endswith(('.tar.gz', '.tgz')):
+        return 'w|gz'
+    if name.endswith('.tar.bz2'):
+        return 'w|bz2'
+    if name.endswith('.tar.xz'):
+        return 'w|xz'
+    return 'w|'
+
+
+def _process_member(data: bytes, method_name: str, config: dict) -> OpResult:
+    ''' Worker: run the operation core on one member '''
+    return BytesHelper.select_helper(method_name)(data, config)
+
+
+def _output_name(name: str, suffix: Union[str, None]) -> str:
+    if suffix is None:
+        return name
+    return str(PurePosixPath(name).with_suffix(suffix))
+
+
+class TarOutput:
+    ''' Write members into a tar stream '''
+    def __init__(self, target: Union[Path, BinaryIO]):
+        if isinstance(target, Path):
+            self.tar = tarfile.open(str(target), _tar_write_mode(target))
+        else:
+            self.tar = tarfile.open(fileobj=target, mode='w|')
+
+    def add_dir(self, name: str, mtime: float):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = mtime
+        self.tar.addfile(info)
+
+    def add_file(self, name: str, fileobj: BinaryIO, size: int, mtime: float, compress: bool):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = mtime
+        self.tar.addfile(info, fileobj)
+
+    def close(self):
+        self.tar.close()
+
+
+class ZipOutput:
+    ''' Write members into a zip file, compressed members deflated, images stored '''
+    def __init__(self, target: Union[Path, BinaryIO]):
+        self.zip = zipfile.ZipFile(target, 'w', allowZip64=True)
+
+    def add_dir(self, name: str, mtime: float):
+        self.zip.writestr(zipfile.ZipInfo(name.rstrip('/') + '/', time.localtime(max(mtime, 315532800))[:6]), b'')
+
+    def add_file(self, name: str, fileobj: BinaryIO, size: int, mtime: float, compress: bool):
+        info = zipfile.ZipInfo(name, time.localtime(max(mtime, 315532800))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.file_size = size
+        with self.zip.open(info, 'w', force_zip64=size > 0x7FFFFFFF) as f:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    def close(self):
+        self.zip.close()
+
+
+class FolderOutput:
+    ''' Write members as files under a folder, names can't escape it '''
+    def __init__(self, folder: Path):
+        self.folder = folder.resolve()
+        self.folder.mkdir(exist_ok=True)
+
+    def _path(self, name: str) -> Path:
+        path = self.folder.joinpath(*PurePosixPath(name).parts).resolve()
+        if self.folder not in path.parents and path != self.folder:
+            raise Exception(f'member outside of the output folder: {name}')
+        return path
+
+    def add_dir(self, name: str, mtime: float):
+        self._path(name).mkdir(parents=True, exist_ok=True)
+
+    def add_file(self, name: str, fileobj: BinaryIO, size: int, mtime: float, compress: bool):
+        path = self._path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+        os.utime(path, (mtime, mtime))
+
+    def close(self):
+        pass
+
+
+def open_output(dst: Union[Path, BinaryIO]):
+    ''' Output for a path: an archive if it has an archive suffix, else a folder '''
+    if not isinstance(dst, Path):
+        return TarOutput(dst)
+    kind = archive_kind(dst)
+    if kind is None:
+        return FolderOutput(dst)
+    if dst.exists():
+        raise Exception(f'{dst} exists.')
+    return TarOutput(dst) if kind == 'tar' else ZipOutput(dst)
+
+
+def _members(src: Union[Path, BinaryIO]):
+    ''' Yield (name, is dir, size, mtime, open) of each member, in archive order.
+
+        open() gives a file object of the member, valid until the next member.
+    '''
+    if isinstance(src, Path) and archive_kind(src) == 'zip':
+        with zipfile.ZipFile(src) as zf:
+            for info in zf.infolist():
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                yield (info.filename, info.is_dir(), info.file_size, mtime, lambda info=info: zf.open(info))
+        return
+
+    with (tarfile.open(str(src), 'r|*') if isinstance(src, Path) else tarfile.open(fileobj=src, mode='r|*')) as tar:
+        for info in tar:
+            if info.isdir():
+                yield (info.name, True, 0, info.mtime, None)
+            elif info.isfile():
+                yield (info.name, False, info.size, info.mtime, lambda info=info: tar.extractfile(info))
+            # links, devices: skipped
+
+
+def process_archive(src: Union[Path, BinaryIO], dst: Union[Path, BinaryIO], transform: List[str], method_name: str, config: dict, executor: str = 'processes', workers: int = 0):
+    '''
+    Run method_name over the images of an archive, write every member into dst.
+
+    Args:
+        src (Path): a tar or zip file, or a binary stream of a tar.
+        dst (Path): an archive to create (.tar, .tar.gz, .zip...) or a folder, or a binary
+            stream (a tar is written there).
+        transform: a list of suffixes, eg. '.png', '.jpeg', '.jpg'
+        method_name: one of the operations of BytesHelper
+        config: the config that the method needed
+        executor: 'threads', else worker processes
+        workers: number of workers, if 0 then max_process_count()
+
+    Yields:
+        str: progress messages.
+    '''
+    BytesHelper.select_helper(method_name)
+    workers = workers or max_process_count()
+    window = workers * WINDOW_PER_WORKER
+    print(f'multi-workers: {workers}')
+
+    output = open_output(dst)
+    pool = ThreadPoolExecutor(workers) if executor == 'threads' else ProcessPoolExecutor(workers)
+    start = time.perf_counter()
+    n_of_images, n_of_copies, n_of_errors = 0, 0, 0
+
+    # future -> (name, source bytes, mtime)
+    running = {}
+
+    def finish(futures):
+        nonlocal n_of_images, n_of_errors
+        for future in futures:
+            name, data, mtime = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                n_of_errors += 1
+                yield f'Error: {name}: {type(e).__name__}: {e}'
+                continue
+            n_of_images += 1
+            if result is None:
+                output.add_file(name, io.BytesIO(data), len(data), mtime, False)
+            else:
+                output.add_file(_output_name(name, result[1]), io.BytesIO(result[0]), len(result[0]), mtime, False)
+            yield f'Process:{method_name}: {name}'
+
+    try:
+        for name, is_dir, size, mtime, open_member in _members(src):
+            if is_dir:
+                output.add_dir(name, mtime)
+                continue
+
+            if PurePosixPath(name).suffix.lower() in transform and not PurePosixPath(name).name.startswith('.'):
+                with open_member() as f:
+                    data = f.read()
+                running[pool.submit(_process_member, data, method_name, config)] = (name, data, mtime)
+                # Bounded window: wait for some results before reading more
+                while len(running) >= window:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    yield from finish(done)
+            else:
+                with open_member() as f:
+                    output.add_file(name, f, size, mtime, True)
+                n_of_copies += 1
+                yield f'Copy: {name}'
+
+            done = [x for x in running if x.done()]
+            yield from finish(done)
+
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            yield from finish(done)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        output.close()
+
+    seconds = time.perf_counter() - start
+    yield f'Archive done: {n_of_images} images, {n_of_copies} copied, {n_of_errors} failed in {seconds:.1f}s ({n_of_images / max(seconds, 1e-6):.1f} images/s)'
@@ -0,0 +1,291 @@
+'''
+    Bounded-memory downscale of huge TIFF images, band by band.
+
+    A band is a run of whole strips (or whole rows of tiles). Its compressed bytes are
+    copied into a small standalone TIFF with the same compression, predictor, photometric...
+    tags, which Pillow decodes as usual. Each band is shrunk by an integer factor with
+    reduce() (box filter), the rows that don't fill a whole box are carried over to the
+    next band. The reduced image is small, it gets the final LANCZOS resize.
+
+    This is what Image.thumbnail() does with its default reducing_gap, so the output
+    matches the full decode, while memory is bounded by one band plus the reduced image.
+
+    Images that can't be split this way (PSD, planar configuration 2, a single compressed
+    strip, old-style JPEG) are decoded at once, with the decompression bomb limit lifted.
+'''
+import io
+import math
+import struct
+import threading
+from pathlib import Path
+from typing import BinaryIO, List, Tuple, Union
+
+import PIL
+from PIL import Image as PILImage
+
+# Decoded pixels per band (about 48MB in RGB).
+BAND_PIXELS = 16 * 1024 * 1024
+
+# Smaller TIFFs are decoded at once, the usual way.
+BANDED_MIN_PIXELS = 64 * 1024 * 1024
+
+# Same gap as Image.thumbnail(): box reduce down to 2x the final size, then LANCZOS.
+REDUCING_GAP = 2.0
+
+# TIFF tags
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_COMPRESSION = 259
+_STRIP_OFFSETS = 273
+_ROWS_PER_STRIP = 278
+_STRIP_BYTE_COUNTS = 279
+_PLANAR_CONFIGURATION = 284
+_TILE_WIDTH = 322
+_TILE_LENGTH = 323
+_TILE_OFFSETS = 324
+_TILE_BYTE_COUNTS = 325
+
+# TIFF field types
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+_UNDEFINED = 7
+_TYPE_SIZES = {_SHORT: 2, _LONG: 4, _RATIONAL: 8, _UNDEFINED: 1}
+
+# Tags a band needs to be decoded like the source, with the type they are written with
+_COPIED_TAGS = {
+    258: _SHORT,      # BitsPerSample
+    259: _SHORT,      # Compression
+    262: _SHORT,      # PhotometricInterpretation
+    266: _SHORT,      # FillOrder
+    277: _SHORT,      # SamplesPerPixel
+    284: _SHORT,      # PlanarConfiguration
+    317: _SHORT,      # Predictor
+    320: _SHORT,      # ColorMap
+    338: _SHORT,      # ExtraSamples
+    339: _SHORT,      # SampleFormat
+    347: _UNDEFINED,  # JPEGTables
+    529: _RATIONAL,   # YCbCrCoefficients
+    530: _SHORT,      # YCbCrSubsampling
+    531: _SHORT,      # YCbCrPositioning
+    532: _RATIONAL,   # ReferenceBlackWhite
+}
+
+# Band = (top row, rows, [(offset, byte count)] of its strips or tiles)
+Band = Tuple[int, int, List[Tuple[int, int]]]
+
+_pixel_limit_lock = threading.Lock()
+
+
+def open_unlimited(source: Union[Path, BinaryIO]) -> PILImage.Image:
+    ''' Image.open() without the decompression bomb check, for images known to be huge '''
+    with _pixel_limit_lock:
+        limit = PILImage.MAX_IMAGE_PIXELS
+        PILImage.MAX_IMAGE_PIXELS = None
+        try:
+            return PILImage.open(source)
+        finally:
+            PILImage.MAX_IMAGE_PIXELS = limit
+
+
+def tiff_exif(im: PILImage.Image) -> PILImage.Exif:
+    ''' EXIF of a TIFF without its image structure tags (strips, tiles, compression...),
+        they describe the TIFF's own pixel data and can't be written into another file '''
+    exif = im.getexif()
+    for tag in list(_COPIED_TAGS) + [_IMAGE_WIDTH, _IMAGE_LENGTH, _STRIP_OFFSETS, _ROWS_PER_STRIP, _STRIP_BYTE_COUNTS, _TILE_WIDTH, _TILE_LENGTH, _TILE_OFFSETS, _TILE_BYTE_COUNTS]:
+        if tag in exif:
+            del exif[tag]
+    return exif
+
+
+def fit_size(size: Tuple[int, int], max_dimension: int) -> Tuple[int, int]:
+    ''' The size Image.thumbnail((max_dimension, max_dimension)) gives, without the image '''
+    width, height = size
+    if max_dimension >= width and max_dimension >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    x = y = max_dimension
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return (x, y)
+
+
+def _values(value) -> tuple:
+    if isinstance(value, bytes):
+        return (value,)
+    if isinstance(value, tuple):
+        return value
+    return (value,)
+
+
+def _split_bands(im: PILImage.Image, band_pixels: int = BAND_PIXELS) -> Union[Tuple[List[Band], dict], None]:
+    ''' Cut a TIFF into bands, None if its layout can't be split.
+
+    Returns:
+        tuple: the bands, the layout tags of the band TIFFs (rows per strip, or tile size).
+    '''
+    tags = im.tag_v2
+    width, height = im.size
+    compression = tags.get(_COMPRESSION, 1)
+    if tags.get(_PLANAR_CONFIGURATION, 1) != 1 or compression == 6:
+        return None
+    rows_target = max(1, band_pixels // width)
+
+    if _TILE_OFFSETS in tags:
+        tile_width, tile_length = tags[_TILE_WIDTH], tags[_TILE_LENGTH]
+        across = math.ceil(width / tile_width)
+        tiles = list(zip(tags[_TILE_OFFSETS], tags[_TILE_BYTE_COUNTS]))
+        tile_rows_per_band = max(1, rows_target // tile_length)
+        bands = []
+        for top_tile_row in range(0, math.ceil(height / tile_length), tile_rows_per_band):
+            top = top_tile_row * tile_length
+            rows = min(tile_rows_per_band * tile_length, height - top)
+            first = top_tile_row * across
+            bands.append((top, rows, tiles[first:first + math.ceil(rows / tile_length) * across]))
+        return bands, {_TILE_WIDTH: tile_width, _TILE_LENGTH: tile_length}
+
+    rows_per_strip = min(tags.get(_ROWS_PER_STRIP, height), height)
+    strips = list(zip(tags[_STRIP_OFFSETS], tags[_STRIP_BYTE_COUNTS]))
+
+    if compression == 1 and rows_per_strip > rows_target:
+        # Uncompressed: cut big strips at any row
+        bits = sum(_values(tags.get(258, 8)))
+        row_bytes = math.ceil(width * bits / 8)
+        bands = []
+        for idx, (offset, _) in enumerate(strips):
+            strip_top = idx * rows_per_strip
+            strip_rows = min(rows_per_strip, height - strip_top)
+            for row in range(0, strip_rows, rows_target):
+                rows = min(rows_target, strip_rows - row)
+                bands.append((strip_top + row, rows, [(offset + row * row_bytes, rows * row_bytes)]))
+        return bands, {_ROWS_PER_STRIP: None}
+
+    if len(strips) == 1 and height > rows_target:
+        return None
+
+    strips_per_band = max(1, rows_target // rows_per_strip)
+    bands = []
+    for idx in range(0, len(strips), strips_per_band):
+        top = idx * rows_per_strip
+        rows = min(strips_per_band * rows_per_strip, height - top)
+        bands.append((top, rows, strips[idx:idx + strips_per_band]))
+    return bands, {_ROWS_PER_STRIP: rows_per_strip}
+
+
+def _band_tiff(prefix: bytes, width: int, rows: int, copied: dict, layout: dict, chunks: List[bytes]) -> bytes:
+    ''' A standalone TIFF holding one band: copied tags, the band's strips (or tiles) as they are '''
+    e = '<' if prefix == b'II' else '>'
+    entries = {tag: (kind, _values(value)) for tag, (kind, value) in copied.items()}
+    entries[_IMAGE_WIDTH] = (_LONG, (width,))
+    entries[_IMAGE_LENGTH] = (_LONG, (rows,))
+    if _TILE_WIDTH in layout:
+        entries[_TILE_WIDTH] = (_LONG, (layout[_TILE_WIDTH],))
+        entries[_TILE_LENGTH] = (_LONG, (layout[_TILE_LENGTH],))
+        offsets_tag, counts_tag = _TILE_OFFSETS, _TILE_BYTE_COUNTS
+    else:
+        entries[_ROWS_PER_STRIP] = (_LONG, (layout[_ROWS_PER_STRIP] or rows,))
+        offsets_tag, counts_tag = _STRIP_OFFSETS, _STRIP_BYTE_COUNTS
+    entries[counts_tag] = (_LONG, tuple([len(x) for x in chunks]))
+    entries[offsets_tag] = (_LONG, (0,) * len(chunks))
+
+    def pack(kind, values) -> bytes:
+        if kind == _UNDEFINED:
+            return values[0]
+        if kind == _RATIONAL:
+            return b''.join([struct.pack(e + 'LL', x.numerator, x.denominator) for x in values])
+        return struct.pack(e + ('H' if kind == _SHORT else 'L') * len(values), *values)
+
+    def count(kind, values) -> int:
+        return len(values[0]) if kind == _UNDEFINED else len(values)
+
+    # Header, IFD, out of line values, then the pixel data
+    ifd_size = 2 + 12 * len(entries) + 4
+    extra_offset = 8 + ifd_size
+    extra_size = 0
+    for kind, values in entries.values():
+        size = count(kind, values) * _TYPE_SIZES[kind]
+        if size > 4:
+            extra_size += size + (size % 2)
+    data_offset = extra_offset + extra_size
+    starts = []
+    for x in chunks:
+        starts.append(data_offset)
+        data_offset += len(x)
+    entries[offsets_tag] = (_LONG, tuple(starts))
+
+    ifd = [struct.pack(e + 'H', len(entries))]
+    extra = []
+    for tag in sorted(entries):
+        kind, values = entries[tag]
+        packed = pack(kind, values)
+        if len(packed) <= 4:
+            ifd.append(struct.pack(e + 'HHL', tag, kind, count(kind, values)) + packed.ljust(4, b'\0'))
+        else:
+            ifd.append(struct.pack(e + 'HHLL', tag, kind, count(kind, values), extra_offset))
+            extra.append(packed + b'\0' * (len(packed) % 2))
+            extra_offset += len(extra[-1])
+    ifd.append(struct.pack(e + 'L', 0))
+    return b''.join([prefix, struct.pack(e + 'HL', 42, 8)] + ifd + extra + chunks)
+
+
+def banded_thumbnail(im: PILImage.Image, max_dimension: int, band_pixels: int = BAND_PIXELS) -> Union[PILImage.Image, None]:
+    ''' Shrink an opened (not loaded) TIFF to fit max_dimension, band by band.
+
+    Returns:
+        Image: L or RGB, None if the TIFF layout can't be split into bands.
+    '''
+    split = _split_bands(im, band_pixels)
+    if split is None:
+        return None
+    bands, layout = split
+
+    width, height = im.size
+    target = fit_size(im.size, max_dimension or max(im.size))
+    factor_x = int(width / target[0] / REDUCING_GAP) or 1
+    factor_y = int(height / target[1] / REDUCING_GAP) or 1
+
+    prefix = im.tag_v2.prefix
+    copied = {tag: (kind, im.tag_v2[tag]) for tag, kind in _COPIED_TAGS.items() if tag in im.tag_v2}
+
+    reduced = None
+    carry = None
+    top = 0
+    for _, rows, ranges in bands:
+        chunks = []
+        for offset, byte_count in ranges:
+            im.fp.seek(offset)
+            chunks.append(im.fp.read(byte_count))
+        band = PILImage.open(io.BytesIO(_band_tiff(prefix, width, rows, copied, layout, chunks)))
+        if band.mode not in ("L", "RGB"):
+            band = band.convert("RGB")
+        else:
+            band.load()
+
+        # Rows left over by the previous band go first
+        if carry is not None:
+            merged = PILImage.new(band.mode, (width, carry.height + band.height))
+            merged.paste(carry, (0, 0))
+            merged.paste(band, (0, carry.height))
+            band = merged
+        if reduced is None:
+            reduced = PILImage.new(band.mode, (math.ceil(width / factor_x), math.ceil(height / factor_y)))
+
+        usable = band.height - band.height % factor_y
+        if usable:
+            reduced.paste(band.reduce((factor_x, factor_y), box=(0, 0, width, usable)), (0, top))
+            top += usable // factor_y
+        carry = band.crop((0, usable, width, band.height)) if usable < band.height else None
+
+    # Like reduce() on the full image, the last partial box is averaged as is
+    if carry is not None:
+        reduced.paste(carry.reduce((factor_x, factor_y)), (0, top))
+
+    if target == (width, height):
+        return reduced
+    return reduced.resize(target, resample=PIL.Image.Resampling.LANCZOS, box=(0, 0, width / factor_x, height / factor_y))
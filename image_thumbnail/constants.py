@@ -54,14 +54,20 @@ class JpegImageQuality:
     JPEG_LIGHT      = 80
 
 
+# Lowest JPEG quality the quality and joint strategies (and the SSIM search) go down to
+MIN_SEARCH_QUALITY = 40
+
+
 IMAGE_SUFFIX = [
     '.jxl', # jpegxl
+    '.avif',
     '.jpeg',
     '.jpg',
     '.png',
     '.gif',
     '.webp',
     '.tiff',
+    '.tif',
     '.psd',
     '.raw',
     '.bmp',
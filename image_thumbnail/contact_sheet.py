@@ -0,0 +1,193 @@
+'''
+    Streaming contact sheets (rows x columns grid of images).
+
+    The output canvas is never allocated as a whole: one row of tiles is
+    rendered at a time and encoded progressively into a PNG file, so peak
+    memory is bounded by a single row regardless of the number of images.
+'''
+import struct
+import zlib
+from pathlib import Path
+from typing import List, Union, Tuple, BinaryIO
+
+from PIL import (
+    Image as PILImage,
+    ImageChops,
+    ImageOps
+)
+
+from . import utils
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG row filter type "Up": each byte minus the byte right above it.
+PNG_FILTER_UP = b'\x02'
+
+# Flush an IDAT chunk once this many compressed bytes are pending.
+IDAT_CHUNK_SIZE = 1024 * 1024
+
+
+class PNGStreamWriter:
+    ''' Write an RGB PNG file strip by strip.
+
+        Usage:
+            with open('out.png', 'wb') as f:
+                writer = PNGStreamWriter(f, width, height)
+                writer.write_strip(strip_1)
+                writer.write_strip(strip_2)
+                writer.close()
+    '''
+    def __init__(self, fp: BinaryIO, width: int, height: int, compress_level: int = 6):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+        # Last row of the previous strip, the "Up" filter of the next strip refers to it.
+        self._prior_row = PILImage.new('RGB', (width, 1))
+
+        self.fp.write(PNG_SIGNATURE)
+        # 8 bit depth, color type 2 (RGB), deflate, adaptive filtering, no interlace
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self.fp.write(struct.pack('>I', len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def _feed(self, data: bytes):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._pending.append(compressed)
+            self._pending_size += len(compressed)
+        if self._pending_size >= IDAT_CHUNK_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending_size:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+
+    def write_strip(self, strip: PILImage.Image):
+        ''' Append a strip (full width, any height) to the image '''
+        if strip.width != self.width:
+            raise ValueError(f'Strip width {strip.width} != image width {self.width}')
+        if self.rows_written + strip.height > self.height:
+            raise ValueError(f'Too many rows, image height is {self.height}')
+        if strip.mode != 'RGB':
+            strip = strip.convert('RGB')
+
+        # Apply the "Up" filter with Pillow: strip minus (strip shifted down by one row).
+        above = PILImage.new('RGB', strip.size)
+        above.paste(self._prior_row, (0, 0))
+        if strip.height > 1:
+            above.paste(strip.crop((0, 0, strip.width, strip.height - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+        del above
+
+        stride = self.width * 3
+        for offset in range(0, len(filtered), stride):
+            self._feed(PNG_FILTER_UP)
+            self._feed(filtered[offset:offset + stride])
+
+        self._prior_row = strip.crop((0, strip.height - 1, strip.width, strip.height))
+        self.rows_written += strip.height
+
+    def close(self):
+        ''' Finish the image, all rows must be written '''
+        if self.rows_written != self.height:
+            raise ValueError(f'Only {self.rows_written} of {self.height} rows written')
+        tail = self._compressor.flush()
+        if tail:
+            self._pending.append(tail)
+            self._pending_size += len(tail)
+        self._flush_idat()
+        self._write_chunk(b'IEND', b'')
+
+
+def _orientation(im: PILImage.Image) -> int:
+    ''' EXIF orientation of an opened image, 1 if unknown '''
+    try:
+        return im.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+
+def header_size(pic_path: Union[str, Path]) -> Tuple[int, int]:
+    ''' Size (width, height) of an image after orientation, read from header only '''
+    with PILImage.open(pic_path) as im:
+        width, height = im.size
+        orientation = _orientation(im)
+    if orientation in (5, 6, 7, 8):
+        return (height, width)
+    return (width, height)
+
+
+def tile_size(sizes: List[Tuple[int, int]], width_aspect_ratio: int, height_aspect_ratio: int) -> Tuple[int, int]:
+    ''' Compute the (width, height) of each tile, same rule as utils.concat_imgs_2 '''
+    min_height = min([x[1] for x in sizes])
+    min_width = min([int(min_height * (x[0] / x[1])) for x in sizes])
+
+    each_width = min_width
+    each_height = int((min_width / width_aspect_ratio) * height_aspect_ratio)
+    if each_height > min_height:
+        each_height = min_height
+        each_width = int((min_height / height_aspect_ratio) * width_aspect_ratio)
+
+    return (each_width, each_height)
+
+
+def _render_tile(pic_path: Union[str, Path], min_height: int, each_width: int, each_height: int) -> PILImage.Image:
+    ''' Open one image and turn it into a tile of (each_width, each_height) '''
+    with PILImage.open(pic_path) as src:
+        # JPEG can decode at a reduced scale, keeps memory low for huge frames.
+        if _orientation(src) in (5, 6, 7, 8):
+            src.draft('RGB', (min_height, 1))
+        else:
+            src.draft('RGB', (1, min_height))
+
+        # Every orientation (mirrored ones too), the same size header_size() expects
+        im = ImageOps.exif_transpose(src)
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im = utils.resize_to_height(im, min_height)
+        return utils.crop_center(im, min(each_width, im.width), each_height)
+
+
+def concat_grid(pic_paths: List[Union[str, Path]], output_path: Union[str, Path], columns: int, width_aspect_ratio: int, height_aspect_ratio: int):
+    ''' Concat images into a grid of rows x columns, streamed into a PNG file.
+
+        Each image is resized and cropped to the same aspect ratio (as concat_imgs_2 does),
+        then placed left to right, top to bottom. Missing cells of the last row stay black.
+
+    Args:
+        pic_paths (list): image file paths, in order.
+        output_path (str): the PNG file to write.
+        columns (int): number of tiles per row. 1 = vertical strip, len(pic_paths) = horizontal strip.
+        width_aspect_ratio (int): the width aspect ratio of each tile.
+        height_aspect_ratio (int): the height aspect ratio of each tile.
+    '''
+    if columns <= 0:
+        raise ValueError(f'Columns {columns} must be positive')
+
+    sizes = [header_size(x) for x in pic_paths]
+    min_height = min([x[1] for x in sizes])
+    each_width, each_height = tile_size(sizes, width_aspect_ratio, height_aspect_ratio)
+
+    columns = min(columns, len(pic_paths))
+    rows = (len(pic_paths) + columns - 1) // columns
+    print(f'grid: {rows}x{columns}, each_width: {each_width}, each_height: {each_height}')
+
+    with open(output_path, 'wb') as f:
+        writer = PNGStreamWriter(f, each_width * columns, each_height * rows)
+        for row in range(rows):
+            strip = PILImage.new('RGB', (each_width * columns, each_height))
+            for column, pic_path in enumerate(pic_paths[row * columns:(row + 1) * columns]):
+                tile = _render_tile(pic_path, min_height, each_width, each_height)
+                strip.paste(tile, (column * each_width, 0))
+            writer.write_strip(strip)
+        writer.close()
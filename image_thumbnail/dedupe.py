@@ -0,0 +1,157 @@
+'''
+    Near-duplicate images (bursts, re-exports, resized copies) by perceptual hashes.
+
+    Each image is decoded small (JPEG draft: the DCT scaled down while decoding) and gets:
+        dHash:  9x8 grayscale, 1 bit per horizontal neighbour pair (brighter or not).
+        pHash:  32x32 grayscale, 2D DCT, the 8x8 lowest frequencies (DC left out) against
+                their median.
+    Both are 64 bits, similar images are a few bits apart (Hamming distance).
+
+    Candidates are found with a BK-tree over the dHashes (a metric tree: only branches
+    within the distance are visited), then confirmed with the pHash. Groups are built
+    around the image kept: biggest images first, each one not yet grouped takes the
+    ungrouped images within the distance of itself. So every duplicate is close to the
+    image kept for it, chains (A~B~C with A far from C) don't merge into one group.
+'''
+import os
+from typing import Dict, Iterable, List, Tuple
+
+from PIL import (
+    Image as PILImage,
+    ImageOps
+)
+
+# Near-duplicate: both hashes at most this many bits apart
+DEFAULT_DISTANCE = 6
+
+# Side the image is decoded at for hashing
+HASH_DECODE_SIDE = 64
+
+
+def _bits(values: Iterable[bool]) -> int:
+    result = 0
+    for x in values:
+        result = (result << 1) | (1 if x else 0)
+    return result
+
+
+def dhash(im: PILImage.Image) -> int:
+    ''' 64 bit difference hash of a grayscale image '''
+    small = im.convert('L').resize((9, 8), PILImage.Resampling.BOX)
+    pixels = list(small.getdata())
+    return _bits([pixels[row * 9 + col] > pixels[row * 9 + col + 1] for row in range(8) for col in range(8)])
+
+
+def phash(im: PILImage.Image) -> int:
+    ''' 64 bit DCT hash of a grayscale image, needs numpy '''
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception('pHash needs numpy: pip install numpy')
+    small = np.asarray(im.convert('L').resize((32, 32), PILImage.Resampling.BOX), dtype=np.float64)
+    # DCT-II as a matrix product, rows then columns
+    n = np.arange(32)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+    low = (basis @ small @ basis.T)[:8, :8].flatten()[1:]
+    return _bits(low > np.median(low))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def image_hashes(path: str) -> Tuple[int, int, Tuple[int, int]]:
+    ''' (dHash, pHash, full size) of an image file, decoded small, EXIF orientation applied '''
+    with PILImage.open(path) as im:
+        size = im.size
+        im.draft('L', (HASH_DECODE_SIDE, HASH_DECODE_SIDE))
+        small = ImageOps.exif_transpose(im)
+        small.thumbnail((HASH_DECODE_SIDE, HASH_DECODE_SIDE), PILImage.Resampling.BOX)
+    return (dhash(small), phash(small), size)
+
+
+class BKTree:
+    ''' Burkhard-Keller tree of 64 bit hashes under the Hamming distance '''
+    def __init__(self):
+        # node: [hash, items, {distance: child node}]
+        self.root = None
+
+    def add(self, value: int, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, object]]:
+        ''' (distance, item) of every hash at most radius bits from value '''
+        found = []
+        todo = [self.root] if self.root is not None else []
+        while todo:
+            node = todo.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend([(distance, x) for x in node[1]])
+            # Triangle inequality: only children in [distance - radius, distance + radius]
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    todo.append(child)
+        return found
+
+
+def find_duplicates(rows: List[dict], max_distance: int = DEFAULT_DISTANCE) -> Dict[str, str]:
+    '''
+    Group near-duplicates around the image kept for each group.
+
+    Args:
+        rows: dicts with 'path', 'dhash', 'phash' (ints), and 'width', 'height', 'size'
+            to pick the image kept in a group.
+        max_distance: bits apart, on both hashes.
+
+    Returns:
+        dict: path of each duplicate -> path of the image kept for its group, both
+            hashes at most max_distance bits apart.
+    '''
+    tree = BKTree()
+    for idx, row in enumerate(rows):
+        tree.add(row['dhash'], idx)
+
+    def rank(row: dict):
+        return ((row.get('width') or 0) * (row.get('height') or 0), row.get('size') or 0)
+
+    # Most pixels, then biggest file, then first path
+    order = sorted(range(len(rows)), key=lambda x: rows[x]['path'])
+    order = sorted(order, key=lambda x: rank(rows[x]), reverse=True)
+
+    duplicates = {}
+    grouped = set()
+    for idx in order:
+        if idx in grouped:
+            continue
+        grouped.add(idx)
+        kept = rows[idx]
+        for _, other in tree.search(kept['dhash'], max_distance):
+            if other not in grouped and hamming(kept['phash'], rows[other]['phash']) <= max_distance:
+                grouped.add(other)
+                duplicates[rows[other]['path']] = kept['path']
+    return duplicates
+
+
+def hash_file(path: str) -> dict:
+    ''' A row of the hashes table, error filled if the file can't be hashed '''
+    st = os.stat(path)
+    row = {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'width': None, 'height': None, 'dhash': None, 'phash': None, 'error': None}
+    try:
+        d, p, (row['width'], row['height']) = image_hashes(path)
+        row['dhash'], row['phash'] = format(d, '016x'), format(p, '016x')
+    except Exception as e:
+        row['error'] = str(e)
+    return row
@@ -0,0 +1,93 @@
+'''
+    DeepZoom tile pyramids, so viewers (eg. OpenSeadragon) fetch only the visible tiles.
+
+    Output of an image "photo.jpg":
+        photo.dzi                   XML descriptor: tile size, overlap, format, full size.
+        photo_files/<level>/<col>_<row>.jpg
+                                    level 0 is 1x1 pixel, the top level is the full size,
+                                    every level is half the next one (rounded up).
+
+    Each level is built from the one above it (2x2 box reduce), never from the original,
+    and the tiles of a level are cropped and encoded by a thread pool.
+'''
+import math
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from PIL import Image as PILImage
+
+from . import utils
+
+# DeepZoom defaults: 254 + 2 x 1 pixel overlap = 256 pixel tiles
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+
+# Tiles encoded in parallel per image, Pillow encoders release the GIL.
+TILE_THREADS = 4
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+
+def level_count(size: Tuple[int, int]) -> int:
+    ''' Number of levels, the smallest one is 1x1 '''
+    return math.ceil(math.log2(max(size))) + 1 if max(size) > 1 else 1
+
+
+def tile_boxes(size: Tuple[int, int], tile_size: int, overlap: int) -> List[Tuple[int, int, Tuple[int, int, int, int]]]:
+    ''' (column, row, crop box) of every tile of a level '''
+    width, height = size
+    boxes = []
+    for row in range(math.ceil(height / tile_size)):
+        for col in range(math.ceil(width / tile_size)):
+            left = col * tile_size - (overlap if col > 0 else 0)
+            upper = row * tile_size - (overlap if row > 0 else 0)
+            right = min((col + 1) * tile_size + overlap, width)
+            lower = min((row + 1) * tile_size + overlap, height)
+            boxes.append((col, row, (left, upper, right, lower)))
+    return boxes
+
+
+def build_pyramid(im: PILImage.Image, dzi_path: Path, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP, quality: int = 85, tile_format: str = 'jpg', n_of_threads: int = TILE_THREADS) -> int:
+    ''' Write the .dzi and the tiles of every level of an image. Return the number of tiles '''
+    if tile_format not in ('jpg', 'png'):
+        raise Exception(f'Unknown tile format {tile_format}, choose from jpg, png')
+    if im.mode not in ('L', 'RGB') and tile_format == 'jpg':
+        im = im.convert('RGB')
+
+    utils.if_exists_then_raise(dzi_path)
+    tiles_folder = dzi_path.parent.joinpath(dzi_path.stem + '_files')
+    tiles_folder.mkdir(exist_ok=True)
+
+    def save(tile: PILImage.Image, path: Path):
+        if tile_format == 'jpg':
+            tile.save(path, 'JPEG', quality=quality)
+        else:
+            tile.save(path, 'PNG')
+
+    n_of_tiles = 0
+    level_image = im
+    with ThreadPoolExecutor(n_of_threads) as pool:
+        for level in reversed(range(level_count(im.size))):
+            level_folder = tiles_folder.joinpath(str(level))
+            level_folder.mkdir(exist_ok=True)
+            jobs = [
+                pool.submit(save, level_image.crop(box), level_folder.joinpath(f'{col}_{row}.{tile_format}'))
+                for col, row, box in tile_boxes(level_image.size, tile_size, overlap)
+            ]
+            # Next level from this one, while the tiles are being encoded
+            if level > 0:
+                next_image = level_image.reduce(2)
+            for x in jobs:
+                x.result()
+            n_of_tiles += len(jobs)
+            if level > 0:
+                level_image = next_image
+
+    with open(dzi_path, 'w') as f:
+        f.write(DZI_TEMPLATE.format(format=tile_format, overlap=overlap, tile_size=tile_size, width=im.width, height=im.height))
+    return n_of_tiles
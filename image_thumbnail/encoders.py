@@ -0,0 +1,85 @@
+'''
+    Output encoders, selectable per operation with the 'encoder' config key.
+
+    jpeg:       baseline JPEG, Pillow defaults. The default, output as before.
+    jpeg_opt:   optimized Huffman tables + progressive scan. Same pixels, a few % smaller,
+                a bit slower to encode.
+    webp:       lossy WebP.
+    avif:       lossy AVIF, Pillow >= 11.2 or the pillow-avif-plugin package.
+    jxl:        lossy JPEG XL, the pillow-jxl-plugin package.
+
+    Every encoder takes the same 1-100 quality, so the size searches of down_size work
+    on any of them. Chroma subsampling ('subsampling' config key: 4:4:4, 4:2:2, 4:2:0)
+    applies to jpeg, jpeg_opt and avif, None keeps the codec default.
+'''
+import io
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, List, Tuple, Union
+
+# Pillow is imported on first use, the CLI reads the encoder names without it
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
+# name -> (Pillow format, output suffix, plugin module to import or None, extra save options)
+ENCODERS = {
+    'jpeg': ('JPEG', '.jpg', None, {}),
+    'jpeg_opt': ('JPEG', '.jpg', None, {'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', '.webp', None, {'method': 4}),
+    'avif': ('AVIF', '.avif', 'pillow_avif', {'speed': 6}),
+    'jxl': ('JXL', '.jxl', 'pillow_jxl', {}),
+}
+
+DEFAULT_ENCODER = 'jpeg'
+
+SUBSAMPLINGS = ['4:4:4', '4:2:2', '4:2:0']
+
+# Formats that take the subsampling option
+_SUBSAMPLED_FORMATS = ['JPEG', 'AVIF']
+
+# Encode(image, quality, exif or None) -> bytes
+Encode = Callable[['PILImage.Image', int, object], bytes]
+
+
+@lru_cache(maxsize=None)
+def available(name: str) -> bool:
+    ''' If Pillow can write this encoder here (codec compiled in, or plugin installed) '''
+    from PIL import Image as PILImage
+    pil_format, _, plugin, _ = ENCODERS[name]
+    if plugin is not None:
+        try:
+            __import__(plugin)
+        except ImportError:
+            pass
+    PILImage.init()
+    return pil_format in PILImage.SAVE
+
+
+def available_encoders() -> List[str]:
+    ''' Names of the encoders that work here '''
+    return [x for x in ENCODERS if available(x)]
+
+
+def encoder_for(name: Union[str, None] = None, subsampling: Union[str, None] = None) -> Tuple[Encode, str]:
+    ''' The encode function and the output suffix of an encoder, None picks the default one '''
+    name = name or DEFAULT_ENCODER
+    if name not in ENCODERS:
+        raise Exception(f'Unknown encoder {name}, choose from {list(ENCODERS)}')
+    if not available(name):
+        raise Exception(f'Encoder {name} is not available here, available: {available_encoders()}')
+    if subsampling is not None and subsampling not in SUBSAMPLINGS:
+        raise Exception(f'Unknown subsampling {subsampling}, choose from {SUBSAMPLINGS}')
+
+    pil_format, suffix, _, extra = ENCODERS[name]
+    options = dict(extra)
+    if subsampling is not None and pil_format in _SUBSAMPLED_FORMATS:
+        options['subsampling'] = subsampling
+
+    def encode(im: 'PILImage.Image', quality: int, exif=None) -> bytes:
+        buffer = io.BytesIO()
+        if exif is not None:
+            im.save(buffer, pil_format, quality=quality, exif=exif, **options)
+        else:
+            im.save(buffer, pil_format, quality=quality, **options)
+        return buffer.getvalue()
+
+    return (encode, suffix)
@@ -0,0 +1,248 @@
+'''
+    Execution backends for image tasks.
+
+    processes: worker processes, best for big images (CPU bound, GIL-free).
+    threads:   a thread pool in this process, no spawn and no pickling.
+               Pillow releases the GIL while decoding, resampling and encoding.
+    hybrid:    N processes, each one running its share of tasks in a thread pool.
+    auto:      choose from the average size of a sample of the files.
+
+    processes and hybrid run under a supervisor (supervisor.py): per-task timeouts,
+    worker recycling, bounded retries and a failure report.
+
+    Start methods of the worker processes (start_method):
+        default:    the platform one (fork on Linux, spawn on macOS and Windows).
+        fork:       a copy of this process, nothing to import, not safe with threads.
+        spawn:      a fresh interpreter per worker, each one imports Pillow and the helpers.
+        forkserver: a server process imports PRELOAD_MODULES once, workers are forked
+                    from it warm. Spawn-safe, without paying the imports per worker.
+
+    Workers are initialized once with the jobs: (method name, config, src parent, dst parent).
+    The helper is resolved and the config compiled inside the worker, tasks are then sent
+    as batches of (job index, relative path string), which keeps pickling and IPC small.
+    The supervisor's workers run each batch (hybrid: on their thread pool) and report
+    every task, see supervisor._worker_main().
+'''
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Callable, Union
+
+EXECUTORS = ['auto', 'threads', 'processes', 'hybrid']
+
+# Files below this average size (bytes) are "small", spawn and IPC overhead dominates.
+SMALL_FILE_BYTES = 512 * 1024
+
+# How many files are looked at (stat) to decide the executor.
+SAMPLE_COUNT = 64
+
+# Threads per process, Pillow work is mostly GIL-free.
+THREADS_PER_WORKER = 4
+
+# Aim for this many batches per worker, so the load stays balanced at the end of a run.
+BATCHES_PER_WORKER = 4
+MAX_BATCH_SIZE = 256
+
+START_METHODS = ['default', 'fork', 'spawn', 'forkserver']
+
+# Imported once by the fork server, workers forked from it start with them loaded
+PRELOAD_MODULES = [
+    'PIL.Image',
+    'PIL.JpegImagePlugin',
+    'PIL.PngImagePlugin',
+    'PIL.GifImagePlugin',
+    'PIL.WebPImagePlugin',
+    'PIL.TiffImagePlugin',
+    'image_thumbnail.utils',
+]
+
+# (method_name, config, src_parent, dst_parent)
+Job = Tuple[str, dict, str, str]
+
+# Per process state, set by _init_worker()
+_worker_jobs: List[Tuple[Callable, dict, Path, Path]] = []
+
+
+def compile_config(config: dict) -> dict:
+    ''' Prepare a config once per worker: EXIF tag names are resolved to tag numbers up front '''
+    from .utils import _find_tag_number_by_name
+    for name in config.get('tags', []):
+        _find_tag_number_by_name(name)
+    return config
+
+
+def mp_context(start_method: Union[str, None] = None):
+    ''' The multiprocessing context of a start method, None or 'default' for the platform one '''
+    import multiprocessing
+    if start_method in (None, 'default'):
+        return multiprocessing.get_context()
+    if start_method not in START_METHODS:
+        raise Exception(f'Unknown start method {start_method}, choose from {START_METHODS}')
+    if start_method not in multiprocessing.get_all_start_methods():
+        raise Exception(f'Start method {start_method} is not available here, available: {multiprocessing.get_all_start_methods()}')
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        # Only read when the server starts, the first time
+        context.set_forkserver_preload(PRELOAD_MODULES)
+    return context
+
+
+def _resolve_jobs(jobs: List[Job]) -> List[Tuple[Callable, dict, Path, Path]]:
+    ''' Resolve the helpers and compile the configs of the jobs '''
+    from .utils import ImageHelper
+    return [
+        (ImageHelper.select_helper(method_name), compile_config(config), Path(src_parent), Path(dst_parent))
+        for method_name, config, src_parent, dst_parent in jobs
+    ]
+
+
+def _init_worker(jobs: List[Job]):
+    ''' Pool initializer: resolve helpers and compile configs once per process '''
+    global _worker_jobs
+    _worker_jobs = _resolve_jobs(jobs)
+
+
+def _run_one(job_idx: int, rel_path: str, resolved: Union[List[Tuple[Callable, dict, Path, Path]], None] = None):
+    ''' Run the job's helper on one file, given by its path relative to the src parent. Return the output path.
+        resolved: jobs of _resolve_jobs(), else the ones of this worker process
+    '''
+    h, config, src_parent, dst_parent = (resolved if resolved is not None else _worker_jobs)[job_idx]
+    new_path = dst_parent.joinpath(rel_path)
+    return h(src_parent.joinpath(rel_path), new_path.stem, new_path.parent, config)
+
+
+def batch_size(n_of_tasks: int, n_of_workers: int) -> int:
+    ''' Adaptive batch size: a few batches per worker, big batches only for big runs '''
+    size = n_of_tasks // (max(n_of_workers, 1) * BATCHES_PER_WORKER)
+    return min(max(size, 1), MAX_BATCH_SIZE)
+
+
+def make_batches(tasks: List[List[str]], size: int) -> List[Tuple[int, List[str]]]:
+    ''' Cut each job's relative paths into batches of (job index, paths).
+
+        The jobs take turns (one batch each, round robin): every job makes progress, and
+        the end of the run is a mix of jobs, not the last job alone on a few cores.
+    '''
+    per_job = [
+        [(job_idx, rel_paths[start:start + size]) for start in range(0, len(rel_paths), size)]
+        for job_idx, rel_paths in enumerate(tasks)
+    ]
+    batches = []
+    for turn in range(max([len(x) for x in per_job], default=0)):
+        batches.extend([x[turn] for x in per_job if turn < len(x)])
+    return batches
+
+
+def sample_average_size(files: List[Path], sample_count: int = SAMPLE_COUNT) -> float:
+    ''' Average file size (bytes) of an evenly spaced sample of the files '''
+    if len(files) == 0:
+        return 0
+    step = max(len(files) // sample_count, 1)
+    sizes = []
+    for x in files[::step][:sample_count]:
+        try:
+            sizes.append(os.stat(x).st_size)
+        except OSError:
+            pass
+    if len(sizes) == 0:
+        return 0
+    return sum(sizes) / len(sizes)
+
+
+def choose_executor(files: List[Path], n_of_cores: int, n_of_tasks: int = None) -> str:
+    ''' Pick an executor: small files go to threads (hybrid on multi-core), big files to processes.
+
+        files can be a sample, then n_of_tasks is the real number of tasks.
+    '''
+    if n_of_tasks is None:
+        n_of_tasks = len(files)
+    average = sample_average_size(files)
+    if average >= SMALL_FILE_BYTES:
+        return 'processes'
+    if n_of_cores > 1 and (os.cpu_count() or 1) > 1 and n_of_tasks > n_of_cores * THREADS_PER_WORKER:
+        return 'hybrid'
+    return 'threads'
+
+
+def run_tasks(jobs: List[Job], tasks: List[List[str]], executor: str, n_of_cores: int, n_of_threads: int = THREADS_PER_WORKER, timeout: float = None, max_tasks_per_worker: int = None, retries: int = None, report_path: Union[str, None] = None, start_method: Union[str, None] = None, outputs: Union[dict, None] = None) -> Tuple[str, List[dict]]:
+    ''' Run every task of every job, a failing task does not stop the others.
+
+    Args:
+        jobs (list): (method_name, config, src_parent, dst_parent) of each job.
+        tasks (list): for each job, the file paths (str) relative to its src_parent.
+        executor (str): one of EXECUTORS.
+        n_of_cores (int): processes to use.
+        n_of_threads (int): threads per process (threads, hybrid).
+        timeout (float): seconds without progress before a worker is killed (processes, hybrid), 0 = never.
+        max_tasks_per_worker (int): tasks before a worker process is replaced (processes, hybrid).
+        retries (int): retries of a task whose worker hung or crashed.
+        report_path (str): append failures there, as JSON lines.
+        start_method (str): one of START_METHODS, how worker processes start (processes, hybrid).
+        outputs (dict): if given, filled with (job index, relative path) -> the path written (str).
+
+    Returns:
+        tuple: the executor that was used, the failures (dicts: path, op, job index, kind, attempts, message).
+    '''
+    from .supervisor import (
+        SupervisedPool,
+        FAILURE_ERROR,
+        TASK_RETRIES,
+        TASK_TIMEOUT_SECONDS,
+        MAX_TASKS_PER_WORKER
+    )
+
+    if executor not in EXECUTORS:
+        raise Exception(f'Unknown executor {executor}, choose from {EXECUTORS}')
+
+    all_tasks = [(idx, x) for idx, rel_paths in enumerate(tasks) for x in rel_paths]
+    if executor == 'auto':
+        step = max(len(all_tasks) // SAMPLE_COUNT, 1)
+        files = [Path(jobs[idx][2]).joinpath(x) for idx, x in all_tasks[::step]]
+        executor = choose_executor(files, n_of_cores, len(all_tasks))
+    print(f'executor: {executor}')
+
+    if len(all_tasks) == 0:
+        return executor, []
+
+    if executor == 'threads':
+        # No timeouts here, a thread can't be killed. Exceptions are still isolated.
+        # The jobs are passed to each call: the worker globals of this process are left alone
+        resolved = _resolve_jobs(jobs)
+        failures = []
+
+        def run(task):
+            try:
+                output = _run_one(*task, resolved)
+                if outputs is not None and output is not None:
+                    outputs[task] = str(output)
+            except Exception as e:
+                method_name, _, src_parent, _ = jobs[task[0]]
+                failures.append({'path': f'{src_parent}/{task[1]}', 'op': method_name, 'job': task[0], 'kind': FAILURE_ERROR, 'attempts': 1, 'message': f'{type(e).__name__}: {e}'})
+
+        with ThreadPoolExecutor(n_of_cores * n_of_threads) as pool:
+            list(pool.map(run, all_tasks))
+        if report_path and failures:
+            import json
+            with open(report_path, 'a') as f:
+                for x in failures:
+                    f.write(json.dumps(x) + '\n')
+        return executor, failures
+
+    threads_per_process = n_of_threads if executor == 'hybrid' else 1
+    batches = make_batches(tasks, batch_size(len(all_tasks), n_of_cores) * threads_per_process)
+    pool = SupervisedPool(
+        jobs,
+        min(n_of_cores, len(batches)),
+        threads_per_process,
+        TASK_TIMEOUT_SECONDS if timeout is None else timeout,
+        MAX_TASKS_PER_WORKER if max_tasks_per_worker is None else max_tasks_per_worker,
+        TASK_RETRIES if retries is None else retries,
+        report_path,
+        mp_context(start_method)
+    )
+    for _ in pool.run([[(job_idx, x) for x in rel_paths] for job_idx, rel_paths in batches]):
+        pass
+    if outputs is not None:
+        outputs.update(pool.outputs)
+
+    return executor, pool.failures
@@ -0,0 +1,140 @@
+'''
+    Screenshots, line art, charts: keep them as PNG instead of turning them into JPEG.
+
+    classify() looks at a small nearest-neighbour sample (no new colors from resampling).
+    Graphics have a low entropy of the difference between horizontal neighbours (what the
+    PNG Sub filter leaves to zlib), and few colors or a handful of colors covering most of
+    the image. Photos have sensor noise and texture: high entropy, thousands of colors.
+
+    encode_png() tries, till one fits the byte budget:
+        1. lossless palette, if the image has <= 256 colors (built from its colors, with
+           their alpha: quantizers merge colors)
+        2. palette quantization to 256, 128, 64 colors, no dithering (flat areas stay flat)
+    then gives up (None) so the caller shrinks the dimensions with png_encoder().
+    Truecolor PNG is never tried, for graphics it is bigger than a JPEG and slow to deflate.
+    Each candidate is deflated at zlib level 6, and at level 9 only if it is just over.
+'''
+import io
+from typing import Union
+
+from PIL import (
+    Image as PILImage,
+    ImageChops
+)
+
+# Side of the sample the classifier looks at
+SAMPLE_SIDE = 256
+
+# Graphics: neighbour difference entropy (bits) at most this...
+MAX_GRAPHICS_ENTROPY = 2.5
+# ...and at most this many colors, or the top DOMINANT_COLORS colors cover DOMINANT_SHARE
+MAX_GRAPHICS_COLORS = 256
+DOMINANT_COLORS = 32
+DOMINANT_SHARE = 0.5
+
+# Palette sizes tried after the lossless encode
+PALETTE_LADDER = [256, 128, 64]
+
+# zlib levels: level 9 is ~4x slower for ~10% less, only worth it just over the budget
+FAST_LEVEL = 6
+BEST_LEVEL = 9
+BEST_LEVEL_MARGIN = 0.12
+
+# Sources that are already lossy are left to JPEG
+LOSSY_FORMATS = ['JPEG', 'MPO']
+
+
+def _sample(im: PILImage.Image) -> PILImage.Image:
+    ''' RGB(A) nearest-neighbour sample, longer side SAMPLE_SIDE '''
+    mode = 'RGBA' if has_alpha(im) else 'RGB'
+    sample = im.convert(mode) if im.mode != mode else im
+    if max(sample.size) > SAMPLE_SIDE:
+        ratio = SAMPLE_SIDE / max(sample.size)
+        size = (max(int(sample.width * ratio), 1), max(int(sample.height * ratio), 1))
+        sample = sample.resize(size, PILImage.Resampling.NEAREST)
+    return sample
+
+
+def has_alpha(im: PILImage.Image) -> bool:
+    return im.mode in ('RGBA', 'LA', 'PA') or (im.mode == 'P' and 'transparency' in im.info)
+
+
+def classify(im: PILImage.Image) -> str:
+    ''' 'graphics' or 'photo' '''
+    sample = _sample(im)
+    n_of_pixels = sample.width * sample.height
+
+    rgb = sample.convert('RGB')
+    residual = ImageChops.difference(rgb, ImageChops.offset(rgb, 1, 0)).convert('L')
+    if residual.entropy() > MAX_GRAPHICS_ENTROPY:
+        return 'photo'
+
+    colors = sample.getcolors(maxcolors=n_of_pixels)
+    if len(colors) <= MAX_GRAPHICS_COLORS:
+        return 'graphics'
+    counts = sorted([count for count, _ in colors], reverse=True)
+    if sum(counts[:DOMINANT_COLORS]) / n_of_pixels >= DOMINANT_SHARE:
+        return 'graphics'
+    return 'photo'
+
+
+def _quantize(im: PILImage.Image, colors: int) -> PILImage.Image:
+    # RGBA only quantizes with the octree
+    method = PILImage.Quantize.FASTOCTREE if im.mode == 'RGBA' else PILImage.Quantize.MEDIANCUT
+    return im.quantize(colors, method=method, dither=PILImage.Dither.NONE)
+
+
+def _exact_palette(im: PILImage.Image) -> PILImage.Image:
+    ''' Palette image of im (RGB or RGBA, <= 256 colors) with exactly its colors, alpha kept per entry '''
+    try:
+        import numpy as np
+    except ImportError:
+        return _quantize(im, 256)
+    pixels = np.asarray(im, dtype=np.uint32)
+    packed = np.zeros(pixels.shape[:2], dtype=np.uint32)
+    for channel in range(pixels.shape[2]):
+        packed = (packed << 8) | pixels[:, :, channel]
+    colors, indices = np.unique(packed, return_inverse=True)
+    paletted = PILImage.fromarray(indices.reshape(packed.shape).astype(np.uint8), 'P')
+
+    shifts = [8 * x for x in reversed(range(pixels.shape[2]))]
+    entries = [[(int(color) >> shift) & 0xFF for shift in shifts] for color in colors]
+    paletted.putpalette([channel for entry in entries for channel in entry[:3]])
+    if im.mode == 'RGBA':
+        paletted.info['transparency'] = bytes([entry[3] for entry in entries])
+    return paletted
+
+
+def _save_png(im: PILImage.Image, exif=None, compress_level: int = 6) -> bytes:
+    buffer = io.BytesIO()
+    if exif is not None:
+        im.save(buffer, 'PNG', compress_level=compress_level, exif=exif)
+    else:
+        im.save(buffer, 'PNG', compress_level=compress_level)
+    return buffer.getvalue()
+
+
+def _fit_png(im: PILImage.Image, max_bytes: float, exif=None) -> Union[bytes, None]:
+    ''' PNG at the fast zlib level, at the best one if that is just over max_bytes. None if over '''
+    data = _save_png(im, exif, FAST_LEVEL)
+    if max_bytes < len(data) <= max_bytes * (1 + BEST_LEVEL_MARGIN):
+        data = _save_png(im, exif, BEST_LEVEL)
+    return data if len(data) <= max_bytes else None
+
+
+def png_encoder(im: PILImage.Image, colors: int, exif=None) -> bytes:
+    ''' PNG with a palette of colors, an Encode function where the quality is the palette size '''
+    return _save_png(_quantize(im, colors), exif, FAST_LEVEL)
+
+
+def encode_png(im: PILImage.Image, max_bytes: float, exif=None) -> Union[bytes, None]:
+    ''' Least lossy palette PNG of im (RGB or RGBA) under max_bytes, None if none fits at this size '''
+    n_of_colors = len(im.getcolors(maxcolors=MAX_GRAPHICS_COLORS) or [])
+    for colors in ([n_of_colors] if n_of_colors else []) + PALETTE_LADDER:
+        if n_of_colors and colors > n_of_colors:
+            continue
+        paletted = _exact_palette(im) if colors == n_of_colors else _quantize(im, colors)
+        data = _fit_png(paletted, max_bytes, exif)
+        if data is not None:
+            return data
+    return None
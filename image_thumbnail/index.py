@@ -0,0 +1,297 @@
+'''
+    Header-only metadata index of image trees, stored in SQLite.
+
+    Every image gets one row: path, size, mtime, format, dimensions, mode, orientation and
+    key EXIF fields. Headers are read with a lazy Image.open (pixels are never decoded),
+    in parallel, and only for files that are new or changed since the last run.
+
+    Other commands query the index instead of opening files again, a row is trusted only
+    while the file's size and mtime still match.
+
+    Perceptual hashes (see dedupe.py) live in a second table, filled on demand since
+    they need a (small) decode.
+'''
+import os
+import sqlite3
+from pathlib import Path
+from multiprocessing import Pool
+from typing import List, Tuple, Union
+
+from PIL import Image as PILImage
+
+from .dedupe import hash_file
+from .utils import (
+    is_img,
+    is_hidden_file,
+    max_process_count
+)
+
+DEFAULT_INDEX_PATH = Path.home().joinpath('.cache', 'image_thumbnail', 'index.sqlite')
+
+COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('size', 'INTEGER'),
+    ('mtime_ns', 'INTEGER'),
+    ('format', 'TEXT'),
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('mode', 'TEXT'),
+    ('orientation', 'INTEGER'),
+    ('datetime_original', 'TEXT'),
+    ('make', 'TEXT'),
+    ('model', 'TEXT'),
+    ('iso', 'INTEGER'),
+    ('exposure_time', 'REAL'),
+    ('f_number', 'REAL'),
+    ('focal_length', 'REAL'),
+    ('error', 'TEXT'),
+]
+
+# EXIF tag numbers, IFD0
+_TAG_ORIENTATION = 0x0112
+_TAG_MAKE = 0x010F
+_TAG_MODEL = 0x0110
+_TAG_DATETIME = 0x0132
+# EXIF sub-IFD
+_IFD_EXIF = 0x8769
+_TAG_DATETIME_ORIGINAL = 0x9003
+_TAG_EXPOSURE_TIME = 0x829A
+_TAG_F_NUMBER = 0x829D
+_TAG_ISO = 0x8827
+_TAG_FOCAL_LENGTH = 0x920A
+
+HASH_COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('size', 'INTEGER'),
+    ('mtime_ns', 'INTEGER'),
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('dhash', 'TEXT'), # 16 hex digits, 64 bits don't fit a signed SQLite INTEGER
+    ('phash', 'TEXT'),
+    ('error', 'TEXT'),
+]
+
+# Files probed per task sent to a worker
+PROBE_CHUNK_SIZE = 64
+HASH_CHUNK_SIZE = 16
+
+
+def _number(value) -> Union[float, None]:
+    try:
+        if isinstance(value, tuple):
+            value = value[0]
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def _text(value) -> Union[str, None]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return str(value).strip('\x00 ').strip() or None
+
+
+def probe_header(path: str) -> dict:
+    ''' Read everything the index needs from the image header, no pixel is decoded '''
+    st = os.stat(path)
+    row = {x[0]: None for x in COLUMNS}
+    row.update({'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+    try:
+        with PILImage.open(path) as im:
+            row['format'] = im.format
+            row['width'], row['height'] = im.size
+            row['mode'] = im.mode
+            exif = im.getexif()
+            row['orientation'] = exif.get(_TAG_ORIENTATION, 1)
+            row['make'] = _text(exif.get(_TAG_MAKE))
+            row['model'] = _text(exif.get(_TAG_MODEL))
+            sub = exif.get_ifd(_IFD_EXIF)
+            row['datetime_original'] = _text(sub.get(_TAG_DATETIME_ORIGINAL, exif.get(_TAG_DATETIME)))
+            iso = _number(sub.get(_TAG_ISO))
+            row['iso'] = int(iso) if iso is not None else None
+            row['exposure_time'] = _number(sub.get(_TAG_EXPOSURE_TIME))
+            row['f_number'] = _number(sub.get(_TAG_F_NUMBER))
+            row['focal_length'] = _number(sub.get(_TAG_FOCAL_LENGTH))
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+
+def _probe_chunk(paths: List[str]) -> List[dict]:
+    ''' Pool worker '''
+    rows = []
+    for x in paths:
+        try:
+            rows.append(probe_header(x))
+        except OSError:
+            pass # vanished while indexing
+    return rows
+
+
+def _hash_chunk(paths: List[str]) -> List[dict]:
+    ''' Pool worker '''
+    rows = []
+    for x in paths:
+        try:
+            rows.append(hash_file(x))
+        except OSError:
+            pass # vanished while hashing
+    return rows
+
+
+def _walk_images(root: Path) -> List[Tuple[str, int, int]]:
+    ''' (path, size, mtime_ns) of every image under root '''
+    found = []
+    for current, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(current, name)
+            if is_hidden_file(path) or not is_img(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append((path, st.st_size, st.st_mtime_ns))
+    return found
+
+
+def oriented_size(row: dict) -> Tuple[int, int]:
+    ''' (width, height) as displayed, EXIF orientation applied '''
+    if row['orientation'] in (5, 6, 7, 8):
+        return (row['height'], row['width'])
+    return (row['width'], row['height'])
+
+
+class ImageIndex:
+    ''' The SQLite index, used from one process (workers only probe headers) '''
+    def __init__(self, db_path: Union[str, Path] = DEFAULT_INDEX_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        columns = ', '.join([f'{name} {kind}' for name, kind in COLUMNS])
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS images ({columns})')
+        columns = ', '.join([f'{name} {kind}' for name, kind in HASH_COLUMNS])
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS hashes ({columns})')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, rows: List[dict]):
+        names = [x[0] for x in COLUMNS]
+        self.conn.executemany(
+            f'INSERT OR REPLACE INTO images ({", ".join(names)}) VALUES ({", ".join(["?"] * len(names))})',
+            [[row[x] for x in names] for row in rows]
+        )
+        self.conn.commit()
+
+    def lookup(self, path: Union[str, Path], check_stat: bool = True) -> Union[dict, None]:
+        ''' The row of a file, None if not indexed (or changed since, when check_stat) '''
+        path = str(Path(path).resolve())
+        row = self.conn.execute('SELECT * FROM images WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        if check_stat:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if (st.st_size, st.st_mtime_ns) != (row['size'], row['mtime_ns']):
+                return None
+        return row
+
+    def rows_under(self, root: Union[str, Path], table: str = 'images') -> List[dict]:
+        ''' Every row of files under a folder '''
+        prefix = str(Path(root).resolve()).rstrip(os.sep) + os.sep
+        # A range on the primary key: every path starting with prefix, without a table scan
+        upper = prefix[:-1] + chr(ord(os.sep) + 1)
+        rows = self.conn.execute(f'SELECT * FROM {table} WHERE path >= ? AND path < ?', (prefix, upper))
+        return [dict(x) for x in rows]
+
+    def hashes_under(self, root: Union[str, Path]) -> List[dict]:
+        ''' Hashed images under a folder, dhash and phash as ints '''
+        rows = []
+        for x in self.rows_under(root, 'hashes'):
+            if x['error'] is not None:
+                continue
+            x['dhash'], x['phash'] = int(x['dhash'], 16), int(x['phash'], 16)
+            rows.append(x)
+        return rows
+
+    def update_hashes(self, root: Union[str, Path], workers: int = 0):
+        ''' Hash new or changed images under root (small decodes, in parallel), forget removed ones.
+
+        Yields:
+            str: progress messages.
+        '''
+        root = Path(root).resolve()
+        known = {x['path']: (x['size'], x['mtime_ns']) for x in self.rows_under(root, 'hashes')}
+        found = _walk_images(root)
+        stale = [path for path, size, mtime_ns in found if known.get(path) != (size, mtime_ns)]
+        seen = set([x[0] for x in found])
+
+        removed = [x for x in known if x not in seen]
+        if removed:
+            self.conn.executemany('DELETE FROM hashes WHERE path = ?', [(x,) for x in removed])
+            self.conn.commit()
+
+        names = [x[0] for x in HASH_COLUMNS]
+        done = 0
+        if stale:
+            chunks = [stale[i:i + HASH_CHUNK_SIZE] for i in range(0, len(stale), HASH_CHUNK_SIZE)]
+            with Pool(min(workers or max_process_count(), len(chunks))) as pool:
+                for rows in pool.imap_unordered(_hash_chunk, chunks):
+                    self.conn.executemany(
+                        f'INSERT OR REPLACE INTO hashes ({", ".join(names)}) VALUES ({", ".join(["?"] * len(names))})',
+                        [[row[x] for x in names] for row in rows]
+                    )
+                    self.conn.commit()
+                    done += len(rows)
+                    yield f'Hashed: {done}/{len(stale)}'
+
+        yield f'Hashes {self.db_path}: {len(seen)} images, {done} updated, {len(seen) - len(stale)} unchanged, {len(removed)} removed'
+
+    def update(self, root: Union[str, Path], workers: int = 0):
+        ''' Index new or changed images under root, forget removed ones.
+
+        Yields:
+            str: progress messages.
+        '''
+        root = Path(root).resolve()
+        known = {x['path']: (x['size'], x['mtime_ns']) for x in self.rows_under(root)}
+
+        stale = []
+        seen = set()
+        for current, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(current, name)
+                if is_hidden_file(path) or not is_img(path):
+                    continue
+                seen.add(path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if known.get(path) != (st.st_size, st.st_mtime_ns):
+                    stale.append(path)
+
+        removed = [x for x in known if x not in seen]
+        if removed:
+            self.conn.executemany('DELETE FROM images WHERE path = ?', [(x,) for x in removed])
+            self.conn.commit()
+
+        done = 0
+        if stale:
+            chunks = [stale[i:i + PROBE_CHUNK_SIZE] for i in range(0, len(stale), PROBE_CHUNK_SIZE)]
+            with Pool(min(workers or max_process_count(), len(chunks))) as pool:
+                for rows in pool.imap_unordered(_probe_chunk, chunks):
+                    self.upsert(rows)
+                    done += len(rows)
+                    yield f'Indexed: {done}/{len(stale)}'
+
+        yield f'Index {self.db_path}: {len(seen)} images, {done} updated, {len(seen) - len(stale)} unchanged, {len(removed)} removed'
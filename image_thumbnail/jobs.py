@@ -0,0 +1,122 @@
+'''
+    Job files: many operations over many folders, in one run with one worker pool.
+
+    A job file (JSON, or TOML on Python >= 3.11) lists the jobs, each one an op of
+    ImageHelper.registry with the config it takes, a src folder and a dst folder:
+
+        {"jobs": [
+            {"name": "web", "op": "down_scale", "src": "photos", "dst": "out/web",
+             "config": {"max_dimension": 1600, "quality": 85}},
+            {"name": "mail", "op": "down_size", "src": "photos", "dst": "out/mail",
+             "config": {"max_size_mb": 0.5, "quality": 85}}
+        ]}
+
+    Relative paths are from the folder of the job file, a missing dst is created.
+    Every job is checked before anything runs. Then each src is walked (folders created,
+    non-images copied), and the images of all jobs go to run_tasks() as a single run:
+    the pool starts once, and the batches of the jobs take turns, so the cores stay busy
+    across job boundaries instead of draining at the end of each job.
+'''
+import json
+import time
+from pathlib import Path
+from typing import List, Union
+
+from .constants import IMAGE_SUFFIX
+
+JOB_KEYS = ['name', 'op', 'src', 'dst', 'config']
+
+
+def _read(path: Path) -> dict:
+    if path.suffix.lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise Exception('TOML job files need Python >= 3.11, use JSON')
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_jobs(path: Union[str, Path]) -> List[dict]:
+    '''
+    Read and check a job file.
+
+    Returns:
+        list: dicts of name, op, src (Path), dst (Path), config.
+
+    Raises:
+        Exception: if a job has an unknown op or key, a bad config, or a src that is not a folder.
+    '''
+    from .utils import ImageHelper
+    from .executor import compile_config
+    from .encoders import encoder_for
+
+    path = Path(path).resolve()
+    data = _read(path)
+    if not isinstance(data.get('jobs'), list) or not data['jobs']:
+        raise Exception(f'{path}: no "jobs" list')
+
+    jobs = []
+    for idx, x in enumerate(data['jobs']):
+        unknown = sorted(set(x) - set(JOB_KEYS))
+        if unknown:
+            raise Exception(f'{path}: job {idx}: unknown keys {unknown}, use {JOB_KEYS}')
+        for key in ('op', 'src', 'dst'):
+            if key not in x:
+                raise Exception(f'{path}: job {idx}: "{key}" is missing')
+        name = str(x.get('name', idx))
+        ImageHelper.select_helper(x['op'])
+        config = x.get('config', {})
+        if not isinstance(config, dict):
+            raise Exception(f'{path}: job {name}: "config" is not a table')
+        compile_config(config)
+        if config.get('encoder') or config.get('subsampling'):
+            encoder_for(config.get('encoder'), config.get('subsampling'))
+
+        src = path.parent.joinpath(x['src']).resolve()
+        dst = path.parent.joinpath(x['dst']).resolve()
+        if not src.is_dir():
+            raise Exception(f'{path}: job {name}: src {src} is not a folder')
+        jobs.append({'name': name, 'op': x['op'], 'src': src, 'dst': dst, 'config': config})
+    return jobs
+
+
+def run_jobs(jobs: List[dict], executor: str = 'auto', **run_options):
+    '''
+    Run the jobs of load_jobs() through one pool, yield progress messages.
+
+    Args:
+        executor: 'auto', 'threads', 'processes' or 'hybrid', see executor.py
+        run_options: timeout, max_tasks_per_worker, retries, report_path, see run_tasks()
+    '''
+    from .utils import _mirror_tree, max_process_count
+    from .executor import run_tasks
+
+    n_of_cores = max_process_count()
+    print(f'multi-workers: {n_of_cores}')
+    start = time.perf_counter()
+
+    tasks = []
+    for job in jobs:
+        job['dst'].mkdir(parents=True, exist_ok=True)
+        rel_paths = []
+        yield from _mirror_tree(job['src'], job['dst'], IMAGE_SUFFIX, job['op'], rel_paths, [])
+        tasks.append(rel_paths)
+        yield f'Job {job["name"]}: {job["op"]} {len(rel_paths)} images'
+
+    _, failures = run_tasks(
+        [(x['op'], x['config'], str(x['src'].parent), str(x['dst'])) for x in jobs],
+        tasks,
+        executor,
+        n_of_cores,
+        **run_options
+    )
+    for x in failures:
+        yield f'Failed ({x["kind"]}, {x["attempts"]} attempts): {x["path"]}: {x["message"]}'
+
+    for idx, job in enumerate(jobs):
+        failed = len([x for x in failures if x['job'] == idx])
+        yield f'Done {job["name"]}: {len(tasks[idx]) - failed} of {len(tasks[idx])} images' + (f', {failed} failed' if failed else '')
+    yield f'Done: {sum([len(x) for x in tasks])} images of {len(jobs)} jobs in {time.perf_counter() - start:.1f}s'
@@ -0,0 +1,85 @@
+'''
+    Image quality metrics: PSNR and SSIM of an image against a reference of the same size.
+
+    PSNR only needs Pillow. SSIM needs numpy (imported when used), it is computed on the
+    luma plane with 7x7 uniform windows, like skimage.metrics.structural_similarity.
+    For speed, perceptual searches compare luma planes box-reduced to about SSIM_SIDE.
+'''
+import math
+
+from PIL import (
+    Image as PILImage,
+    ImageChops
+)
+
+SSIM_WINDOW = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# Longer side of the luma planes compared by perceptual searches
+SSIM_SIDE = 512
+
+
+def psnr(im: PILImage.Image, reference: PILImage.Image) -> float:
+    ''' Peak signal to noise ratio in dB (RGB, 8 bits), inf if identical '''
+    if im.size != reference.size:
+        raise Exception(f'Size mismatch {im.size} vs {reference.size}')
+    diff = ImageChops.difference(im.convert('RGB'), reference.convert('RGB'))
+    histogram = diff.histogram()
+    squares = sum([count * ((idx % 256) ** 2) for idx, count in enumerate(histogram)])
+    mse = squares / (im.width * im.height * 3)
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def _window_means(x, size: int):
+    ''' Mean of every size x size window (valid positions only), with an integral image '''
+    import numpy as np
+    integral = np.pad(x, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return sums / (size * size)
+
+
+def luma_plane(im: PILImage.Image, side: int = 0):
+    ''' Luma as a float numpy array, box-reduced by an integer factor to about side (0: full size).
+        The shorter side is kept at least SSIM_WINDOW (eg. a 3000x20 strip).
+    '''
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception('SSIM needs numpy: pip install numpy')
+    luma = im.convert('L')
+    factor = min(max(luma.size) // side, min(luma.size) // SSIM_WINDOW) if side > 0 else 1
+    if factor > 1:
+        luma = luma.reduce(factor)
+    return np.asarray(luma, dtype=np.float64)
+
+
+def ssim_planes(x, y, window: int = SSIM_WINDOW) -> float:
+    ''' Mean structural similarity of two luma planes (numpy arrays of the same shape) '''
+    if x.shape != y.shape:
+        raise Exception(f'Shape mismatch {x.shape} vs {y.shape}')
+    if min(x.shape) < window:
+        raise Exception(f'Image smaller than the SSIM window {window}')
+
+    # Sample covariance, as skimage does
+    n = window * window
+    cov_norm = n / (n - 1)
+    mx, my = _window_means(x, window), _window_means(y, window)
+    vx = cov_norm * (_window_means(x * x, window) - mx * mx)
+    vy = cov_norm * (_window_means(y * y, window) - my * my)
+    vxy = cov_norm * (_window_means(x * y, window) - mx * my)
+
+    c1 = (SSIM_K1 * 255) ** 2
+    c2 = (SSIM_K2 * 255) ** 2
+    s = ((2 * mx * my + c1) * (2 * vxy + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    # Only windows fully inside the image, like skimage (which crops the border ones)
+    return float(s.mean())
+
+
+def ssim(im: PILImage.Image, reference: PILImage.Image, window: int = SSIM_WINDOW) -> float:
+    ''' Mean structural similarity of the luma planes, 1.0 if identical '''
+    if im.size != reference.size:
+        raise Exception(f'Size mismatch {im.size} vs {reference.size}')
+    return ssim_planes(luma_plane(im), luma_plane(reference), window)
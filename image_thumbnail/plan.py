@@ -0,0 +1,165 @@
+'''
+    Dry-run planner: estimate output size, copy vs transcode share and wall-clock time of a run.
+
+    The files are grouped into strata (format x size bucket). A stratified sample is processed
+    for real, in memory, by the same operation cores as a real run. Each stratum's measured
+    output ratio, copy share and seconds per file are then applied to the whole stratum,
+    using only what the directory walk stats for the rest. When the header index has an
+    up to date row of a file, its pixel count splits the strata further (the cost of a
+    file follows its pixels more than its bytes).
+'''
+import os
+import math
+import time
+import random
+from pathlib import Path
+from multiprocessing import Pool
+from typing import Dict, List, Tuple, Union
+
+from .utils import (
+    BytesHelper,
+    max_process_count
+)
+
+# Sample size: 1% of the images, at least PLAN_MIN_SAMPLE, at most PLAN_MAX_SAMPLE.
+PLAN_MIN_SAMPLE = 50
+PLAN_MAX_SAMPLE = 500
+PLAN_SAMPLE_RATIO = 0.01
+
+
+def _stratum(path: str, size: int, pixels: Union[int, None] = None) -> Tuple[str, int, int]:
+    ''' (suffix, power of 2 size bucket, power of 4 pixel bucket or -1 if unknown) '''
+    pixel_bucket = int(math.log(max(pixels, 1), 4)) if pixels else -1
+    return (Path(path).suffix.lower(), int(math.log2(max(size, 1))), pixel_bucket)
+
+
+def _measure(args: Tuple[str, str, dict]) -> Tuple[str, int, int, bool, float]:
+    ''' Pool worker: run the operation in memory, (path, in bytes, out bytes, copied, seconds) '''
+    path, method_name, config = args
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        result = BytesHelper.select_helper(method_name)(data, config)
+    except Exception:
+        # A failing file produces nothing in a real run
+        return (path, len(data), 0, False, time.perf_counter() - start)
+    seconds = time.perf_counter() - start
+    if result is None:
+        return (path, len(data), len(data), True, seconds)
+    return (path, len(data), len(result[0]), False, seconds)
+
+
+def _human_bytes(n: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1024 or unit == 'TB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def _human_seconds(n: float) -> str:
+    if n < 120:
+        return f'{n:.0f}s'
+    if n < 7200:
+        return f'{n / 60:.0f}min'
+    return f'{n / 3600:.1f}h'
+
+
+def _walk(src: Path, transform: List[str]) -> Tuple[List[str], List[str], Dict[str, os.stat_result]]:
+    ''' Images and other files under src, with the stat of each one (taken while walking) '''
+    images, others, stats = [], [], {}
+    folders = [str(src)]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                    continue
+                try:
+                    stats[entry.path] = entry.stat()
+                except OSError:
+                    continue
+                (images if Path(entry.name).suffix.lower() in transform else others).append(entry.path)
+    return (images, others, stats)
+
+
+def _index_pixels(src: Path, stats: Dict[str, os.stat_result]) -> Dict[str, int]:
+    ''' Pixel count of the files under src the header index knows, rows not matching the stat are skipped '''
+    from .index import ImageIndex, DEFAULT_INDEX_PATH
+    if not DEFAULT_INDEX_PATH.exists():
+        return {}
+    image_index = ImageIndex(DEFAULT_INDEX_PATH)
+    try:
+        rows = image_index.rows_under(src)
+    finally:
+        image_index.close()
+
+    pixels = {}
+    for row in rows:
+        st = stats.get(row['path'])
+        if st is None or (st.st_size, st.st_mtime_ns) != (row['size'], row['mtime_ns']):
+            continue
+        if row['width'] and row['height']:
+            pixels[row['path']] = row['width'] * row['height']
+    return pixels
+
+
+def plan(src: Path, transform: List[str], method_name: str, config: dict, workers: int = 0, seed: int = 0):
+    '''
+    Estimate a scan_multi run of method_name over src, without writing anything.
+
+    Yields:
+        str: report lines.
+    '''
+    BytesHelper.select_helper(method_name)
+    workers = workers or max_process_count()
+    start = time.perf_counter()
+
+    # Paths are resolved, as the index keeps them
+    images, others, stats = _walk(Path(src).resolve(), transform)
+    sizes = {x: st.st_size for x, st in stats.items()}
+    other_bytes = sum([sizes[x] for x in others])
+    pixels = _index_pixels(Path(src).resolve(), stats)
+
+    strata: Dict[Tuple[str, int, int], List[str]] = {}
+    for x in images:
+        strata.setdefault(_stratum(x, sizes[x], pixels.get(x)), []).append(x)
+
+    # Proportional allocation, at least one file per stratum
+    n_of_sample = min(len(images), max(PLAN_MIN_SAMPLE, min(PLAN_MAX_SAMPLE, int(len(images) * PLAN_SAMPLE_RATIO))))
+    rng = random.Random(seed)
+    sample = []
+    for key, members in strata.items():
+        k = max(1, round(n_of_sample * len(members) / max(len(images), 1)))
+        sample.extend(rng.sample(members, min(k, len(members))))
+
+    yield f'Plan {method_name}: {len(images)} images ({_human_bytes(sum([sizes[x] for x in images]))}), {len(others)} other files ({_human_bytes(other_bytes)})'
+    if pixels:
+        yield f'Index: dimensions of {len(pixels)} images'
+    yield f'Sampling {len(sample)} images from {len(strata)} strata with {workers} workers...'
+
+    measured: Dict[str, Tuple[int, int, bool, float]] = {}
+    if sample:
+        with Pool(min(workers, len(sample))) as pool:
+            for path, in_bytes, out_bytes, copied, seconds in pool.imap_unordered(_measure, [(x, method_name, config) for x in sample]):
+                measured[path] = (in_bytes, out_bytes, copied, seconds)
+
+    total_out = float(other_bytes)
+    total_copied = 0.0
+    total_seconds = 0.0
+    for key, members in strata.items():
+        results = [measured[x] for x in members if x in measured]
+        if not results:
+            continue
+        in_bytes = sum([x[0] for x in results]) or 1
+        stratum_bytes = sum([sizes[x] for x in members])
+        total_out += stratum_bytes * sum([x[1] for x in results]) / in_bytes
+        total_copied += len(members) * sum([1 for x in results if x[2]]) / len(results)
+        total_seconds += len(members) * sum([x[3] for x in results]) / len(results)
+
+    total_in = sum([sizes[x] for x in images]) + other_bytes
+    copied_share = total_copied / len(images) if images else 0
+    yield f'Estimated output: {_human_bytes(total_out)} ({total_out / max(total_in, 1) * 100:.0f}% of input)'
+    yield f'Estimated copied as is: {copied_share * 100:.0f}% of images, transcoded: {(1 - copied_share) * 100:.0f}%'
+    yield f'Estimated time: {_human_seconds(total_seconds / workers)} with {workers} workers ({_human_seconds(total_seconds)} of work)'
+    yield f'Planned in {_human_seconds(time.perf_counter() - start)}'
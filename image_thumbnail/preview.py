@@ -0,0 +1,150 @@
+'''
+    Fast path for small renditions: use a JPEG already embedded in the file.
+
+    RAW files (and many PSD, HEIC, TIFF) carry full-size or preview JPEGs, JPEGs carry
+    an EXIF thumbnail. The file is scanned for JPEG streams (SOI marker, then segments up
+    to the EOI), the smallest one that still covers max_dimension is decoded instead of the
+    sensor or composite data. A JPEG is decoded with draft(), ie. the DCT is scaled down
+    by 1/2, 1/4 or 1/8 while decoding, as far as max_dimension allows.
+'''
+import io
+import mmap
+from pathlib import Path
+from typing import BinaryIO, List, Tuple, Union
+
+import PIL
+from PIL import Image as PILImage
+
+# Preview = (start, end, width, height), a JPEG stream in the file bytes
+Preview = Tuple[int, int, int, int]
+
+# Smaller streams are icons, not previews.
+MIN_PREVIEW_SIDE = 64
+
+# Stop looking after this many JPEG streams.
+MAX_PREVIEWS = 32
+
+_SOI = b'\xff\xd8\xff'
+_SOF_MARKERS = set([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+_TAG_ORIENTATION = 0x0112
+
+
+def _jpeg_stream(buf, start: int) -> Union[Preview, None]:
+    ''' Walk the JPEG segments from the SOI at start, (start, end, width, height) or None '''
+    size = len(buf)
+    pos = start + 2
+    width = height = None
+    while pos + 2 <= size:
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1 # fill byte
+            continue
+        if marker == 0xD9:
+            return (start, pos + 2, width, height) if width else None
+        if 0xD0 <= marker <= 0xD8 or marker == 0x01:
+            pos += 2
+            continue
+        if pos + 4 > size:
+            return None
+        length = int.from_bytes(buf[pos + 2:pos + 4], 'big')
+        if length < 2:
+            return None
+        if marker in _SOF_MARKERS and pos + 9 <= size:
+            height = int.from_bytes(buf[pos + 5:pos + 7], 'big')
+            width = int.from_bytes(buf[pos + 7:pos + 9], 'big')
+        pos += 2 + length
+        if marker == 0xDA:
+            if width is None:
+                return None
+            # Entropy coded data: skip to the next marker (FF00 is data, RSTn are inside)
+            while True:
+                pos = buf.find(b'\xff', pos)
+                if pos < 0 or pos + 1 >= size:
+                    return None
+                follower = buf[pos + 1]
+                if follower == 0x00 or 0xD0 <= follower <= 0xD7:
+                    pos += 2
+                elif follower == 0xFF:
+                    pos += 1
+                else:
+                    break
+    return None
+
+
+def find_previews(buf) -> List[Preview]:
+    ''' Every JPEG stream of the file bytes (bytes or mmap), nested ones (EXIF thumbnail) too '''
+    previews = []
+    pos = buf.find(_SOI)
+    while pos >= 0 and len(previews) < MAX_PREVIEWS:
+        found = _jpeg_stream(buf, pos)
+        if found is not None and min(found[2], found[3]) >= MIN_PREVIEW_SIDE:
+            previews.append(found)
+        pos = buf.find(_SOI, pos + 2)
+    return previews
+
+
+def choose_preview(previews: List[Preview], max_dimension: int) -> Union[Preview, None]:
+    ''' The smallest preview that still covers max_dimension, None if none does '''
+    big_enough = [x for x in previews if max(x[2], x[3]) >= max_dimension]
+    if len(big_enough) == 0:
+        return None
+    return min(big_enough, key=lambda x: x[2] * x[3])
+
+
+def _container_orientation(buf) -> int:
+    ''' EXIF orientation of the file itself (TIFF based RAW, HEIC...), 1 if unknown '''
+    try:
+        with PILImage.open(io.BytesIO(bytes(buf[:1024 * 1024]))) as im:
+            return im.getexif().get(_TAG_ORIENTATION, 1)
+    except Exception:
+        return 1
+
+
+def preview_thumbnail(source: Union[Path, BinaryIO], max_dimension: int, fallback_largest: bool = False) -> Union[Tuple[PILImage.Image, PILImage.Exif], None]:
+    ''' Shrink the best embedded JPEG to fit max_dimension.
+
+    Args:
+        source: a path or a file object of the image.
+        max_dimension: the longer side of the output.
+        fallback_largest: if no preview covers max_dimension, use the largest one anyway.
+
+    Returns:
+        tuple: the image (L or RGB) and its EXIF, None if there is no usable preview.
+    '''
+    if isinstance(source, Path):
+        with open(source, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None # empty file
+    else:
+        source.seek(0)
+        buf = source.read()
+
+    try:
+        previews = find_previews(buf)
+        chosen = choose_preview(previews, max_dimension)
+        if chosen is None and fallback_largest and previews:
+            chosen = max(previews, key=lambda x: x[2] * x[3])
+        if chosen is None:
+            return None
+
+        start, end, _, _ = chosen
+        im = PILImage.open(io.BytesIO(bytes(buf[start:end])))
+        im.draft('RGB', (max_dimension, max_dimension))
+        exif = im.getexif()
+        # An embedded preview has no orientation of its own, the file has it
+        if start > 0 and _TAG_ORIENTATION not in exif:
+            orientation = _container_orientation(buf)
+            if orientation != 1:
+                exif[_TAG_ORIENTATION] = orientation
+
+        if im.mode not in ("L", "RGB"):
+            im = im.convert("RGB")
+        im.thumbnail((max_dimension, max_dimension), resample=PIL.Image.Resampling.LANCZOS)
+        return (im, exif)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
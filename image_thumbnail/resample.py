@@ -0,0 +1,46 @@
+'''
+    Resampling strategies, selectable per operation with the 'resample' config key.
+
+    lanczos:    LANCZOS straight from the full resolution. The reference, slowest for big
+                reductions (the filter support grows with the reduction factor).
+    two_stage:  integer box reduction (Image.reduce) down to about 2x the target, then
+                LANCZOS for the rest. Close to lanczos, much faster for big reductions.
+    fast:       box reduction down to about 1x the target, then LANCZOS. Fastest, a bit
+                softer / more aliasing on fine patterns.
+
+    Pillow does the reduction itself through the reducing_gap argument of resize() and
+    thumbnail(), so every strategy is one call.
+'''
+from typing import Tuple, Union
+
+from PIL import Image as PILImage
+
+# strategy -> reducing_gap (None: no box reduction)
+STRATEGIES = {
+    'lanczos': None,
+    'two_stage': 2.0,
+    'fast': 1.0,
+}
+
+DEFAULT_STRATEGY = 'two_stage'
+
+
+def reducing_gap(strategy: Union[str, None]) -> Union[float, None]:
+    ''' The reducing_gap of a strategy, None picks the default one '''
+    strategy = strategy or DEFAULT_STRATEGY
+    if strategy not in STRATEGIES:
+        raise Exception(f'Unknown resample strategy {strategy}, choose from {list(STRATEGIES)}')
+    return STRATEGIES[strategy]
+
+
+def resize(im: PILImage.Image, size: Tuple[int, int], strategy: Union[str, None] = None) -> PILImage.Image:
+    ''' Image.resize() to size with LANCZOS, the way the strategy says '''
+    return im.resize(size, PILImage.Resampling.LANCZOS, reducing_gap=reducing_gap(strategy))
+
+
+def thumbnail(im: PILImage.Image, size: Tuple[int, int], strategy: Union[str, None] = None):
+    ''' Image.thumbnail() in place with LANCZOS, the way the strategy says.
+
+        Pillow only uses JPEG draft (DCT scaling) when there is a reducing_gap.
+    '''
+    im.thumbnail(size, resample=PILImage.Resampling.LANCZOS, reducing_gap=reducing_gap(strategy))
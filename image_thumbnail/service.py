@@ -0,0 +1,365 @@
+'''
+    Long-lived thumbnail service.
+
+    A warm worker pool renders images on demand over a local HTTP (TCP or Unix socket) API:
+
+        GET /render?src=holiday/IMG_0001.jpg&op=down_scale&max_dimension=800&quality=85
+        GET /render?src=holiday/IMG_0001.jpg&rendition=small
+        GET /metrics
+
+    Renditions are kept in an on-disk cache keyed by (source digest, op, config), evicted
+    least-recently-used by total bytes. Concurrent identical requests share one render.
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import mimetypes
+import socketserver
+from pathlib import Path
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, Tuple, Union
+
+from .constants import (
+    Resolutions,
+    StorageSizes,
+    JpegImageQuality
+)
+
+# Operations that can be requested, they produce exactly one output file.
+SERVICE_OPS = ['down_scale', 'down_size', 'distort_images', 'remove_black_bar', 'crop']
+
+# Named renditions: name -> (op, config)
+RENDITIONS = {
+    'thumb': ('down_scale', {'max_dimension': 320, 'quality': JpegImageQuality.JPEG_LIGHT}),
+    'small': ('down_scale', {'max_dimension': Resolutions.JPEG_LIGHT, 'quality': JpegImageQuality.JPEG_OK}),
+    'medium': ('down_scale', {'max_dimension': Resolutions.JPEG_OK, 'quality': JpegImageQuality.JPEG_GOOD}),
+    'large': ('down_scale', {'max_dimension': Resolutions.JPEG_GOOD, 'quality': JpegImageQuality.JPEG_GOOD}),
+    'light': ('down_size', {'max_size_mb': StorageSizes.JPEG_LIGHT, 'quality': JpegImageQuality.JPEG_OK}),
+}
+
+# How many recent latencies are kept to compute percentiles.
+LATENCY_WINDOW = 2048
+
+# How many source digests are remembered (least recently used ones are dropped).
+DIGEST_ENTRIES = 65536
+
+
+def _warm_worker():
+    ''' Pool initializer: load Pillow and its format plugins once per worker '''
+    from PIL import Image as PILImage
+    from . import utils # noqa: F401
+    PILImage.init()
+
+
+def _render(src: str, method_name: str, config: dict, tmp_folder: str) -> str:
+    ''' Pool worker: run one operation into an empty folder, return the output file path '''
+    from .utils import ImageHelper
+    h = ImageHelper.select_helper(method_name)
+    h(Path(src), 'rendition', Path(tmp_folder), config)
+    outputs = os.listdir(tmp_folder)
+    if len(outputs) != 1:
+        raise Exception(f'{method_name} produced no output for {src}')
+    return os.path.join(tmp_folder, outputs[0])
+
+
+def parse_value(value: str):
+    ''' Query string value to int, float, bool or str '''
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class RenditionCache:
+    ''' On-disk cache of rendered files, LRU eviction by total bytes. Thread safe. '''
+    def __init__(self, folder: Path, max_bytes: int):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.tmp_folder = self.folder.joinpath('tmp')
+        shutil.rmtree(self.tmp_folder, ignore_errors=True)
+        self.tmp_folder.mkdir()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        # key -> (path, size), oldest first
+        self._entries: 'OrderedDict[str, Tuple[Path, int]]' = OrderedDict()
+
+        # Reload what previous runs left, least recently used first
+        files = [x for x in self.folder.iterdir() if x.is_file()]
+        files.sort(key=lambda x: x.stat().st_mtime)
+        for x in files:
+            size = x.stat().st_size
+            self._entries[x.stem] = (x, size)
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Union[Tuple[Path, bytes], None]:
+        ''' (path, content) of a cached rendition, None if not cached '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            try:
+                os.utime(entry[0])
+                # Opened under the lock: an eviction can unlink it, the open file stays readable
+                f = open(entry[0], 'rb')
+            except OSError:
+                return None
+        with f:
+            return (entry[0], f.read())
+
+    def put(self, key: str, file_path: str) -> Tuple[Path, bytes]:
+        ''' Move a rendered file into the cache, return its (path, content) '''
+        target = self.folder.joinpath(key + Path(file_path).suffix)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        os.replace(file_path, target)
+        size = target.stat().st_size
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.total_bytes -= old[1]
+            self._entries[key] = (target, size)
+            self.total_bytes += size
+            self._evict()
+        return (target, data)
+
+    def _evict(self):
+        # Keep at least the newest entry, even if it is bigger than the budget
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+
+class ThumbnailService:
+    ''' Render requests through a warm worker pool, with caching and request coalescing '''
+    def __init__(self, root: Path, cache_folder: Path, cache_bytes: int, workers: int):
+        self.root = Path(root).resolve()
+        self.cache = RenditionCache(cache_folder, cache_bytes)
+        self.pool = Pool(workers, initializer=_warm_worker)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        # (path, size, mtime_ns) -> sha256 of the content, the DIGEST_ENTRIES most recent
+        self._digests: 'OrderedDict[Tuple[str, int, int], str]' = OrderedDict()
+        self._digests_lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {'requests': 0, 'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def resolve_source(self, rel_path: str) -> Path:
+        ''' A source path under root, refuse anything outside '''
+        src = self.root.joinpath(rel_path).resolve()
+        if src != self.root and self.root not in src.parents:
+            raise PermissionError(f'{rel_path} is outside of the served folder')
+        if not src.is_file():
+            raise FileNotFoundError(f'{rel_path} not found')
+        return src
+
+    def source_digest(self, src: Path) -> str:
+        ''' Content digest of a source, remembered until the file changes '''
+        st = src.stat()
+        stamp = (str(src), st.st_size, st.st_mtime_ns)
+        with self._digests_lock:
+            digest = self._digests.get(stamp)
+            if digest is not None:
+                self._digests.move_to_end(stamp)
+                return digest
+        # Hashed outside the lock, two threads may hash the same file at worst
+        h = hashlib.sha256()
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._digests_lock:
+            self._digests[stamp] = digest
+            while len(self._digests) > DIGEST_ENTRIES:
+                self._digests.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def cache_key(digest: str, method_name: str, config: dict) -> str:
+        payload = json.dumps([digest, method_name, config], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def render(self, rel_path: str, method_name: str, config: dict) -> Tuple[Path, bytes]:
+        ''' Return the cached rendition (path, content), render it first if needed '''
+        start = time.perf_counter()
+        with self._lock:
+            self.counters['requests'] += 1
+        try:
+            if method_name not in SERVICE_OPS:
+                raise ValueError(f'Unknown op {method_name}, choose from {SERVICE_OPS}')
+            src = self.resolve_source(rel_path)
+            key = self.cache_key(self.source_digest(src), method_name, config)
+
+            cached = self.cache.get(key)
+            if cached is not None:
+                with self._lock:
+                    self.counters['hits'] += 1
+                return cached
+
+            with self._lock:
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    self.counters['misses'] += 1
+                    self._submit(key, src, method_name, config, future)
+                else:
+                    self.counters['coalesced'] += 1
+            return future.result()
+        except Exception:
+            with self._lock:
+                self.counters['errors'] += 1
+            raise
+        finally:
+            self._latencies.append(time.perf_counter() - start)
+
+    def _submit(self, key: str, src: Path, method_name: str, config: dict, future: Future):
+        tmp_folder = tempfile.mkdtemp(dir=self.cache.tmp_folder)
+
+        def done(file_path: str):
+            try:
+                future.set_result(self.cache.put(key, file_path))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+        def failed(e: BaseException):
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+
+        self.pool.apply_async(_render, (str(src), method_name, config, tmp_folder), callback=done, error_callback=failed)
+
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if len(latencies) == 0:
+                return 0
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+
+        with self._lock:
+            result = dict(self.counters)
+            result['inflight'] = len(self._inflight)
+        result['latency_ms'] = {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99), 'max': percentile(1)}
+        result['cache'] = self.cache.stats()
+        return result
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    ''' GET /render and GET /metrics '''
+    service: ThumbnailService = None
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj):
+        self._send(status, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self._send_json(200, self.service.metrics())
+            return
+        if url.path != '/render':
+            self._send_json(404, {'error': f'unknown path {url.path}'})
+            return
+
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        rel_path = query.pop('src', None)
+        if rel_path is None:
+            self._send_json(400, {'error': 'src is required'})
+            return
+
+        rendition = query.pop('rendition', None)
+        if rendition is not None:
+            if rendition not in RENDITIONS:
+                self._send_json(400, {'error': f'unknown rendition {rendition}, choose from {list(RENDITIONS)}'})
+                return
+            method_name, config = RENDITIONS[rendition]
+        else:
+            method_name = query.pop('op', 'down_scale')
+            config = {k: parse_value(v) for k, v in query.items()}
+            if 'tags' in config:
+                config['tags'] = [x.lower() for x in str(config['tags']).split(',') if x]
+
+        try:
+            output, body = self.service.render(rel_path, method_name, config)
+        except PermissionError as e:
+            self._send_json(403, {'error': str(e)})
+            return
+        except FileNotFoundError as e:
+            self._send_json(404, {'error': str(e)})
+            return
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+
+        content_type = mimetypes.guess_type(str(output))[0] or 'application/octet-stream'
+        self._send(200, body, content_type)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(root: Path, cache_folder: Path, cache_bytes: int, workers: int, host: str = '127.0.0.1', port: int = 8080, socket_path: str = None):
+    ''' Run the service until interrupted '''
+    service = ThumbnailService(root, cache_folder, cache_bytes, workers)
+    handler = type('BoundServiceHandler', (ServiceHandler,), {'service': service})
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+        print(f'serving {service.root} on unix:{socket_path}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'serving {service.root} on http://{host}:{port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,215 @@
+'''
+    Deterministic sharding: N machines process disjoint parts of the same SRC into the same
+    DST layout, without talking to each other.
+
+    Every node lists the same tree and computes the same assignment:
+        hash:   blake2b of the relative path, modulo N. No I/O, stable when files are added.
+        cost:   header probes (pixels, or bytes if there is no header), heaviest first, each
+                one to the least loaded shard (ties: lowest shard, then path order).
+                Better balanced, the assignment changes when the file set does.
+    Non-image files (copied, not processed) always go by hash.
+
+    Each node writes a manifest into DST/.image_thumbnail_shards/shard-<i>-of-<N>.json:
+    its files, outputs, failures and timings. merge_manifests() checks that every shard is
+    there, that no file was processed twice, that no image failed (unless allowed), that
+    outputs exist (and, given SRC, that every image was covered), and sums the stats.
+'''
+import os
+import json
+import time
+import heapq
+import socket
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+from PIL import Image as PILImage
+
+SHARD_STRATEGIES = ['hash', 'cost']
+
+MANIFEST_FOLDER = '.image_thumbnail_shards'
+
+# Header probes in flight, NFS latency bound
+PROBE_THREADS = 16
+
+# Cost of a file without a readable header, per byte (JPEG is ~0.1-0.3 bytes per pixel)
+PIXELS_PER_BYTE = 5
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    ''' 'i/N' -> (i, N), i counts from 0 '''
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise Exception(f'Shard {text} is not i/N, eg. 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise Exception(f'Shard {text}: i must be in 0..N-1')
+    return (index, count)
+
+
+def path_shard(rel_path: str, count: int) -> int:
+    ''' Shard of a relative path, the same on every node and every run '''
+    digest = hashlib.blake2b(Path(rel_path).as_posix().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def image_cost(path: Union[str, Path]) -> int:
+    ''' Decode work of an image: its pixels from the header, else a guess from its bytes '''
+    try:
+        with PILImage.open(path) as im:
+            return im.width * im.height
+    except Exception:
+        return os.stat(path).st_size * PIXELS_PER_BYTE
+
+
+def assign_by_cost(rel_paths: List[str], src_parent: Path, count: int) -> Dict[str, int]:
+    ''' rel path -> shard, longest processing time first (greedy) '''
+    with ThreadPoolExecutor(PROBE_THREADS) as pool:
+        costs = list(pool.map(lambda x: image_cost(src_parent.joinpath(x)), rel_paths))
+
+    loads = [(0, x) for x in range(count)]
+    assignment = {}
+    for cost, rel_path in sorted(zip(costs, rel_paths), key=lambda x: (-x[0], Path(x[1]).as_posix())):
+        load, shard = heapq.heappop(loads)
+        assignment[rel_path] = shard
+        heapq.heappush(loads, (load + cost, shard))
+    return assignment
+
+
+def select_shard(rel_paths: List[str], src_parent: Path, shard: Tuple[int, int], strategy: str = 'hash') -> List[str]:
+    ''' The images of one shard, in their original order '''
+    index, count = shard
+    if strategy not in SHARD_STRATEGIES:
+        raise Exception(f'Unknown shard strategy {strategy}, choose from {SHARD_STRATEGIES}')
+    if strategy == 'cost':
+        assignment = assign_by_cost(rel_paths, src_parent, count)
+        return [x for x in rel_paths if assignment[x] == index]
+    return [x for x in rel_paths if path_shard(x, count) == index]
+
+
+def manifest_path(dst_parent: Path, shard: Tuple[int, int]) -> Path:
+    return dst_parent.joinpath(MANIFEST_FOLDER, f'shard-{shard[0]}-of-{shard[1]}.json')
+
+
+def write_manifest(dst_parent: Path, shard: Tuple[int, int], strategy: str, method_name: str, files: List[dict], copies: List[str], failures: List[dict], seconds: float) -> Path:
+    '''
+    Write the manifest of a finished shard.
+
+    Args:
+        files: {'path': rel path, 'input_bytes', 'output': rel path or None, 'output_bytes'}
+            of every image of the shard.
+        copies: rel paths of the non-image files the shard copied.
+        failures: from run_tasks().
+    '''
+    path = manifest_path(dst_parent, shard)
+    path.parent.mkdir(exist_ok=True)
+    manifest = {
+        'shard': shard[0],
+        'n_of_shards': shard[1],
+        'strategy': strategy,
+        'method': method_name,
+        'host': socket.gethostname(),
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': round(seconds, 3),
+        'files': files,
+        'copies': copies,
+        'failures': failures,
+    }
+    # Write then rename, a reader never sees half a manifest
+    with open(str(path) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(str(path) + '.tmp', path)
+    return path
+
+
+def _expected_images(src: Path, transform: List[str]) -> List[str]:
+    ''' Rel paths (from the parent of src) of the images a scan of src processes '''
+    found = []
+    for current, dirs, files in os.walk(src):
+        for name in files:
+            if Path(name).suffix.lower() in transform:
+                found.append(Path(os.path.join(current, name)).relative_to(src.parent).as_posix())
+    return found
+
+
+def merge_manifests(dst_parent: Path, src: Union[Path, None] = None, transform: Union[List[str], None] = None, allow_failures: bool = False) -> Tuple[List[str], bool]:
+    '''
+    Check and combine the shard manifests of dst_parent, write merged.json next to them.
+
+    Args:
+        src: if given, also check that every image of this folder was assigned to a shard.
+        transform: the image suffixes of the scan, needed with src.
+        allow_failures: images that failed (listed in the manifests) are not problems.
+
+    Returns:
+        tuple: (report lines, True if no problem was found)
+    '''
+    folder = dst_parent.joinpath(MANIFEST_FOLDER)
+    manifests = []
+    for x in sorted(folder.glob('shard-*-of-*.json')) if folder.exists() else []:
+        with open(x) as f:
+            manifests.append(json.load(f))
+    if not manifests:
+        return ([f'No shard manifest in {folder}'], False)
+
+    problems = []
+    counts = set([x['n_of_shards'] for x in manifests])
+    strategies = set([x['strategy'] for x in manifests])
+    if len(counts) > 1:
+        problems.append(f'Manifests of different runs: N = {sorted(counts)}')
+    if len(strategies) > 1:
+        problems.append(f'Manifests of different strategies: {sorted(strategies)}')
+    count = max(counts)
+    missing = sorted(set(range(count)) - set([x['shard'] for x in manifests]))
+    if missing:
+        problems.append(f'Missing shards: {missing} of {count}')
+
+    owners = {}
+    for manifest in manifests:
+        failed = set([x['path'] for x in manifest['failures']])
+        if not allow_failures:
+            problems.extend([f'Failed: {x["path"]} (shard {manifest["shard"]}): {x["message"]}' for x in manifest['failures']])
+        for x in manifest['files']:
+            if x['path'] in owners:
+                problems.append(f'Processed twice: {x["path"]} (shards {owners[x["path"]]} and {manifest["shard"]})')
+            owners[x['path']] = manifest['shard']
+            if x['output'] is None:
+                if not any([y.endswith('/' + x['path']) for y in failed]):
+                    problems.append(f'No output: {x["path"]}')
+                continue
+            output = dst_parent.joinpath(x['output'])
+            if not output.exists():
+                problems.append(f'Output missing: {x["output"]}')
+            elif output.stat().st_size != x['output_bytes']:
+                problems.append(f'Output changed since the run: {x["output"]}')
+
+    if src is not None:
+        expected = set(_expected_images(src, transform or []))
+        uncovered = sorted(expected - set(owners))
+        problems.extend([f'Not in any shard: {x}' for x in uncovered])
+
+    lines = [f'{"shard":>5} {"host":<16} {"images":>7} {"failed":>6} {"copied":>6} {"seconds":>8} {"in MB":>9} {"out MB":>9} {"img/s":>7}']
+    total = {'images': 0, 'failed': 0, 'copied': 0, 'input_bytes': 0, 'output_bytes': 0}
+    for manifest in sorted(manifests, key=lambda x: x['shard']):
+        images = len(manifest['files'])
+        input_bytes = sum([x['input_bytes'] for x in manifest['files']])
+        output_bytes = sum([x['output_bytes'] or 0 for x in manifest['files']])
+        lines.append(f'{manifest["shard"]:>5} {manifest["host"][:16]:<16} {images:>7} {len(manifest["failures"]):>6} {len(manifest["copies"]):>6} {manifest["seconds"]:>8.1f} {input_bytes / 2**20:>9.1f} {output_bytes / 2**20:>9.1f} {images / max(manifest["seconds"], 1e-6):>7.1f}')
+        total['images'] += images
+        total['failed'] += len(manifest['failures'])
+        total['copied'] += len(manifest['copies'])
+        total['input_bytes'] += input_bytes
+        total['output_bytes'] += output_bytes
+
+    seconds = [x['seconds'] for x in manifests]
+    total['slowest_seconds'] = max(seconds)
+    total['imbalance'] = round(max(seconds) / max(sum(seconds) / len(seconds), 1e-6), 3)
+    lines.append(f'{"all":>5} {"":<16} {total["images"]:>7} {total["failed"]:>6} {total["copied"]:>6} {total["slowest_seconds"]:>8.1f} {total["input_bytes"] / 2**20:>9.1f} {total["output_bytes"] / 2**20:>9.1f}')
+    lines.append(f'slowest shard / mean: {total["imbalance"]}')
+    lines.extend(problems)
+    lines.append('OK' if not problems else f'{len(problems)} problems')
+
+    with open(folder.joinpath('merged.json'), 'w') as f:
+        json.dump({'n_of_shards': count, 'shards': len(manifests), 'total': total, 'problems': problems}, f, indent=1)
+    return (lines, not problems)
@@ -0,0 +1,282 @@
+'''
+    Supervised worker processes, so one bad file can't stall or kill a long run.
+
+    - Per-task timeout: a worker that makes no progress for `timeout` seconds is killed and replaced.
+    - Crash isolation: a worker that dies (eg. a decoder segfault) is replaced as well.
+    - Recycling: a worker exits after `max_tasks_per_worker` tasks and is replaced, this
+      bounds the RSS growth of long runs (allocator fragmentation).
+    - Bounded retries: tasks of a killed or crashed worker are retried one by one, up to
+      `retries` times. Exceptions raised by the operation are not retried.
+    - Failures are written as JSON lines into a report file.
+
+    Each worker has its own pipes: batches in, messages out. A message is sent (in the
+    pipe, no feeder thread) before the next task starts, so a worker that is killed or
+    dies only loses the task it was running, and can't break the channel of the others.
+    Every output path is claimed before it is written: the outputs of an unfinished task
+    are removed before it is retried, the retry starts clean.
+'''
+import json
+import time
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import deque
+from typing import Dict, List, Tuple, Union
+
+from .executor import (
+    Job,
+    _init_worker,
+    _run_one
+)
+
+# Defaults, see the module docstring
+TASK_TIMEOUT_SECONDS = 300
+MAX_TASKS_PER_WORKER = 1000
+TASK_RETRIES = 1
+
+# Failure kinds
+FAILURE_ERROR = 'error'
+FAILURE_TIMEOUT = 'timeout'
+FAILURE_CRASH = 'crash'
+
+# Task = (job index, relative path)
+Task = Tuple[int, str]
+
+
+def _worker_main(worker_id: int, jobs: List[Job], n_of_threads: int, inbox, outbox, max_tasks: int):
+    ''' Worker process: run batches from its inbox, report every claimed output and finished task '''
+    from concurrent.futures import ThreadPoolExecutor
+    from . import utils
+    _init_worker(jobs)
+    lock = threading.Lock()
+    running = threading.local()
+
+    def report(kind: str, task: Union[Task, None] = None, error: Union[str, None] = None, output: Union[str, None] = None):
+        # The message is in the pipe when this returns
+        with lock:
+            outbox.send((kind, worker_id, task, error, output))
+
+    def claim(path):
+        report('claim', running.task, None, str(path))
+
+    utils._claim_output = claim
+
+    def run(task: Task):
+        running.task = task
+        output = None
+        try:
+            output = _run_one(*task)
+            error = None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        report('done', task, error, str(output) if output is not None else None)
+
+    tasks_done = 0
+    thread_pool = ThreadPoolExecutor(n_of_threads) if n_of_threads > 1 else None
+    while tasks_done < max_tasks:
+        try:
+            batch = inbox.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+        if thread_pool:
+            list(thread_pool.map(run, batch))
+        else:
+            for task in batch:
+                run(task)
+        tasks_done += len(batch)
+    report('exit')
+
+
+class SupervisedPool:
+    ''' Run batches of tasks in worker processes, with timeouts, recycling and retries '''
+    def __init__(self, jobs: List[Job], n_of_workers: int, n_of_threads: int = 1, timeout: float = TASK_TIMEOUT_SECONDS, max_tasks_per_worker: int = MAX_TASKS_PER_WORKER, retries: int = TASK_RETRIES, report_path: Union[str, None] = None, context=None):
+        self.jobs = jobs
+        self.n_of_workers = n_of_workers
+        self.n_of_threads = n_of_threads
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.retries = retries
+        self.report_path = report_path
+        self.failures: List[dict] = []
+        # task -> path the operation wrote
+        self.outputs: Dict[Task, str] = {}
+
+        # multiprocessing context: the start method of the workers
+        self._context = context or multiprocessing.get_context()
+        self._next_id = 0
+        # worker id -> {'process', 'inbox', 'outbox', 'tasks': unfinished tasks of the batch, 'since': last progress,
+        #               'handed': tasks sent to it (it exits once max_tasks_per_worker are done),
+        #               'claims': task -> output paths it started to write, 'exited': its 'exit' was read,
+        #               'closed': its outbox is at the end}
+        self._workers: Dict[int, dict] = {}
+        self._attempts: Dict[Task, int] = {}
+        self._finished = 0
+
+    def _spawn(self):
+        worker_id = self._next_id
+        self._next_id += 1
+        inbox_reader, inbox = self._context.Pipe(duplex=False)
+        outbox, outbox_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(worker_id, self.jobs, self.n_of_threads, inbox_reader, outbox_writer, self.max_tasks_per_worker),
+            daemon=True
+        )
+        process.start()
+        # The worker's ends: once it is gone, its outbox reads as closed
+        inbox_reader.close()
+        outbox_writer.close()
+        self._workers[worker_id] = {
+            'process': process, 'inbox': inbox, 'outbox': outbox, 'tasks': None, 'since': 0, 'handed': 0,
+            'claims': {}, 'exited': False, 'closed': False
+        }
+
+    def _receive(self, worker_id: int) -> List[tuple]:
+        ''' Every message waiting in a worker's outbox '''
+        worker = self._workers[worker_id]
+        messages = []
+        try:
+            while not worker['closed'] and worker['outbox'].poll():
+                messages.append(worker['outbox'].recv())
+        except (EOFError, OSError):
+            # Gone, everything it sent is read (a message cut by a kill is dropped)
+            worker['closed'] = True
+        return messages
+
+    def _fail(self, task: Task, kind: str, message: str):
+        method_name, _, src_parent, _ = self.jobs[task[0]]
+        failure = {
+            'path': f'{src_parent}/{task[1]}',
+            'op': method_name,
+            'job': task[0],
+            'kind': kind,
+            'attempts': self._attempts.get(task, 0) + 1,
+            'message': message,
+        }
+        self.failures.append(failure)
+        if self.report_path:
+            with open(self.report_path, 'a') as f:
+                f.write(json.dumps(failure) + '\n')
+
+    def _close(self, worker_id: int) -> dict:
+        worker = self._workers.pop(worker_id)
+        if worker['process'].is_alive():
+            worker['process'].kill()
+        worker['process'].join()
+        worker['inbox'].close()
+        worker['outbox'].close()
+        return worker
+
+    def _lose_worker(self, worker_id: int, kind: str, pending: deque):
+        ''' A worker was killed or died: retry its unfinished tasks one by one, or give up on them '''
+        from .utils import silent_remove
+        worker = self._close(worker_id)
+        remaining = worker['tasks'] or []
+
+        for idx, task in enumerate(remaining):
+            # Whatever an unfinished task wrote can't be trusted, and would fail the retry
+            for path in worker['claims'].get(task, []):
+                silent_remove(path)
+            # Without threads, only the first unfinished task was running, the others are innocent
+            if self.n_of_threads == 1 and idx > 0:
+                pending.appendleft([task])
+                continue
+            attempts = self._attempts.get(task, 0)
+            if attempts >= self.retries:
+                exitcode = worker['process'].exitcode
+                message = f'no progress for {self.timeout}s' if kind == FAILURE_TIMEOUT else f'worker exit code {exitcode}'
+                self._fail(task, kind, message)
+            else:
+                self._attempts[task] = attempts + 1
+                pending.append([task])
+
+    def _recycle(self, worker_id: int, pending: deque):
+        ''' A worker exited on its own (all its messages read): tasks it never reported go back, without counting an attempt '''
+        worker = self._close(worker_id)
+        if worker['tasks']:
+            pending.appendleft(worker['tasks'])
+        if pending:
+            self._spawn()
+
+    def _handle(self, worker_id: int):
+        ''' Read a worker's messages, yield the number of tasks finished so far after each finished one '''
+        worker = self._workers[worker_id]
+        for kind, _, task, error, output in self._receive(worker_id):
+            if kind == 'claim':
+                worker['claims'].setdefault(task, []).append(output)
+            elif kind == 'done':
+                worker['since'] = time.monotonic()
+                worker['claims'].pop(task, None)
+                if worker['tasks'] and task in worker['tasks']:
+                    worker['tasks'].remove(task)
+                    if not worker['tasks']:
+                        worker['tasks'] = None
+                self._finished += 1
+                if error:
+                    self._fail(task, FAILURE_ERROR, error)
+                elif output is not None:
+                    self.outputs[task] = output
+                yield self._finished
+            elif kind == 'exit':
+                # Recycled after max_tasks_per_worker
+                worker['exited'] = True
+
+    def run(self, batches: List[List[Task]]):
+        ''' Run every batch, yield the number of tasks finished so far '''
+        pending = deque(batches)
+        self._finished = 0
+        for _ in range(min(self.n_of_workers, len(pending))):
+            self._spawn()
+
+        try:
+            while pending or any([x['tasks'] is not None for x in self._workers.values()]):
+                # Hand out batches to idle workers, not to one that is about to recycle
+                for worker_id, worker in list(self._workers.items()):
+                    if worker['tasks'] is None and worker['handed'] < self.max_tasks_per_worker and pending:
+                        batch = pending.popleft()
+                        try:
+                            worker['inbox'].send(batch)
+                        except OSError:
+                            # Already gone, found below
+                            pending.appendleft(batch)
+                            continue
+                        worker['tasks'] = list(batch)
+                        worker['since'] = time.monotonic()
+                        worker['handed'] += len(batch)
+
+                outboxes = {x['outbox']: worker_id for worker_id, x in self._workers.items()}
+                for outbox in wait(list(outboxes), timeout=0.5):
+                    yield from self._handle(outboxes[outbox])
+
+                # Replace the workers that are gone, kill hung ones. Whatever a worker sent
+                # before it went is read first: only tasks it never reported are retried
+                now = time.monotonic()
+                for worker_id, worker in list(self._workers.items()):
+                    if not worker['exited'] and not worker['closed']:
+                        if not worker['process'].is_alive():
+                            yield from self._handle(worker_id)
+                        elif worker['tasks'] is not None and self.timeout and now - worker['since'] > self.timeout:
+                            worker['process'].kill()
+                            worker['process'].join()
+                            yield from self._handle(worker_id)
+                            self._lose_worker(worker_id, FAILURE_TIMEOUT, pending)
+                            self._spawn()
+                            continue
+                    if worker['exited']:
+                        self._recycle(worker_id, pending)
+                    elif worker['closed'] or not worker['process'].is_alive():
+                        self._lose_worker(worker_id, FAILURE_CRASH, pending)
+                        self._spawn()
+        finally:
+            for worker in self._workers.values():
+                try:
+                    worker['inbox'].send(None)
+                except OSError:
+                    pass
+            for worker in self._workers.values():
+                worker['process'].join(timeout=5)
+                if worker['process'].is_alive():
+                    worker['process'].kill()
+            self._workers = {}
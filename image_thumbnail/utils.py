@@ -1,10 +1,13 @@
 import io
 import os
+import functools
+import time
 import shutil
 from pathlib import Path
 import multiprocessing
 from multiprocessing import Pool
-from typing import List, Callable, Union, Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Callable, Union, Tuple, BinaryIO
 
 import PIL
 from PIL import (
@@ -13,15 +16,35 @@ from PIL import (
     ExifTags
 )
 
-from exif import (
-    Image as EXIFImage
-)
+# exif is only imported by the ops that edit EXIF, see _exif_image()
+if TYPE_CHECKING:
+    from exif import Image as EXIFImage
 
 from .constants import (
     StorageSizes,
     JpegImageQuality,
-    IMAGE_SUFFIX
+    IMAGE_SUFFIX,
+    MIN_SEARCH_QUALITY
+)
+from .executor import run_tasks
+from .banded import (
+    BANDED_MIN_PIXELS,
+    banded_thumbnail,
+    open_unlimited,
+    tiff_exif
 )
+from .preview import preview_thumbnail
+from . import resample
+from .encoders import DEFAULT_ENCODER, ENCODERS, Encode, encoder_for
+from .animation import ANIMATED_FORMATS, fit_animation, is_animated, resize_animation
+from .dedupe import DEFAULT_DISTANCE, find_duplicates
+from .graphics import LOSSY_FORMATS, PALETTE_LADDER, classify, encode_png, has_alpha, png_encoder
+
+def _exif_image(data) -> 'EXIFImage':
+    ''' exif.Image of bytes or an open file, imports the exif package on first use '''
+    from exif import Image as EXIFImage
+    return EXIFImage(data)
+
 
 def is_hidden_file(file_path: Union[str, Path]):
     ''' If is hidden file '''
@@ -40,11 +63,16 @@ def is_img(file_path: str):
 # Load partial images without error
 PILImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# Told every output path before it is written, set in supervised workers (see supervisor.py)
+_claim_output: Union[Callable, None] = None
+
 def if_exists_then_raise(path: Union[str, Path]):
-    ''' If path exists then raise exception '''
+    ''' If path exists then raise exception, else claim it as an output '''
     path = Path(path)
     if path.exists():
         raise Exception(f'File exists: {path}')
+    if _claim_output is not None:
+        _claim_output(path)
 
 def silent_remove(path: Union[str, Path]):
     ''' Silently remove a file on the os '''
@@ -104,13 +132,14 @@ def open_img(pic_path:str):
     return im
 
 
-def resize_to_height(image: PILImage, required_height: int) -> PILImage:
+def resize_to_height(image: PILImage, required_height: int, strategy: Union[str, None] = None) -> PILImage:
     """
     Resize the given image to the specified height while maintaining the aspect ratio.
 
     Args:
         image (Image.Image): The input image object.
         required_height (int): The desired height of the resized image.
+        strategy (str): resample strategy, see resample.py.
 
     Returns:
         Image.Image: The resized image.
@@ -123,7 +152,7 @@ def resize_to_height(image: PILImage, required_height: int) -> PILImage:
     new_width = int(required_height * aspect_ratio)
 
     # Resize the image
-    resized_image = image.resize((new_width, required_height), PILImage.Resampling.LANCZOS)
+    resized_image = resample.resize(image, (new_width, required_height), strategy)
 
     return resized_image
 
@@ -161,8 +190,8 @@ def crop_center(image: PIL.Image, a: int, b: int) -> PIL.Image:
     return cropped_image
 
 
-def resize_to_fit(img: PILImage.Image, x:int, y:int):
-    ''' Resize the img to width x and height y
+def resize_to_fit(img: PILImage.Image, x:int, y:int, strategy: Union[str, None] = None):
+    ''' Resize the img to width x and height y, with a resample strategy (see resample.py)
         Return type Image
     '''
     # Open the original image
@@ -183,7 +212,7 @@ def resize_to_fit(img: PILImage.Image, x:int, y:int):
         new_height = int(x / aspect_ratio)
 
     # Resize the original image
-    resized_image = original_image.resize((new_width, new_height), PILImage.Resampling.LANCZOS)
+    resized_image = resample.resize(original_image, (new_width, new_height), strategy)
 
     # Create a new blank image with the target dimensions
     new_image = PILImage.new("RGB", (x, y), (255, 255, 255))  # White background
@@ -320,7 +349,7 @@ def concat_imgs_2(imgs: List[PILImage.Image], horizontal:bool, width_aspect_rati
     return concatenated_image
 
 
-def distort(image, width_aspect_ratio: int, height_aspect_ratio: int):
+def distort(image, width_aspect_ratio: int, height_aspect_ratio: int, strategy: Union[str, None] = None):
     ''' 
     Distort the aspect ratio of an image.
 
@@ -334,6 +363,7 @@ def distort(image, width_aspect_ratio: int, height_aspect_ratio: int):
         image (PIL.Image): The image to be distorted.
         width_aspect_ratio (int): The ratio to distort the width.
         height_aspect_ratio (int): The ratio to distort the height.
+        strategy (str): resample strategy, see resample.py.
 
     Returns:
         PIL.Image: The distorted image.
@@ -345,7 +375,7 @@ def distort(image, width_aspect_ratio: int, height_aspect_ratio: int):
     new_height = int((original_width / width_aspect_ratio) * height_aspect_ratio)
 
     # Resize the image to the new dimensions
-    distorted_image = image.resize((original_width, new_height), PILImage.Resampling.LANCZOS)
+    distorted_image = resample.resize(image, (original_width, new_height), strategy)
 
     return distorted_image
 
@@ -364,6 +394,7 @@ def just_copy_file(src: Path, dst: Path):
     shutil.copyfile(src, dst)
 
 
+@functools.lru_cache(maxsize=None)
 def _find_tag_number_by_name(name: str) -> Union[int, None]:
     '''Pillow internal: Find a EXIF tag number, given a string name reference
 
@@ -409,7 +440,7 @@ def _strip_exif_tags_2(src: Path, dst: Path, tags: List[str]):
     '''
     my_image = None
     with open(src, 'rb') as in_file:
-        my_image = EXIFImage(in_file)
+        my_image = _exif_image(in_file)
 
     if my_image.has_exif:
         for k in my_image.list_all():
@@ -428,204 +459,457 @@ def compute_relative_path(longer: Path, shorter: Path) -> Union[Path, None]:
     return shorter.relative_to(longer)
 
 
-def down_size(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
-    ''' Downsize an image, up till desired size, into JPEG format
+def _encode_jpeg(im: PILImage.Image, quality: int, exif=None) -> bytes:
+    ''' Encode an image into JPEG bytes, in memory '''
+    buffer = io.BytesIO()
+    if exif is not None:
+        im.save(buffer, "JPEG", quality=quality, exif=exif)
+    else:
+        im.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
 
-        Parameters
-        ----------
-        config: {'max_size_mb':float, 'quality':int, 'force_jpg':bool, 'tags':List[str]}
+
+# Result of an operation core:
+#   None                   -> output is the untouched original (copy)
+#   (bytes, None)          -> new content, keep the original suffix
+#   (bytes, '.jpg')        -> new content, with this suffix
+OpResult = Union[None, Tuple[bytes, Union[str, None]]]
+
+
+def _save_result(original_pic: Path, output_stem: str, output_folder: Path, result: OpResult) -> Path:
+    ''' Write the result of an operation core next to output_stem in output_folder, return its path '''
+    if result is None:
+        output_pic_path = output_folder.joinpath(Path(output_stem + original_pic.suffix))
+        if_exists_then_raise(output_pic_path)
+        just_copy_file(original_pic, output_pic_path)
+        return output_pic_path
+
+    data, suffix = result
+    output_pic_path = output_folder.joinpath(Path(output_stem + (suffix or original_pic.suffix)))
+    if_exists_then_raise(output_pic_path)
+    with open(output_pic_path, 'wb') as f:
+        f.write(data)
+    print("save:", output_pic_path)
+    return output_pic_path
+
+
+# down_size strategies: how the byte budget is met
+SIZE_STRATEGIES = ['dimension', 'quality', 'joint']
+
+# joint: image scales tried, encodes allowed, side of the image the loss is measured on
+JOINT_SCALES = [1.0, 0.85, 0.7, 0.6, 0.5, 0.4, 0.3, 0.25, 0.2, 0.15, 0.1]
+JOINT_MAX_ENCODES = 32
+JOINT_REFERENCE_SIDE = 1024
+
+# Perceptual target: SSIM of the JPEG against its source, 0 means off
+DEFAULT_TARGET_SSIM = 0
+
+
+def _shrink_dimension(im: PILImage.Image, my_exif, quality: int, max_bytes: float, strategy: Union[str, None], encode: Encode = _encode_jpeg) -> bytes:
+    ''' Shrink dimensions at a fixed quality, till the encoded image fits max_bytes '''
+    longer_side = max([im.width, im.height])
+
+    # To achieve fast tryouts, do 1/2 dimension for once first
+    semi_side = int(longer_side / 2)
+    im_copy = im.copy()
+    resample.thumbnail(im_copy, (semi_side, semi_side), strategy)
+
+    # If semi size is still too big
+    if len(encode(im_copy, quality, my_exif)) > max_bytes:
+        longer_side = semi_side
+        # print(f'{original_pic} Too big, start from half dimension {semi_side}')
+
+    factor = 0.9 # Shrink factor
+    counter = 1  # Round of process
+    while True:
+        im_copy = im.copy()
+        new_width = int(longer_side * (factor ** counter))
+        new_height = int(longer_side * (factor ** counter))
+        counter += 1
+
+        # Try to do the thumbnail
+        resample.thumbnail(im_copy, (new_width, new_height), strategy)
+
+        # Encode thumbnail in memory and check if size exceeds the limit
+        data = encode(im_copy, quality, my_exif)
+        if len(data) <= max_bytes:
+            return data
+
+
+def _search_quality(im: PILImage.Image, my_exif, max_bytes: float, low: int, high: int, n_of_threads: int = 1, encode: Encode = _encode_jpeg, pool: Union[Executor, None] = None) -> Tuple[Union[int, None], Union[bytes, None], int]:
+    ''' Highest quality in [low, high] that fits max_bytes, same dimensions.
+
+        Bisection, or n_of_threads candidates encoded at once per round (n-ary search),
+        on pool if given (else one is made for this search).
+
+        Returns:
+            tuple: (quality, encoded bytes, number of encodes), (None, None, n) if even low is too big.
     '''
-    # _disallow_multi_dot(original_pic)
+    best_quality, best_data = None, None
+    encodes = 0
+
+    def encode_at(q: int) -> Tuple[int, bytes]:
+        return (q, encode(im, q, my_exif))
+
+    # Most images fit at the wanted quality already
+    data = encode(im, high, my_exif)
+    encodes += 1
+    if len(data) <= max_bytes:
+        return (high, data, encodes)
+    high -= 1
+
+    own_pool = pool is None and n_of_threads > 1
+    if own_pool:
+        pool = ThreadPoolExecutor(n_of_threads)
+    try:
+        while low <= high:
+            n = max(n_of_threads, 1)
+            candidates = sorted(set([low + (high - low + 1) * (i + 1) // (n + 1) for i in range(n)]))
+            candidates = [min(max(x, low), high) for x in candidates]
+            results = list(pool.map(encode_at, candidates)) if pool and n_of_threads > 1 else [encode_at(x) for x in candidates]
+            encodes += len(results)
+
+            fitting = [(q, d) for q, d in results if len(d) <= max_bytes]
+            if fitting:
+                q, d = max(fitting, key=lambda x: x[0])
+                if best_quality is None or q > best_quality:
+                    best_quality, best_data = q, d
+                low = q + 1
+            too_big = [q for q, d in results if len(d) > max_bytes and q >= low]
+            if too_big:
+                high = min(too_big) - 1
+            elif not fitting:
+                high = min(candidates) - 1
+    finally:
+        if own_pool:
+            pool.shutdown()
+    return (best_quality, best_data, encodes)
+
+
+def _search_joint(im: PILImage.Image, my_exif, max_bytes: float, low: int, high: int, n_of_threads: int, strategy: Union[str, None], max_encodes: int = JOINT_MAX_ENCODES, encode: Encode = _encode_jpeg, pool: Union[Executor, None] = None) -> Union[bytes, None]:
+    ''' The (dimension, quality) pair under max_bytes with the least visual loss (PSNR against
+        the source, both at JOINT_REFERENCE_SIDE). Scales go down from 1, each one gets
+        the best quality that fits, till a scale fits at the wanted quality or max_encodes.
+        None if no scale fits. The quality searches of all scales share pool.
+    '''
+    from .metrics import psnr
+
+    reference = im.copy()
+    resample.thumbnail(reference, (JOINT_REFERENCE_SIDE, JOINT_REFERENCE_SIDE), strategy)
+
+    best_score, best_data = None, None
+    encodes = 0
+    longer_side = max(im.size)
+    for scale in JOINT_SCALES:
+        if encodes >= max_encodes:
+            break
+        candidate = im
+        if scale < 1:
+            side = max(int(longer_side * scale), 1)
+            candidate = im.copy()
+            resample.thumbnail(candidate, (side, side), strategy)
+
+        quality, data, n = _search_quality(candidate, my_exif, max_bytes, low, high, n_of_threads, encode, pool)
+        encodes += n
+        if data is None:
+            continue
+
+        decoded = PILImage.open(io.BytesIO(data))
+        score = psnr(decoded.resize(reference.size, PILImage.Resampling.LANCZOS), reference)
+        if best_score is None or score > best_score:
+            best_score, best_data = score, data
+        # Smaller scales only lose more detail from here
+        if quality == high:
+            break
+    return best_data
+
+
+def _search_ssim(im: PILImage.Image, my_exif, target: float, low: int, high: int, encode: Encode = _encode_jpeg) -> Tuple[int, bytes]:
+    ''' Lowest quality in [low, high] whose SSIM against im reaches target (high if none does).
+
+        SSIM is measured on luma planes reduced to about SSIM_SIDE, it goes up with the
+        quality, so a bisection needs about log2(high - low) encodes.
+
+        Returns:
+            tuple: (quality, encoded bytes)
+    '''
+    from .metrics import SSIM_SIDE, SSIM_WINDOW, luma_plane, ssim_planes
+
+    ceiling = high
+    # Too thin for an SSIM window: fixed quality
+    if min(im.size) < SSIM_WINDOW:
+        return (ceiling, encode(im, ceiling, my_exif))
+
+    reference = luma_plane(im, SSIM_SIDE)
+    best_quality, best_data = None, None
+    while low <= high:
+        q = (low + high) // 2
+        data = encode(im, q, my_exif)
+        score = ssim_planes(luma_plane(PILImage.open(io.BytesIO(data)), SSIM_SIDE), reference)
+        if score >= target:
+            best_quality, best_data = q, data
+            high = q - 1
+        else:
+            low = q + 1
+
+    if best_data is None:
+        best_quality, best_data = ceiling, encode(im, ceiling, my_exif)
+    return (best_quality, best_data)
+
 
+def _in_encoder_format(pil_format: str, encoder: str) -> bool:
+    ''' If a source of this Pillow format is already what the encoder writes (camera MPO files are JPEGs) '''
+    return ('JPEG' if pil_format == 'MPO' else pil_format) == ENCODERS[encoder][0]
+
+
+def _down_size_core(source: Union[Path, BinaryIO], source_size: int, config: dict) -> OpResult:
+    ''' Downsize an image from a path or a file object, see down_size() '''
     # Set up configurations, if not configured then use "middle" range options
     quality = config.get('quality', JpegImageQuality.JPEG_GOOD)
     max_size_mb = config.get('max_size_mb', StorageSizes.JPEG_GOOD)
     force_jpg = config.get('force_jpg', False)
     tags = config.get('tags', [])
-    
-    flag_file_is_jpg = original_pic.suffix.lower() == '.jpg' or original_pic.suffix.lower() == '.jpeg'
-    flag_file_size_exceeded = original_pic.stat().st_size > max_size_mb * 1024 * 1024
-
-    try:
-        im = PILImage.open(original_pic)
-        my_exif = im.getexif()
-        my_exif = _strip_exif_tags(my_exif, tags)
-
-        if im.mode not in ("L", "RGB"):
-            im = im.convert("RGB")
-
-        flag_should_transform = False
-
-        if flag_file_size_exceeded:
+    resample_strategy = config.get('resample', None)
+    size_strategy = config.get('strategy', 'dimension')
+    min_quality = min(config.get('min_quality', MIN_SEARCH_QUALITY), quality)
+    n_of_threads = config.get('threads', 1)
+    target_ssim = config.get('target_ssim', DEFAULT_TARGET_SSIM)
+    encoder = config.get('encoder', None) or DEFAULT_ENCODER
+    max_bytes = max_size_mb * 1024 * 1024
+
+    if size_strategy not in SIZE_STRATEGIES:
+        raise Exception(f'Unknown strategy {size_strategy}, choose from {SIZE_STRATEGIES}')
+    encode, suffix = encoder_for(encoder, config.get('subsampling', None))
+
+    im = PILImage.open(source)
+    flag_file_in_format = _in_encoder_format(im.format, encoder)
+    flag_file_size_exceeded = source_size > max_bytes
+
+    flag_should_transform = False
+    if flag_file_size_exceeded:
+        flag_should_transform = True
+    if not flag_file_in_format:
+        if force_jpg:
             flag_should_transform = True
-        if not flag_file_is_jpg:
-            if force_jpg:
-                flag_should_transform = True
-
-        
-        if not flag_should_transform:
-            # Output file final path
-            output_pic_file_name = Path(output_stem + original_pic.suffix)
-            output_pic_path = output_folder.joinpath(output_pic_file_name)
-            if_exists_then_raise(output_pic_path)
-            just_copy_file(original_pic, output_pic_path)
-        else:
-            # Output file final path
-            output_pic_file_name = Path(output_stem + '.jpg')
-            output_pic_path = output_folder.joinpath(output_pic_file_name)
 
-            longer_side = max([im.width, im.height])
-            
-            # To achieve fast tryouts, do 1/2 dimension for once first
-            semi_side = int(longer_side / 2)
-            im_copy = im.copy()
-            im_copy.thumbnail((semi_side, semi_side), resample=PIL.Image.Resampling.LANCZOS)
-            buffer = io.BytesIO()
-            im_copy.save(buffer, "JPEG", quality=quality, exif=my_exif)
-            
-            # If semi size is still too big
-            if len(buffer.getvalue()) > max_size_mb * 1024 * 1024:
-                longer_side = semi_side
-                # print(f'{original_pic} Too big, start from half dimension {semi_side}')
+    if not flag_should_transform:
+        return None
+
+    # Animated GIF / WebP stay animated, frames dropped before the dimensions shrink
+    if config.get('keep_animation', True) and is_animated(im):
+        output_format = 'WEBP' if encoder == 'webp' else im.format
+        return (fit_animation(im, max_bytes, output_format, quality, resample_strategy), ANIMATED_FORMATS[output_format])
+
+    my_exif = im.getexif()
+    my_exif = _strip_exif_tags(my_exif, tags)
+
+    # Screenshots, line art: a palette PNG is smaller and cleaner than a JPEG
+    # -f asks for the encoder's format every time
+    use_graphics = config.get('graphics', 'auto') == 'auto' and ENCODERS[encoder][0] == 'JPEG' and not force_jpg
+    if use_graphics and im.format not in LOSSY_FORMATS and classify(im) == 'graphics':
+        graphic = im.convert('RGBA' if has_alpha(im) else 'RGB')
+        data = encode_png(graphic, max_bytes, my_exif)
+        if data is None:
+            data = _shrink_dimension(graphic, my_exif, PALETTE_LADDER[0], max_bytes, resample_strategy, png_encoder)
+        return (data, '.png')
+
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
+
+    # Perceptual target: no need for more quality than the eye gets, at full resolution
+    if target_ssim > 0:
+        quality, data = _search_ssim(im, my_exif, target_ssim, min_quality, quality, encode)
+        if len(data) <= max_bytes:
+            return (data, suffix)
+
+    if size_strategy in ('quality', 'joint'):
+        # One pool for every quality search of this image
+        pool = ThreadPoolExecutor(n_of_threads) if n_of_threads > 1 else None
+        try:
+            # Keep the resolution, lower the quality
+            if size_strategy == 'quality':
+                _, data, _ = _search_quality(im, my_exif, max_bytes, min_quality, quality, n_of_threads, encode, pool)
+            # Best (dimension, quality) pair
             else:
-                pass
-
-            factor = 0.9 # Shrink factor
-            counter = 1  # Round of process
-            while True:
-                im_copy = im.copy()
-                new_width = int(longer_side * (factor ** counter))
-                new_height = int(longer_side * (factor ** counter))
-                counter += 1
-                
-                # Try to do the thumbnail
-                im_copy.thumbnail((new_width, new_height), resample=PIL.Image.Resampling.LANCZOS)
-
-                # Save thumbnail to memory and check if size exceeds the limit
-                # If not, save it to a disk
-                buffer = io.BytesIO()
-                im_copy.save(buffer, "JPEG", quality=quality)
-                if len(buffer.getvalue()) > max_size_mb * 1024 * 1024:
-                    continue
-                else:
-                    if_exists_then_raise(output_pic_path)
-                    im_copy.save(output_pic_path, "JPEG", quality=quality, exif=my_exif)
-                    print("save:", output_pic_path)
-                    break
+                data = _search_joint(im, my_exif, max_bytes, min_quality, quality, n_of_threads, resample_strategy, encode=encode, pool=pool)
+        finally:
+            if pool:
+                pool.shutdown()
+        if data is not None:
+            return (data, suffix)
+        # Too big even at min_quality: shrink at min_quality
+        return (_shrink_dimension(im, my_exif, min_quality, max_bytes, resample_strategy, encode), suffix)
 
-    except Exception as e:
-        print(e)
+    return (_shrink_dimension(im, my_exif, quality, max_bytes, resample_strategy, encode), suffix)
 
 
-def down_scale(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
-    '''
-        Downscale an image into JPEG format
+def down_size(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    ''' Downsize an image, up till desired size, into JPEG format (or the configured encoder)
 
         Parameters
         ----------
-        config: {'max_dimension':int, 'quality':int, 'tags':List[str]}
+        config: {'max_size_mb':float, 'quality':int, 'force_jpg':bool, 'tags':List[str], 'resample':str,
+                 'strategy':str, 'min_quality':int, 'threads':int, 'target_ssim':float, 'encoder':str, 'subsampling':str,
+                 'keep_animation':bool, 'graphics':str}
     '''
     # _disallow_multi_dot(original_pic)
-    # output file final path
-    output_pic_file_name = Path(output_stem+'.jpg')
-    output_pic_path = output_folder.joinpath(output_pic_file_name)
+    result = _down_size_core(original_pic, original_pic.stat().st_size, config)
+    return _save_result(original_pic, output_stem, output_folder, result)
 
+
+def _encode_output(im: PILImage.Image, my_exif, config: dict) -> Tuple[bytes, str]:
+    ''' Encode a result with the configured encoder: at the configured quality, or the lowest
+        quality that reaches target_ssim. Return (bytes, suffix)
+    '''
+    encode, suffix = encoder_for(config.get('encoder', None), config.get('subsampling', None))
+    quality = config.get('quality', JpegImageQuality.JPEG_GOOD) # 95% quality can save 1/2 space
+    target_ssim = config.get('target_ssim', DEFAULT_TARGET_SSIM)
+    if target_ssim > 0:
+        min_quality = min(config.get('min_quality', MIN_SEARCH_QUALITY), quality)
+        return (_search_ssim(im, my_exif, target_ssim, min_quality, quality, encode)[1], suffix)
+    return (encode(im, quality, my_exif), suffix)
+
+
+def _down_scale_core(source: Union[Path, BinaryIO], source_size: int, config: dict) -> OpResult:
+    ''' Downscale an image from a path or a file object, see down_scale() '''
     # Set up configurations, if not configured then use "middle" range options
     max_dimension = config.get('max_dimension', 0)
-    quality = config.get('quality', JpegImageQuality.JPEG_GOOD) # 95% quality can save 1/2 space
     tags = config.get('tags', [])
 
     skip_under_mb = config.get('skip_under_mb', 0)
-    
-    shall_skip_flag = False
-    if skip_under_mb == 0:
-        shall_skip_flag = True
-    else:
-        if original_pic.stat().st_size < skip_under_mb * 1024 * 1024:
-            shall_skip_flag = True
-    
-    if shall_skip_flag:
-        # remain the original file suffix if the file is to be copied.
-        output_pic_file_name = Path(output_stem + original_pic.suffix)
-        output_pic_path = output_folder.joinpath(output_pic_file_name)
-        just_copy_file(original_pic, output_pic_path)
-        return
+
+    # 0 means never skip, the original file is kept as it is
+    if skip_under_mb > 0 and source_size < skip_under_mb * 1024 * 1024:
+        return None
+
+    # Opt-in: an embedded JPEG (RAW preview, EXIF thumbnail...) instead of a full decode
+    use_preview = config.get('use_preview', False) and max_dimension > 0
+    if use_preview:
+        found = preview_thumbnail(source, max_dimension)
+        if found is not None:
+            return _encode_output(found[0], _strip_exif_tags(found[1], tags), config)
+        if not isinstance(source, Path):
+            source.seek(0)
 
     try:
-        im = PILImage.open(original_pic)
-        if im.mode not in ("L", "RGB"):
-            im = im.convert("RGB")
+        im = PILImage.open(source)
+    except PILImage.DecompressionBombError:
+        # Gigapixel scans (TIFF, PSD), handled below without a full decode when possible
+        if not isinstance(source, Path):
+            source.seek(0)
+        im = open_unlimited(source)
+    except PILImage.UnidentifiedImageError:
+        # No decoder (RAW, HEIC...): a smaller preview is better than nothing
+        found = preview_thumbnail(source, max_dimension, fallback_largest=True) if use_preview else None
+        if found is None:
+            raise
+        return _encode_output(found[0], _strip_exif_tags(found[1], tags), config)
+
+    # Animated GIF / WebP: frame by frame, into the same format (or WebP)
+    if config.get('keep_animation', True) and is_animated(im):
+        output_format = 'WEBP' if config.get('encoder', None) == 'webp' else im.format
+        quality = config.get('quality', JpegImageQuality.JPEG_GOOD)
+        return (resize_animation(im, max_dimension, output_format, quality, 1, config.get('resample', None)), ANIMATED_FORMATS[output_format])
+
+    # Huge TIFF: decode band by band, memory is bounded by a band
+    if im.format == 'TIFF' and im.width * im.height >= BANDED_MIN_PIXELS:
+        small = banded_thumbnail(im, max_dimension)
+        if small is not None:
+            my_exif = _strip_exif_tags(tiff_exif(im), tags)
+            return _encode_output(small, my_exif, config)
+
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
+
+    if max_dimension == 0:
+        max_dimension = max(im.size)
+
+    resample.thumbnail(im, (max_dimension, max_dimension), config.get('resample', None))
+    my_exif = tiff_exif(im) if im.format == 'TIFF' else im.getexif()
+    my_exif = _strip_exif_tags(my_exif, tags)
+
+    return _encode_output(im, my_exif, config)
 
-        if max_dimension == 0:
-            max_dimension = max(im.size)
 
-        im.thumbnail((max_dimension, max_dimension), resample=PIL.Image.Resampling.LANCZOS)
-        my_exif = im.getexif()
-        my_exif = _strip_exif_tags(my_exif, tags)
+def down_scale(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    '''
+        Downscale an image into JPEG format (or the configured encoder)
 
-        if_exists_then_raise(output_pic_path)
-        im.save(output_pic_path, "JPEG", quality=quality, exif=my_exif)
-        print("save:", output_pic_path)
-    except Exception as e:
-        print(e)
+        Parameters
+        ----------
+        config: {'max_dimension':int, 'quality':int, 'tags':List[str], 'skip_under_mb':float, 'use_preview':bool, 'resample':str,
+                 'target_ssim':float, 'min_quality':int, 'encoder':str, 'subsampling':str, 'keep_animation':bool}
+    '''
+    # _disallow_multi_dot(original_pic)
+    result = _down_scale_core(original_pic, original_pic.stat().st_size, config)
+    return _save_result(original_pic, output_stem, output_folder, result)
 
 
-def distort_images(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
-    output_pic_file_name = Path(output_stem + '.jpg')
-    output_pic_path = output_folder.joinpath(output_pic_file_name)
-    
+def _distort_images_core(source: Union[Path, BinaryIO], config: dict) -> OpResult:
+    ''' Distort an image from a path or a file object, see distort_images() '''
     quality = config.get('quality', JpegImageQuality.JPEG_GOOD)
     width_aspect_ratio = config.get('width_aspect_ratio', -1)
     height_aspect_ratio = config.get('height_aspect_ratio', -1)
 
-    if width_aspect_ratio <= 0 or height_aspect_ratio <= 0:
-        raise Exception(f'Width {width_aspect_ratio} and height {height_aspect_ratio} aspect ratio must be positive')
-    
-    try:
-        im = PILImage.open(original_pic)
-        if im.mode not in ("L", "RGB"):
-            im = im.convert("RGB")
+    im = PILImage.open(source)
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
 
-        # Distort the image
-        im = distort(im, width_aspect_ratio, height_aspect_ratio)
+    # Distort the image
+    im = distort(im, width_aspect_ratio, height_aspect_ratio, config.get('resample', None))
 
-        # Save the distorted image
-        if_exists_then_raise(output_pic_path)
-        im.save(output_pic_path, "JPEG", quality=quality)
-        print("save:", output_pic_path)
-    except Exception as e:
-        print(e)
+    encode, suffix = encoder_for(config.get('encoder', None), config.get('subsampling', None))
+    return (encode(im, quality), suffix)
 
 
-def remove_black_bar(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
-    ''' Remove black bar from picture '''
-    # _disallow_multi_dot(original_pic)
-    # output file final path
-    output_pic_file_name = Path(output_stem + '.jpg')
-    output_pic_path = output_folder.joinpath(output_pic_file_name)
+def distort_images(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    width_aspect_ratio = config.get('width_aspect_ratio', -1)
+    height_aspect_ratio = config.get('height_aspect_ratio', -1)
+
+    if width_aspect_ratio <= 0 or height_aspect_ratio <= 0:
+        raise Exception(f'Width {width_aspect_ratio} and height {height_aspect_ratio} aspect ratio must be positive')
+
+    result = _distort_images_core(original_pic, config)
+    return _save_result(original_pic, output_stem, output_folder, result)
 
+
+def _remove_black_bar_core(source: Union[Path, BinaryIO], config: dict) -> OpResult:
+    ''' Remove black bar from a path or a file object, see remove_black_bar() '''
     # Set up configurations, if not configured then use "middle" range options
     quality = JpegImageQuality.JPEG_GOOD # 95% quality can save 1/2 space
 
-    try:
-        im = open_img(original_pic)
-        if im.mode not in ("L", "RGB"):
-            im = im.convert("RGB")
+    im = open_img(source)
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
 
-        grayscale_image = im.convert("L")
-    
-        # Find the bounding box of non-black areas
-        bbox = grayscale_image.getbbox()
+    grayscale_image = im.convert("L")
 
-        # Crop the original image
-        cropped_image = im.crop(bbox)
+    # Find the bounding box of non-black areas
+    bbox = grayscale_image.getbbox()
 
-        # Save the cropped image
-        if_exists_then_raise(output_pic_path)
-        cropped_image.save(output_pic_path, "JPEG", quality=quality)
-        print("save:", output_pic_path)
-    except Exception as e:
-        print(e)
+    # Crop the original image
+    cropped_image = im.crop(bbox)
+
+    encode, suffix = encoder_for(config.get('encoder', None), config.get('subsampling', None))
+    return (encode(cropped_image, quality), suffix)
+
+
+def remove_black_bar(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    ''' Remove black bar from picture '''
+    # _disallow_multi_dot(original_pic)
+    result = _remove_black_bar_core(original_pic, config)
+    return _save_result(original_pic, output_stem, output_folder, result)
+
+
+def _strip_exif_core(data: bytes, config: dict) -> OpResult:
+    ''' Strip EXIF tags from image bytes, without re-compressing '''
+    tags = config.get('tags', [])
+    my_image = _exif_image(data)
+    if my_image.has_exif:
+        for k in my_image.list_all():
+            if k in tags:
+                del my_image[k]
+    return (my_image.get_file(), None)
 
 
 def strip_exif(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
@@ -644,11 +928,100 @@ def strip_exif(original_pic: Path, output_stem: str, output_folder: Path, config
 
     tags = config.get('tags', [])
 
-    try:
-        if_exists_then_raise(output_pic_path)
-        _strip_exif_tags_2(original_pic, output_pic_path, tags)
-    except Exception as e:
-        print(e)
+    if_exists_then_raise(output_pic_path)
+    _strip_exif_tags_2(original_pic, output_pic_path, tags)
+    return output_pic_path
+
+
+def crop_box(size: Tuple[int, int], side: str, percentage: float) -> Tuple[int, int, int, int]:
+    """
+    Calculate the crop box for the specified side and percentage.
+
+    Parameters:
+        size (tuple): (width, height) of the image, eg. from the image header.
+        side (str): The side to crop, one of 'top', 'bottom', 'left', 'right'.
+        percentage (float): The percentage to crop (0-99.9).
+
+    Returns:
+        tuple: A box (left, upper, right, lower) for the crop method.
+    """
+    width, height = size
+    crop_amount = int((percentage / 100) * width if side in ['left', 'right'] else (percentage / 100) * height)
+
+    if side == 'left':
+        box = (crop_amount, 0, width, height)
+    elif side == 'right':
+        box = (0, 0, width - crop_amount, height)
+    elif side == 'top':
+        box = (0, crop_amount, width, height)
+    elif side == 'bottom':
+        box = (0, 0, width, height - crop_amount)
+    else:
+        raise ValueError("Side must be one of 'top', 'bottom', 'left', 'right'.")
+
+    return box
+
+
+def _crop_core(source: Union[Path, BinaryIO], config: dict) -> OpResult:
+    ''' Crop an image from a path or a file object, keep its format, see crop() '''
+    side = config.get('side', 'bottom')
+    percent = config.get('percent', 0)
+    quality = config.get('quality', JpegImageQuality.JPEG_GOOD)
+    tags = config.get('tags', [])
+
+    # Open once, the size comes from the header, pixels are decoded by crop()
+    im = PILImage.open(source)
+    image_format = im.format
+    my_exif = im.getexif()
+    my_exif = _strip_exif_tags(my_exif, tags)
+
+    cropped_image = im.crop(crop_box(im.size, side, percent))
+
+    buffer = io.BytesIO()
+    if image_format in ('JPEG', 'MPO'):
+        # Camera MPO files are JPEGs (plus extra frames), written as JPEG
+        cropped_image.save(buffer, "JPEG", quality=quality, exif=my_exif)
+    elif image_format == 'WEBP':
+        cropped_image.save(buffer, "WEBP", quality=quality, exif=my_exif)
+    elif image_format in ('PNG', 'TIFF'):
+        # Lossless, no quality
+        cropped_image.save(buffer, image_format, exif=my_exif)
+    else:
+        cropped_image.save(buffer, image_format)
+    return (buffer.getvalue(), None)
+
+
+def crop(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    ''' Crop out part of an image (like bottom), keep the original format.
+
+        Parameters
+        ----------
+        config: {'side':str, 'percent':float, 'quality':int, 'tags':List[str]}
+    '''
+    result = _crop_core(original_pic, config)
+    return _save_result(original_pic, output_stem, output_folder, result)
+
+
+def tiles(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
+    ''' DeepZoom tile pyramid of an image: output_stem.dzi and output_stem_files/, see deepzoom.py
+
+        Parameters
+        ----------
+        config: {'tile_size':int, 'overlap':int, 'quality':int, 'format':str, 'threads':int}
+    '''
+    from .deepzoom import build_pyramid, TILE_SIZE, TILE_OVERLAP, TILE_THREADS
+    dzi_path = output_folder.joinpath(Path(output_stem + '.dzi'))
+    n_of_tiles = build_pyramid(
+        open_img(original_pic),
+        dzi_path,
+        config.get('tile_size', TILE_SIZE),
+        config.get('overlap', TILE_OVERLAP),
+        config.get('quality', JpegImageQuality.JPEG_OK),
+        config.get('format', 'jpg'),
+        config.get('threads', TILE_THREADS)
+    )
+    print("save:", dzi_path, f'({n_of_tiles} tiles)')
+    return dzi_path
 
 
 def _remove_exif(src: Path):
@@ -666,7 +1039,7 @@ def _open_as_exif_image(src: Path):
     '''
     my_image = None
     with open(src, 'rb') as in_file:
-        my_image = EXIFImage(in_file)
+        my_image = _exif_image(in_file)
         return my_image
 
 
@@ -687,7 +1060,7 @@ def open_as_exif_image(src: Path):
     return my_image
 
 
-def _set_exifs(my_image: EXIFImage, config: dict) -> Union[EXIFImage, None]:
+def _set_exifs(my_image: 'EXIFImage', config: dict) -> Union['EXIFImage', None]:
     try:
         for key in config:
             my_image[key] = config[key]
@@ -697,7 +1070,7 @@ def _set_exifs(my_image: EXIFImage, config: dict) -> Union[EXIFImage, None]:
         return None
 
 
-def set_exifs(src: Path, my_image: EXIFImage, config: dict) -> EXIFImage:
+def set_exifs(src: Path, my_image: 'EXIFImage', config: dict) -> 'EXIFImage':
     ''' Set exif of image, if error occurs try to fix it '''
     max_try = 10
     new_image = None
@@ -732,7 +1105,7 @@ def _set_exif_tags_2(src: Path, dst: Path, config: dict):
             out_file.write(my_image.get_file())
     except Exception as e:
         print('Error save:', dst)
-        print(e)
+        raise e
 
 
 def set_exif(original_pic: Path, output_stem: str, output_folder: Path, config:dict):
@@ -744,12 +1117,21 @@ def set_exif(original_pic: Path, output_stem: str, output_folder: Path, config:d
     try:
         if_exists_then_raise(output_pic_path)
         _set_exif_tags_2(original_pic, output_pic_path, config)
+        return output_pic_path
     except Exception as e:
         print(f'set_exif error: {original_pic}')
         print(e)
         raise (e)
 
 
+def _set_exif_core(data: bytes, config: dict) -> OpResult:
+    ''' Set EXIF tags of image bytes, without re-compressing (no repair of corrupted EXIF) '''
+    my_image = _exif_image(data)
+    for key in config:
+        my_image[key] = config[key]
+    return (my_image.get_file(), None)
+
+
 class ImageHelper:
     registry = {
         'down_size': down_size,
@@ -757,7 +1139,29 @@ class ImageHelper:
         'remove_black_bar': remove_black_bar,
         'strip_exif': strip_exif,
         'set_exif': set_exif,
-        'distort_images': distort_images
+        'distort_images': distort_images,
+        'crop': crop,
+        'tiles': tiles
+    }
+
+    @classmethod
+    def select_helper(cls, name:str) -> Callable:
+        func = cls.registry.get(name, None)
+        if func == None:
+            raise Exception(f'{name} function not found')
+        return func
+
+
+class BytesHelper:
+    ''' Operations on image bytes: (data, config) -> OpResult '''
+    registry = {
+        'down_size': lambda data, config: _down_size_core(io.BytesIO(data), len(data), config),
+        'down_scale': lambda data, config: _down_scale_core(io.BytesIO(data), len(data), config),
+        'remove_black_bar': lambda data, config: _remove_black_bar_core(io.BytesIO(data), config),
+        'strip_exif': _strip_exif_core,
+        'set_exif': _set_exif_core,
+        'distort_images': lambda data, config: _distort_images_core(io.BytesIO(data), config),
+        'crop': lambda data, config: _crop_core(io.BytesIO(data), config)
     }
 
     @classmethod
@@ -768,6 +1172,155 @@ class ImageHelper:
         return func
 
 
+def process_bytes(data: Union[bytes, bytearray, memoryview], method_name: str, config: dict) -> bytes:
+    ''' Run an operation on an image in memory, no file is read or written.
+
+    Args:
+        data (bytes): the encoded source image (bytes, bytearray or memoryview).
+        method_name (str): one of the operations of BytesHelper.
+        config (dict): the config that the method needed, same as the file version.
+
+    Returns:
+        bytes: the encoded output image, the source itself if the method keeps it as it is.
+
+    Raises:
+        Exception: on unknown method or any image error.
+    '''
+    data = bytes(data)
+    result = BytesHelper.select_helper(method_name)(data, config)
+    if result is None:
+        return data
+    return result[0]
+
+
+async def process_bytes_async(data: Union[bytes, bytearray, memoryview], method_name: str, config: dict, executor: Union[Executor, None] = None) -> bytes:
+    ''' asyncio version of process_bytes(), the work runs in an executor.
+
+        executor: a ThreadPoolExecutor (Pillow releases the GIL) or a ProcessPoolExecutor,
+        None for the loop's default executor.
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    # memoryview can't be pickled to a process pool
+    return await loop.run_in_executor(executor, process_bytes, bytes(data), method_name, config)
+
+
+def concat_folder(folder_path: Union[str, Path], horizontal: bool, remove_after: bool, width_aspect_ratio: int, height_aspect_ratio: int, columns: int = 0) -> Union[str, None]:
+    ''' Concat ALL images directly under one folder (not recursive).
+
+        The output is saved next to the images, named after the first image (by name).
+
+    Args:
+        folder_path (str): the folder.
+        horizontal (bool): True=horizontal, False=vertical
+        remove_after (bool): Remove original images after concat.
+        width_aspect_ratio (int): the width aspect ratio of each image.
+        height_aspect_ratio (int): the height aspect ratio of each image.
+        columns (int): if > 0, make a rows x columns grid streamed into a PNG instead.
+
+    Returns:
+        Union[str, None]: the output path, or None if less than 2 images found.
+    '''
+    imgs = _list_concat_imgs(folder_path)
+    if len(imgs) < 2:
+        return None
+
+    if columns > 0:
+        from .contact_sheet import concat_grid
+        big_img_path = imgs[0] + '.png'
+        concat_grid(imgs, big_img_path, columns, width_aspect_ratio, height_aspect_ratio)
+    else:
+        PIL_imgs = [open_img(img) for img in imgs] # Convert to img objects
+        big_img = concat_imgs_2(PIL_imgs, horizontal, width_aspect_ratio, height_aspect_ratio) # Concat into one
+        big_img_path = imgs[0] + '.jpg'
+        save_jpg(big_img, big_img_path) # Save
+
+    if remove_after:
+        for img in imgs:
+            silent_remove(img)
+
+    return big_img_path
+
+
+def _list_concat_imgs(folder_path: Union[str, Path]) -> List[str]:
+    ''' Sorted image paths (strings) directly under a folder, hidden files excluded '''
+    full_paths = [os.path.join(folder_path, f) for f in os.listdir(folder_path)]
+    imgs = [x for x in full_paths if os.path.isfile(x) and (not is_hidden_file(x)) and is_img(x)]
+    return sorted(imgs) # sort path strings by name
+
+
+def find_concat_folders(root: Union[str, Path], recursive: bool = True) -> List[str]:
+    ''' Find every folder (root included) that holds at least 2 images to concat.
+
+        Folders are independent of each other, each one is a task.
+    '''
+    if not recursive:
+        return [str(root)] if len(_list_concat_imgs(root)) >= 2 else []
+
+    folders = []
+    for current, _, _ in os.walk(root):
+        if len(_list_concat_imgs(current)) >= 2:
+            folders.append(current)
+    return sorted(folders)
+
+
+def _concat_folder_task(folder_path: str, horizontal: bool, remove_after: bool, width_aspect_ratio: int, height_aspect_ratio: int, columns: int) -> Tuple[str, Union[str, None], Union[str, None]]:
+    ''' Pool worker: (folder, output path, error message) '''
+    try:
+        output = concat_folder(folder_path, horizontal, remove_after, width_aspect_ratio, height_aspect_ratio, columns)
+        return (folder_path, output, None)
+    except Exception as e:
+        return (folder_path, None, str(e))
+
+
+def concat_folders_multi(root: Path, horizontal: bool, remove_after: bool, width_aspect_ratio: int, height_aspect_ratio: int, columns: int = 0, recursive: bool = True, dry_run: bool = False):
+    '''
+    [Multi-process version] Concat images of each folder under root, one folder per task.
+
+    Args:
+        root (Path): the starting folder.
+        horizontal (bool): True=horizontal, False=vertical
+        remove_after (bool): Remove original images after concat.
+        width_aspect_ratio (int): the width aspect ratio of each image.
+        height_aspect_ratio (int): the height aspect ratio of each image.
+        columns (int): if > 0, make a rows x columns grid streamed into a PNG instead.
+        recursive (bool): go into sub-folders.
+        dry_run (bool): only report the planned folders, touch nothing.
+
+    Yields:
+        str: progress messages.
+    '''
+    folders = find_concat_folders(root, recursive)
+
+    if dry_run:
+        for folder in folders:
+            yield f'Plan: {folder} ({len(_list_concat_imgs(folder))} images)'
+        yield f'Planned {len(folders)} folders'
+        return
+
+    n_of_cores = min(max_process_count(), max(len(folders), 1))
+    print(f'multi-workers: {n_of_cores}')
+
+    start = time.monotonic()
+    done = 0
+    args = [(x, horizontal, remove_after, width_aspect_ratio, height_aspect_ratio, columns) for x in folders]
+    with Pool(n_of_cores) as pool:
+        for folder, output, error in pool.imap_unordered(_concat_folder_unpack, args):
+            done += 1
+            if error:
+                yield f'Error: {folder}: {error}'
+            else:
+                yield f'Concat: {output}'
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    yield f'Done {done} folders in {elapsed:.1f}s, {done / elapsed:.2f} folders/s'
+
+
+def _concat_folder_unpack(args: tuple):
+    ''' imap_unordered only passes one argument '''
+    return _concat_folder_task(*args)
+
+
 def scan(src: Path, dst_parent: Path, transform:List[str], method_name:str, config: dict):
     '''
     Scan from root, get all dirs and files.
@@ -817,7 +1370,10 @@ def scan(src: Path, dst_parent: Path, transform:List[str], method_name:str, conf
             # Copy or transform?
             if str(new_path.suffix).lower() in transform:
                 h = ImageHelper.select_helper(method_name)
-                h(current, new_path.stem, new_path.parent, config)
+                try:
+                    h(current, new_path.stem, new_path.parent, config)
+                except Exception as e:
+                    print(e)
                 yield f'Process:{method_name}: {new_path}'
             else:
                 just_copy_file(current, new_path)
@@ -827,36 +1383,88 @@ def scan(src: Path, dst_parent: Path, transform:List[str], method_name:str, conf
             raise Exception(f'not file, not dir. {current}')
 
 
-def scan_multi(src: Path, dst_parent: Path, transform:List[str], method_name:str, config: dict):
+# What an operation writes for an image: an image (any format the encoders give), or a DeepZoom .dzi
+OUTPUT_SUFFIXES = IMAGE_SUFFIX + ['.dzi']
+
+
+def image_outputs(output_folder: Path, output_stem: str) -> List[Path]:
+    ''' Files in output_folder that can be the output of an image: same stem and an OUTPUT_SUFFIXES suffix.
+        Sidecars of the same stem (.xmp, .aae) are not outputs.
     '''
-    [Multi-process version] Scan from root, get all dirs and files.
+    if not output_folder.is_dir():
+        return []
+    return sorted([x for x in output_folder.iterdir() if x.is_file() and x.stem == output_stem and x.suffix.lower() in OUTPUT_SUFFIXES])
+
+
+def _link_duplicate(dst_parent: Path, rel_path: str, kept_rel_path: str, output: Union[str, None]) -> str:
+    ''' Hard link output, the file written for kept_rel_path, as the output of rel_path (a copy if links fail) '''
+    if output is None:
+        return f'Not linked (no output of {kept_rel_path}): {rel_path}'
+    output = Path(output)
+    new_path = dst_parent.joinpath(rel_path)
+    new_path = new_path.parent.joinpath(new_path.stem + output.suffix)
+    if new_path.exists():
+        return f'Not linked ({new_path} exists): {rel_path}'
+    try:
+        os.link(output, new_path)
+    except OSError:
+        just_copy_file(output, new_path)
+    return f'Link: {new_path} -> {output}'
+
+
+def _keeps_as_is(method_name: str, config: dict, row: dict) -> bool:
+    ''' If the operation would return the file unchanged, decided from its index row (size, format) '''
+    if method_name == 'down_size':
+        if row['format'] is None or row['size'] > config.get('max_size_mb', StorageSizes.JPEG_GOOD) * 1024 * 1024:
+            return False
+        return not config.get('force_jpg', False) or _in_encoder_format(row['format'], config.get('encoder', None) or DEFAULT_ENCODER)
+    if method_name == 'down_scale':
+        skip_under_mb = config.get('skip_under_mb', 0)
+        return skip_under_mb > 0 and row['size'] < skip_under_mb * 1024 * 1024
+    return False
 
-    Args:
-        src (Path): a folder (contain images) as starting point.
-        dst_parent (Path): a parent folder where the cloned (downscaled) src folder is put in.
-        transform: a list of suffixes, eg. '.png', '.jpeg', '.jpg'
-        method_name: one of the image helper method supported
-        config: the config that the method needed
 
-    Raises:
-        Exception: If scanning path is not file nor dir.
+def _kept_by_index(src: Path, rel_paths: List[str], method_name: str, config: dict, index_path: Union[str, Path, None] = None) -> List[str]:
+    ''' Images (rel paths) of src that the header index says method_name keeps as they are.
+        Only rows still matching the file (size, mtime) count, nothing without an index_path.
     '''
-    # Multi-process setup
-    n_of_cores = max_process_count()
-    print(f'multi-workers: {n_of_cores}')
+    from .index import ImageIndex
+    if method_name not in ('down_size', 'down_scale') or index_path is None or not Path(index_path).exists():
+        return []
+    image_index = ImageIndex(index_path)
+    try:
+        rows = {x['path']: x for x in image_index.rows_under(src)}
+    finally:
+        image_index.close()
+
+    kept = []
+    for x in rel_paths:
+        path = src.parent.joinpath(x)
+        row = rows.get(str(path))
+        if row is None or not _keeps_as_is(method_name, config, row):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns) == (row['size'], row['mtime_ns']):
+            kept.append(x)
+    return kept
+
+
+def _mirror_tree(src: Path, dst_parent: Path, transform: List[str], method_name: str, rel_paths: List[str], copies: List[str], copy_filter: Union[Callable, None] = None):
+    '''
+    Walk src (resolved): create its folders in dst_parent, copy the non-image files
+    (those copy_filter(rel path) accepts, if given), yield progress messages.
 
-    # src folder
-    src = src.resolve()
-    # parent of src folder
+    The images found are appended to rel_paths and the copied files to copies, as paths
+    relative to the parent of src.
+    '''
     src_parent = src.parent
-    # parent of dst folder
-    dst_parent = dst_parent.resolve()
-
     # Set up a registry for all unresolved (un-visited) paths
     unresolved = []
     unresolved.append(src)
 
-    downsize_args = []
     while len(unresolved):
         current = unresolved.pop(0)
         # Directory? Create a same folder in dst, then go deeper.
@@ -864,8 +1472,8 @@ def scan_multi(src: Path, dst_parent: Path, transform:List[str], method_name:str
             # Exception: path can't be related
             rel_path = compute_relative_path(src_parent, current)            
             new_path = dst_parent.joinpath(rel_path)
-            # Exception: cannot create dir
-            new_path.mkdir()
+            # Exception: cannot create dir (an existing one is fine, eg. a re-run)
+            new_path.mkdir(exist_ok=True)
             yield f'Create: {new_path}'
             
             # Exception: If encounter "permission" error (can't list)
@@ -880,18 +1488,130 @@ def scan_multi(src: Path, dst_parent: Path, transform:List[str], method_name:str
 
             # Copy or transform?
             if str(new_path.suffix).lower() in transform:
-                downsize_args.append(
-                    (current, new_path.stem, new_path.parent, config)
-                )
+                rel_paths.append(str(rel_path))
                 yield f'Process:{method_name}: {new_path}'
-            else:
+            elif copy_filter is None or copy_filter(str(rel_path)):
                 just_copy_file(current, new_path)
+                copies.append(rel_path.as_posix())
                 yield f'Copy: {new_path}'
 
         else:
             raise Exception(f'not file, not dir. {current}')
-    
+
+
+def scan_multi(src: Path, dst_parent: Path, transform:List[str], method_name:str, config: dict, executor: str = 'auto', dedupe: Union[str, None] = None, dedupe_distance: int = DEFAULT_DISTANCE, index_path: Union[str, Path, None] = None, shard: Union[str, None] = None, shard_strategy: str = 'hash', **run_options):
+    '''
+    [Multi-process version] Scan from root, get all dirs and files.
+
+    Args:
+        src (Path): a folder (contain images) as starting point.
+        dst_parent (Path): a parent folder where the cloned (downscaled) src folder is put in.
+        transform: a list of suffixes, eg. '.png', '.jpeg', '.jpg'
+        method_name: one of the image helper method supported
+        config: the config that the method needed
+        executor: 'auto', 'threads', 'processes' or 'hybrid', see executor.py
+        dedupe: None, or 'skip' / 'link': process one image of each group of near-duplicates,
+            the others get no output / a hard link to its output. See dedupe.py
+        dedupe_distance: near-duplicates are at most this many hash bits apart
+        index_path: SQLite index where the hashes are kept, None for the default one.
+            Only given, down_size and down_scale also copy the images it shows are kept as they are
+        shard: 'i/N', only process the part i (from 0) of N of the files, see shard.py.
+            A manifest of the part is written into dst_parent.
+        shard_strategy: 'hash' or 'cost'
+        run_options: timeout, max_tasks_per_worker, retries, report_path, see run_tasks()
+
+    Raises:
+        Exception: If scanning path is not file nor dir.
+    '''
+    # Multi-process setup
+    n_of_cores = max_process_count()
+    print(f'multi-workers: {n_of_cores}')
+    start = time.perf_counter()
+
+    if shard is not None:
+        from .shard import parse_shard, path_shard, select_shard, write_manifest
+        shard = parse_shard(shard)
+        if dedupe is not None:
+            raise Exception('dedupe needs every image, it can not run on a shard')
+
+    # src folder
+    src = src.resolve()
+    # parent of src folder
+    src_parent = src.parent
+    # parent of dst folder
+    dst_parent = dst_parent.resolve()
+
+    rel_paths = []
+    copies = []
+    # Non-image files of the other shards are copied by their node
+    copy_filter = None if shard is None else (lambda x: path_shard(x, shard[1]) == shard[0])
+    yield from _mirror_tree(src, dst_parent, transform, method_name, rel_paths, copies, copy_filter)
+
+    # Only this node's part, every node computes the same split
+    if shard is not None:
+        rel_paths = select_shard(rel_paths, src_parent, shard, shard_strategy)
+        yield f'Shard {shard[0]}/{shard[1]} ({shard_strategy}): {len(rel_paths)} images, {len(copies)} copies'
+
+    # Near-duplicates: hashes are cached in the index, only new or changed files are decoded
+    duplicates = {}
+    if dedupe is not None:
+        if dedupe not in ('skip', 'link'):
+            raise Exception(f'Unknown dedupe {dedupe}, choose from skip, link')
+        from .index import DEFAULT_INDEX_PATH, ImageIndex
+        image_index = ImageIndex(index_path or DEFAULT_INDEX_PATH)
+        try:
+            yield from image_index.update_hashes(src)
+            wanted = set(rel_paths)
+            rows = []
+            for x in image_index.hashes_under(src):
+                x['path'] = str(compute_relative_path(src_parent, Path(x['path'])))
+                if x['path'] in wanted:
+                    rows.append(x)
+        finally:
+            image_index.close()
+        duplicates = find_duplicates(rows, dedupe_distance)
+        for x in sorted(duplicates):
+            yield f'Duplicate: {x} of {duplicates[x]}'
+        rel_paths = [x for x in rel_paths if x not in duplicates]
+
+    # Images the index shows would be kept as they are: copied here, never sent to a worker
+    outputs = {}
+    kept_as_is = set(_kept_by_index(src, rel_paths, method_name, config, index_path))
+    for x in sorted(kept_as_is):
+        new_path = dst_parent.joinpath(x)
+        if new_path.exists():
+            # Left to the workers: it fails and is reported like any other existing output
+            kept_as_is.discard(x)
+            continue
+        just_copy_file(src_parent.joinpath(x), new_path)
+        outputs[(0, x)] = str(new_path)
+    if kept_as_is:
+        yield f'Index: {len(kept_as_is)} images kept as they are, copied'
+
     # Finally, do the downsize
-    with Pool(n_of_cores) as pool:
-        h = ImageHelper.select_helper(method_name)
-        pool.starmap(h, downsize_args)
\ No newline at end of file
+    # Workers get the method and config once, then batches of relative paths
+    jobs = [(method_name, config, str(src_parent), str(dst_parent))]
+    _, failures = run_tasks(jobs, [[x for x in rel_paths if x not in kept_as_is]], executor, n_of_cores, outputs=outputs, **run_options)
+    for x in failures:
+        yield f'Failed ({x["kind"]}, {x["attempts"]} attempts): {x["path"]}: {x["message"]}'
+    if failures:
+        yield f'Failed: {len(failures)} of {len(rel_paths)} images' + (f', see {run_options["report_path"]}' if run_options.get('report_path') else '')
+
+    if dedupe == 'link':
+        for x in sorted(duplicates):
+            yield _link_duplicate(dst_parent, x, duplicates[x], outputs.get((0, duplicates[x])))
+    if duplicates:
+        yield f'Duplicates: {len(duplicates)} of {len(rel_paths) + len(duplicates)} images not processed ({dedupe})'
+
+    if shard is not None:
+        files = []
+        for x in rel_paths:
+            output = Path(outputs[(0, x)]) if (0, x) in outputs else None
+            files.append({
+                'path': Path(x).as_posix(),
+                'input_bytes': src_parent.joinpath(x).stat().st_size,
+                'output': output.relative_to(dst_parent).as_posix() if output else None,
+                'output_bytes': output.stat().st_size if output else None,
+            })
+        path = write_manifest(dst_parent, shard, shard_strategy, method_name, files, copies, failures, time.perf_counter() - start)
+        yield f'Manifest: {path}'
\ No newline at end of file
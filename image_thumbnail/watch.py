@@ -0,0 +1,291 @@
+'''
+    Watch mode: keep a worker pool alive and process new or modified files as they land.
+
+    Changes are detected with inotify on Linux (through ctypes, no extra package),
+    or by polling the tree elsewhere. A file is processed once its size and mtime have been
+    stable for a while (debounce), so partially written files are not picked up.
+    If inotify drops events (queue overflow), the tree is synced again like at the start.
+'''
+import os
+import sys
+import time
+import errno
+import ctypes
+import select
+import struct
+import ctypes.util
+from pathlib import Path
+from multiprocessing import Pool
+from typing import Dict, List, Set, Tuple
+
+from .executor import _init_worker, _run_one
+from .utils import (
+    image_outputs,
+    is_hidden_file,
+    just_copy_file,
+    max_process_count,
+    compute_relative_path
+)
+
+# A file must keep the same (size, mtime) this long before it is processed.
+SETTLE_SECONDS = 2.0
+
+# Polling interval of the fallback watcher.
+POLL_SECONDS = 2.0
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    ''' Find changed files by comparing (size, mtime) snapshots of the tree '''
+    def __init__(self, root: Path, interval: float = POLL_SECONDS):
+        self.root = root
+        self.interval = interval
+        # Never loses changes
+        self.overflowed = False
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for current, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(current, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout: float) -> Set[str]:
+        ''' Block up to timeout seconds, return files created or modified since last call '''
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = set([x for x, stamp in snapshot.items() if self._snapshot.get(x) != stamp])
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    ''' Linux inotify on every folder of the tree, new folders are watched as they appear.
+        overflowed: events were lost since the last wait(), the caller must look at the tree again
+    '''
+    def __init__(self, root: Path):
+        self.root = root
+        self.overflowed = False
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches: Dict[int, str] = {}
+        self._found: Set[str] = set()
+        self._add_tree(str(root))
+        # Files that were created before their folder got watched are picked up by _add_tree
+        self._found.clear()
+
+    def _add_tree(self, folder: str, with_files: bool = True):
+        ''' Watch folder and its sub-folders, remember files already inside (with_files) '''
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for current, _, files in os.walk(folder):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(current), mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, 'inotify watch limit reached, raise fs.inotify.max_user_watches')
+                continue
+            self._watches[wd] = current
+            if with_files:
+                for name in files:
+                    self._found.add(os.path.join(current, name))
+
+    def wait(self, timeout: float) -> Set[str]:
+        ''' Block up to timeout seconds, return files created or modified '''
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                data = b''
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Folders created meanwhile get watched, their files come from the caller's sync
+                    self.overflowed = True
+                    self._add_tree(str(self.root), with_files=False)
+                    continue
+                folder = self._watches.get(wd)
+                if folder is None or not name:
+                    continue
+                path = os.path.join(folder, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_tree(path)
+                else:
+                    self._found.add(path)
+
+        found = self._found
+        self._found = set()
+        return found
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(root: Path):
+    ''' inotify on Linux, polling otherwise (or if inotify is not usable) '''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            print(f'inotify unavailable ({e}), fall back to polling')
+    return PollingWatcher(root)
+
+
+def _previous_outputs(new_path: Path, is_image: bool, outputs: Dict[str, Path]) -> List[Path]:
+    '''
+    What an earlier run wrote for a source whose output would be new_path:
+        a copied file: new_path itself.
+        an image: the output recorded by this watch, else (written before it started) the
+        images of the same stem. A sidecar of the same stem (.xmp) is never taken.
+    '''
+    if not is_image:
+        return [new_path] if new_path.is_file() else []
+    if str(new_path) in outputs:
+        return [x for x in [outputs[str(new_path)]] if x.is_file()]
+    return image_outputs(new_path.parent, new_path.stem)
+
+
+def _is_up_to_date(src_file: Path, previous: List[Path]) -> bool:
+    ''' An output of the source exists and is newer than the source '''
+    src_mtime = src_file.stat().st_mtime
+    return any([x.stat().st_mtime >= src_mtime for x in previous])
+
+
+def watch_multi(src: Path, dst_parent: Path, transform: List[str], method_name: str, config: dict, settle: float = SETTLE_SECONDS):
+    '''
+    Process src into dst_parent (same layout as scan_multi), then keep processing new or
+    modified files until interrupted.
+
+    Args:
+        src (Path): a folder (contain images) as starting point.
+        dst_parent (Path): a parent folder where the cloned (downscaled) src folder is put in.
+        transform: a list of suffixes, eg. '.png', '.jpeg', '.jpg'
+        method_name: one of the image helper method supported
+        config: the config that the method needed
+        settle: seconds a file must stay unchanged before it is processed
+
+    Yields:
+        str: progress messages.
+    '''
+    src = src.resolve()
+    src_parent = src.parent
+    dst_parent = dst_parent.resolve()
+
+    n_of_cores = max_process_count()
+    print(f'multi-workers: {n_of_cores}')
+    jobs = [(method_name, config, str(src_parent), str(dst_parent))]
+
+    watcher = make_watcher(src)
+    print(f'watcher: {type(watcher).__name__}')
+
+    # dst path of an image -> the output written for it, from this watch
+    outputs: Dict[str, Path] = {}
+
+    # path -> (size, mtime_ns, last time the stamp changed)
+    pending: Dict[str, Tuple[int, int, float]] = {}
+
+    def remember(path: str):
+        try:
+            st = os.stat(path)
+        except OSError:
+            pending.pop(path, None)
+            return
+        old = pending.get(path)
+        if old is None or old[:2] != (st.st_size, st.st_mtime_ns):
+            pending[path] = (st.st_size, st.st_mtime_ns, time.monotonic())
+
+    def sync():
+        ''' Everything that has no up-to-date output yet '''
+        for current, _, files in os.walk(src):
+            for name in files:
+                path = Path(current).joinpath(name)
+                if is_hidden_file(path):
+                    continue
+                new_path = dst_parent.joinpath(compute_relative_path(src_parent, path))
+                try:
+                    if _is_up_to_date(path, _previous_outputs(new_path, new_path.suffix.lower() in transform, outputs)):
+                        continue
+                except OSError:
+                    continue
+                remember(str(path))
+
+    sync()
+
+    # task -> (dst path, landing time)
+    running = {}
+    with Pool(n_of_cores, initializer=_init_worker, initargs=(jobs,)) as pool:
+        try:
+            while True:
+                changed = watcher.wait(settle / 2 if pending or running else 60)
+                if watcher.overflowed:
+                    watcher.overflowed = False
+                    yield 'Watch: events lost (queue overflow), sync the tree again'
+                    sync()
+                for path in changed:
+                    remember(path)
+
+                # Debounce: only files whose stamp stayed the same for settle seconds
+                now = time.monotonic()
+                for path in [x for x, stamp in pending.items() if now - stamp[2] >= settle]:
+                    remember(path)
+                    if path not in pending or now - pending[path][2] < settle:
+                        continue
+
+                    current = Path(path)
+                    if is_hidden_file(current) or not current.is_file():
+                        del pending[path]
+                        continue
+                    rel_path = compute_relative_path(src_parent, current)
+                    new_path = dst_parent.joinpath(rel_path)
+                    # Still processing an earlier version: taken again once that task is done
+                    if new_path in [x[0] for x in running.values()]:
+                        continue
+                    del pending[path]
+                    new_path.parent.mkdir(parents=True, exist_ok=True)
+                    is_image = str(new_path.suffix).lower() in transform
+                    for x in _previous_outputs(new_path, is_image, outputs):
+                        x.unlink()
+                    landed = current.stat().st_mtime
+
+                    if is_image:
+                        running[pool.apply_async(_run_one, (0, str(rel_path)))] = (new_path, landed)
+                        yield f'Queue:{method_name}: {new_path}'
+                    else:
+                        just_copy_file(current, new_path)
+                        yield f'Copy: {new_path} ({time.time() - landed:.1f}s)'
+
+                for task in [x for x in running if x.ready()]:
+                    new_path, landed = running.pop(task)
+                    try:
+                        outputs[str(new_path)] = task.get()
+                        yield f'Process:{method_name}: {new_path} ({time.time() - landed:.1f}s)'
+                    except Exception as e:
+                        yield f'Error: {new_path}: {e}'
+        finally:
+            watcher.close()
@@ -1,125 +1,283 @@
 ''' Interface to image process '''
 import click
 from pathlib import Path
-from image_thumbnail import (
-    utils,
-    constants
-)
+# Pillow, exif and the helpers are imported by the commands that run, not for --help
+from image_thumbnail import constants
+from image_thumbnail.executor import EXECUTORS, START_METHODS
+from image_thumbnail.encoders import ENCODERS, SUBSAMPLINGS
 
 @click.group()
 def cli():
     pass
 
+executor_option = click.option('-x', '--executor', type=click.Choice(EXECUTORS), default='auto', show_default=True, help='threads for many small images, processes for big ones, hybrid = processes x threads; auto picks from a sample of file sizes')
+
+watch_option = click.option('--watch', is_flag=True, show_default=True, default=False, help='Keep running, process new or modified files of SRC as they land')
+
+plan_option = click.option('--plan', is_flag=True, show_default=True, default=False, help='Only estimate output size, copy/transcode share and time from a sample, write nothing')
+
+def supervise_options(f):
+    ''' Failure handling options of processes/hybrid runs, passed to run_scan as a dict '''
+    f = click.option('--start-method', type=click.Choice(START_METHODS), default='default', show_default=True, help='How worker processes start: forkserver imports Pillow once and forks warm workers from it, spawn imports it in every worker')(f)
+    f = click.option('--report', 'report_path', type=click.Path(dir_okay=False, writable=True), default=None, help='Append failed images there, as JSON lines')(f)
+    f = click.option('--retries', type=int, default=1, show_default=True, help='Retries of an image whose worker hung or crashed')(f)
+    f = click.option('--max-tasks-per-worker', type=int, default=1000, show_default=True, help='Replace a worker process after this many images (bounds memory growth)')(f)
+    f = click.option('--timeout', type=float, default=300, show_default=True, help='Kill and replace a worker stuck on one image this many seconds, 0 = never')(f)
+    return f
+
+resample_option = click.option('-r', '--resample', type=click.Choice(['two_stage', 'lanczos', 'fast']), default='two_stage', show_default=True, help='two_stage: box reduce to ~2x then LANCZOS, lanczos: LANCZOS from full size (slowest), fast: box reduce to ~1x then LANCZOS')
+
+def _check_encoder(ctx, param, value):
+    ''' Fail before the scan if the codec isn't there '''
+    from image_thumbnail.encoders import available, available_encoders
+    if not available(value):
+        raise click.BadParameter(f'{value} is not available here, available: {available_encoders()}')
+    return value
+
+def encoder_options(f):
+    ''' Output format options, passed to the config as 'encoder' and 'subsampling' '''
+    f = click.option('--subsampling', type=click.Choice(SUBSAMPLINGS), default=None, help='Chroma subsampling of jpeg, jpeg_opt and avif, default: codec default')(f)
+    f = click.option('-o', '--encoder', type=click.Choice(list(ENCODERS)), default='jpeg', show_default=True, callback=_check_encoder, help='Output format: jpeg, jpeg_opt (optimized + progressive), webp, avif, jxl (the last two need their Pillow plugin)')(f)
+    return f
+
+flatten_option = click.option('--flatten', is_flag=True, show_default=True, default=False, help='Animated GIF/WebP: keep only the first frame, as a still image (default: stay animated)')
+
+target_ssim_option = click.option('--target-ssim', type=float, default=0, show_default=True, help='[0-1] Lowest JPEG quality (down to --min-quality, up to -q) whose SSIM reaches this, eg. 0.98. 0: fixed quality')
+
+def dedupe_options(f):
+    ''' Near-duplicate handling of scan_multi, passed to run_scan as a dict '''
+    f = click.option('--dedupe-distance', type=int, default=6, show_default=True, help='Near-duplicates are at most this many bits apart (of 64, dHash and pHash)')(f)
+    f = click.option('--dedupe', type=click.Choice(['skip', 'link']), default=None, help='Process one image of each group of near-duplicates, the others get no output (skip) or a hard link to its output (link)')(f)
+    return f
+
+def shard_options(f):
+    ''' Multi-node runs of scan_multi, passed to run_scan as a dict '''
+    f = click.option('--shard-strategy', type=click.Choice(['hash', 'cost']), default='hash', show_default=True, help='hash: by relative path, no I/O. cost: balanced by pixels from header probes')(f)
+    f = click.option('--shard', type=str, default=None, help='i/N: only process part i (0..N-1) of N, eg. 0/4 on the first of 4 nodes. Then run merge-shards')(f)
+    return f
+
+index_option = click.option('--index', 'index_path', type=click.Path(exists=True, dir_okay=False, resolve_path=True), default=None, help='Header index (see index) to consult: images it shows are kept as they are get copied without a decode. Also keeps the --dedupe hashes [default: ~/.cache/image_thumbnail/index.sqlite for --dedupe only]')
+
+archive_option = click.option('--extract', is_flag=True, show_default=True, default=False, help='If SRC is an archive: write a folder into DST, not an archive of the same name')
+
+def run_archive(src: str, dst: str, method_name: str, config: dict, executor_name: str, extract: bool):
+    ''' Run a method over the archive SRC, into an archive (or a folder) of the same name in DST '''
+    from image_thumbnail.archive import ARCHIVE_SUFFIXES, process_archive
+    src = Path(src)
+    name = src.name
+    if extract:
+        for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+            if name.lower().endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+    for message in process_archive(src, Path(dst).joinpath(name), constants.IMAGE_SUFFIX, method_name, config, executor_name):
+        print(f'\r{message}', end='\n' if message.startswith(('Error', 'Archive')) else '')
+
+# Options of scan_multi that watch_multi has no use for
+WATCH_IGNORED = ['executor', 'timeout', 'max_tasks_per_worker', 'retries', 'report_path', 'start_method', 'index_path']
+
+def run_scan(src: str, dst: str, method_name: str, config: dict, executor_name: str, watch: bool = False, plan: bool = False, options: dict = None):
+    ''' Run a method over SRC into DST, print progress.
+
+        options: --extract (archive SRC), then the supervise_options, dedupe_options, shard_options (and index_option) of scan_multi
+    '''
+    options = dict(options or {})
+    extract = options.pop('extract', False)
+    if options.get('dedupe') and (Path(src).is_file() or watch or plan):
+        raise click.BadParameter('--dedupe needs a SRC folder, without --watch or --plan')
+    if options.get('shard') and (Path(src).is_file() or watch or plan):
+        raise click.BadParameter('--shard needs a SRC folder, without --watch or --plan')
+    if Path(src).is_file():
+        from image_thumbnail.archive import archive_kind
+        if archive_kind(src) is None:
+            raise click.BadParameter(f'{src} is not a folder nor a .tar/.zip archive')
+        if watch or plan:
+            raise click.BadParameter('--watch and --plan need a SRC folder')
+        run_archive(src, dst, method_name, config, executor_name, extract)
+        return
+
+    if plan:
+        from image_thumbnail.plan import plan as make_plan
+        for message in make_plan(Path(src), constants.IMAGE_SUFFIX, method_name, config):
+            click.echo(message)
+        return
+
+    if watch:
+        # The watch pool is a plain one: no executor choice, no supervision
+        ctx = click.get_current_context()
+        given = [x for x in WATCH_IGNORED if ctx.get_parameter_source(x) not in (None, click.core.ParameterSource.DEFAULT)]
+        if given:
+            raise click.BadParameter(f'--watch does not take {", ".join(["--" + x.replace("_path", "").replace("_", "-") for x in given])}')
+        from image_thumbnail.watch import watch_multi
+        try:
+            for message in watch_multi(Path(src), Path(dst), constants.IMAGE_SUFFIX, method_name, config):
+                click.echo(message)
+        except KeyboardInterrupt:
+            click.echo('stopped')
+        return
+
+    from image_thumbnail import utils
+    for message in utils.scan_multi(
+        Path(src),
+        Path(dst),
+        constants.IMAGE_SUFFIX,
+        method_name,
+        config,
+        executor_name,
+        **options
+    ):
+        print(f'\r{message}', end='\n' if message.startswith(('Failed', 'Duplicate', 'Link', 'Not linked', 'Shard', 'Manifest', 'Index')) else '')
+    print()
+
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
 @click.option('-s', '--size', type=float, required=False, default=constants.StorageSizes.JPEG_GOOD, prompt="Process files till less than () MB?", help='Process files till less than () MB?')
 @click.option('-q', '--quality', type=int, required=False, default=constants.JpegImageQuality.JPEG_GOOD, prompt="[1-100] JPEG image quality (bigger is better)", help='[1-100] JPEG image quality (bigger is better)')
 @click.option('-f', '--force', is_flag=True, show_default=True, default=False, help="Enfore every image converted to JPG")
 @click.option('-t', '--tag', type=str, required=False, default=[], multiple=True, prompt="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.", help="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.")
-def down_size(src, dst, size, quality, force, tag):
+@click.option('--strategy', type=click.Choice(['dimension', 'quality', 'joint']), default='dimension', show_default=True, help='dimension: shrink at the given quality, quality: keep the resolution and lower the quality, joint: best (dimension, quality) pair')
+@click.option('--min-quality', type=int, default=constants.MIN_SEARCH_QUALITY, show_default=True, help='[1-100] Lowest JPEG quality of the quality and joint strategies')
+@click.option('--threads', type=int, default=1, show_default=True, help='Quality candidates encoded at once per image (quality, joint)')
+@click.option('--graphics', type=click.Choice(['auto', 'off']), default='auto', show_default=True, help='auto: screenshots and line art (not JPEG sources) become palette PNGs instead of JPEG, off: always JPEG')
+@target_ssim_option
+@encoder_options
+@flatten_option
+@resample_option
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@index_option
+@shard_options
+@archive_option
+def down_size(src, dst, size, quality, force, tag, strategy, min_quality, threads, graphics, target_ssim, encoder, subsampling, flatten, resample, executor, watch, plan, **options):
     '''
         Shrink images till a max size in MB.
 
-        Read from SRC folder, store in DST folder. (non-images are simply copied)
+        Read from SRC folder (or .tar/.zip archive), store in DST folder. (non-images are simply copied)
     '''
-    click.echo(f'src: {src}, dst: {dst}, size: {size} MB, quality: {quality}, force jpg: {force}, tags: {tag}')
+    click.echo(f'src: {src}, dst: {dst}, size: {size} MB, quality: {quality}, force jpg: {force}, tags: {tag}, strategy: {strategy}, target SSIM: {target_ssim}')
     config = {
         'max_size_mb': float(size),
         'quality': quality,
         'force_jpg': force,
-        'tags': [x.lower() for x in tag]
+        'tags': [x.lower() for x in tag],
+        'resample': resample,
+        'strategy': strategy,
+        'min_quality': min_quality,
+        'threads': threads,
+        'target_ssim': target_ssim,
+        'encoder': encoder,
+        'subsampling': subsampling,
+        'keep_animation': not flatten,
+        'graphics': graphics
     }
-    for message in utils.scan_multi(
-        Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'down_size',
-        config
-    ):
-        print(f'\r{message}', end='')
-    print()
+    run_scan(src, dst, 'down_size', config, executor, watch, plan, options)
 
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
 @click.option('-d', '--dimension', type=int, required=False, default=0, prompt="Max dimension (eg. width, height), if 0 then size unchanged", help='Max dimension (eg. width, height), if 0 then size unchanged')
 @click.option('-q', '--quality', type=int, required=False, default=constants.JpegImageQuality.JPEG_GOOD, prompt="[1-100] JPEG image quality (bigger is better)", help='[1-100] JPEG image quality (bigger is better)')
 @click.option('-t', '--tag', type=str, required=False, default=[], multiple=True, prompt="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.", help="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.")
 @click.option('-s', '--skipunder', type=float, required=False, default=0, prompt="Skip images under this ?MB, if 0 then no skip", help='Skip images under this ?MB, if 0 then no skip')
-def down_scale(src, dst, dimension, quality, tag, skipunder):
+@click.option('--preview', is_flag=True, show_default=True, default=False, help='Use the smallest embedded JPEG (RAW/PSD preview, EXIF thumbnail) that covers the dimension, instead of a full decode')
+@target_ssim_option
+@click.option('--min-quality', type=int, default=constants.MIN_SEARCH_QUALITY, show_default=True, help='[1-100] Lowest JPEG quality of --target-ssim')
+@encoder_options
+@flatten_option
+@resample_option
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@index_option
+@shard_options
+@archive_option
+def down_scale(src, dst, dimension, quality, tag, skipunder, preview, target_ssim, min_quality, encoder, subsampling, flatten, resample, executor, watch, plan, **options):
     '''
         Shrink images till a max dimension in pixels (width, height).
 
-        Read from SRC folder, store in DST folder. (non-images are simply copied)
+        Read from SRC folder (or .tar/.zip archive), store in DST folder. (non-images are simply copied)
     '''
-    click.echo(f'src: {src}, dst: {dst}, dimension: {dimension}x{dimension} pixels, quality: {quality}')
+    click.echo(f'src: {src}, dst: {dst}, dimension: {dimension}x{dimension} pixels, quality: {quality}, preview: {preview}, target SSIM: {target_ssim}')
     config = {
         'max_dimension': int(dimension),
         'quality': quality,
         'tags': [x.lower() for x in tag],
-        'skip_under_mb': float(skipunder)
+        'skip_under_mb': float(skipunder),
+        'use_preview': preview,
+        'resample': resample,
+        'target_ssim': target_ssim,
+        'min_quality': min_quality,
+        'encoder': encoder,
+        'subsampling': subsampling,
+        'keep_animation': not flatten
     }
-    for message in utils.scan_multi(
-        Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'down_scale',
-        config
-    ):
-        print(f'\r{message}', end='')
-    print()
+    run_scan(src, dst, 'down_scale', config, executor, watch, plan, options)
 
 
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
-def remove_black_bar(src, dst):
+@encoder_options
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@shard_options
+@archive_option
+def remove_black_bar(src, dst, encoder, subsampling, executor, watch, plan, **options):
     '''
         Remove the black bar from images.
 
-        Read from SRC folder, store in DST folder. (non-images are simply copied)
+        Read from SRC folder (or .tar/.zip archive), store in DST folder. (non-images are simply copied)
     '''
     click.echo(f'src: {src}, dst: {dst}')
-    config = {}
-    for message in utils.scan_multi(
-        Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'remove_black_bar',
-        config
-    ):
-        print(f'\r{message}', end='')
-    print()
+    config = {
+        'encoder': encoder,
+        'subsampling': subsampling
+    }
+    run_scan(src, dst, 'remove_black_bar', config, executor, watch, plan, options)
 
 
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
 @click.option('-t', '--tag', type=str, required=True, default=[], multiple=True, prompt="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.", help="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.")
-def strip_exif(src, dst, tag):
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@shard_options
+@archive_option
+def strip_exif(src, dst, tag, executor, watch, plan, **options):
     ''' Strip EXIF tags off images.
     '''
     click.echo(f'src: {src}, dst: {dst}, tag: {tag}')
     config = {
         'tags': [x.lower() for x in tag]
     }
-    for message in utils.scan_multi(
-        Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'strip_exif',
-        config
-    ):
-        print(f'\r{message}', end='')
-    print()
+    run_scan(src, dst, 'strip_exif', config, executor, watch, plan, options)
 
 
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
 @click.option('-t', '--tag', type=str, required=True, default=[], multiple=True, prompt="Exif Tags to be writte. Eg. -t artist -t john", help="Exif Tags to be writte. Eg. -t artist -t john")
-def set_exif(src, dst, tag):
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@shard_options
+@archive_option
+def set_exif(src, dst, tag, executor, watch, plan, **options):
     ''' Write EXIF tags of images.
     '''
     click.echo(f'src: {src}, dst: {dst}, tag: {tag}')
@@ -143,24 +301,25 @@ def set_exif(src, dst, tag):
     key_value = zip(keys, values)
     config = {x[0]:x[1] for x in key_value}
 
-    for message in utils.scan_multi(
-        Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'set_exif',
-        config
-    ):
-        print(f'\r{message}', end='')
-    print()
+    run_scan(src, dst, 'set_exif', config, executor, watch, plan, options)
 
 
 @click.command()
-@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
 @click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
 @click.option('-w', '--width', type=int, required=True, default=0, prompt="Width aspect ratio of image (eg, the 3 in 3x2)", help='Width aspect ratio of image (eg, the 3 in 3x2)')
 @click.option('-t', '--height', type=int, required=True, default=0, prompt="Height aspect ratio of image (eg, the 2 in 3x2)", help='Height aspect ratio of image (eg, the 3 in 3x2)')
 @click.option('-q', '--quality', type=int, required=False, default=constants.JpegImageQuality.JPEG_GOOD, prompt="[1-100] JPEG image quality (bigger is better)", help='[1-100] JPEG image quality (bigger is better)')
-def distort_images(src, dst, width, height, quality):
+@encoder_options
+@resample_option
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@shard_options
+@archive_option
+def distort_images(src, dst, width, height, quality, encoder, subsampling, resample, executor, watch, plan, **options):
     '''
         All images will be distorted to a specified dimensions (width x height).
     '''
@@ -169,16 +328,211 @@ def distort_images(src, dst, width, height, quality):
         'width_aspect_ratio': int(width),
         'height_aspect_ratio': int(height),
         'quality': quality,
+        'resample': resample,
+        'encoder': encoder,
+        'subsampling': subsampling
     }
-    for message in utils.scan_multi(
+    run_scan(src, dst, 'distort_images', config, executor, watch, plan, options)
+
+@click.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
+@click.option('-e', '--side', type=click.Choice(['top', 'bottom', 'left', 'right']), required=True, default='bottom', prompt="Side to cut, eg. left, right, top, bottom", help='Side to cut, eg. left, right, top, bottom')
+@click.option('-p', '--percent', type=float, required=True, default=0, prompt="Percent to cut, eg. 15.1 (= 15.1%)", help='Percent to cut, eg. 15.1 (= 15.1%)')
+@click.option('-q', '--quality', type=int, required=False, default=constants.JpegImageQuality.JPEG_GOOD, prompt="[1-100] JPEG image quality (bigger is better)", help='[1-100] JPEG image quality (bigger is better)')
+@click.option('-t', '--tag', type=str, required=False, default=[], multiple=True, prompt="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.", help="EXIF tag to be removed, eg. image_description, exposure_mode. Can use -t multiple times.")
+@executor_option
+@watch_option
+@plan_option
+@supervise_options
+@dedupe_options
+@shard_options
+@archive_option
+def crop(src, dst, side, percent, quality, tag, executor, watch, plan, **options):
+    '''
+        Crop out part of images (like bottom), keep the original format.
+
+        Read from SRC folder (or .tar/.zip archive), store in DST folder. (non-images are simply copied)
+    '''
+    click.echo(f'src: {src}, dst: {dst}, side: {side}, percent: {percent}%, quality: {quality}, tags: {tag}')
+    config = {
+        'side': side,
+        'percent': float(percent),
+        'quality': quality,
+        'tags': [x.lower() for x in tag]
+    }
+    run_scan(src, dst, 'crop', config, executor, watch, plan, options)
+
+@click.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
+@click.option('-z', '--tile-size', type=int, default=254, show_default=True, help='Tile size in pixels, without the overlap')
+@click.option('-o', '--overlap', type=int, default=1, show_default=True, help='Pixels shared with neighbour tiles, on each side')
+@click.option('-q', '--quality', type=int, default=constants.JpegImageQuality.JPEG_OK, show_default=True, help='[1-100] JPEG tile quality (bigger is better)')
+@click.option('-f', '--format', 'tile_format', type=click.Choice(['jpg', 'png']), default='jpg', show_default=True, help='Tile format')
+@click.option('-n', '--threads', type=int, default=4, show_default=True, help='Threads encoding the tiles of one image')
+@executor_option
+@supervise_options
+def tiles(src, dst, tile_size, overlap, quality, tile_format, threads, executor, **options):
+    '''
+        Make a DeepZoom tile pyramid (.dzi + tiles) of each image, for zoomable viewers.
+
+        Read from SRC folder, store in DST folder. (non-images are simply copied)
+    '''
+    click.echo(f'src: {src}, dst: {dst}, tile size: {tile_size}, overlap: {overlap}, quality: {quality}, format: {tile_format}')
+    config = {
+        'tile_size': tile_size,
+        'overlap': overlap,
+        'quality': quality,
+        'format': tile_format,
+        'threads': threads
+    }
+    run_scan(src, dst, 'tiles', config, executor, options=options)
+
+
+@click.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True, resolve_path=True), required=True)
+@click.option('-d', '--direction', type=click.Choice(['horizontal', 'vertical']), default='horizontal', help='Concat direction of images in each folder')
+@click.option('-w', '--width', type=int, required=False, default=3, help='Width aspect ratio of each image (eg, the 3 in 3x2)')
+@click.option('-t', '--height', type=int, required=False, default=2, help='Height aspect ratio of each image (eg, the 2 in 3x2)')
+@click.option('-c', '--columns', type=int, required=False, default=0, help='If > 0, make a grid of this many columns, streamed into a PNG')
+@click.option('-r', '--recursive', is_flag=True, show_default=True, default=False, help='Go into sub-folders, each folder is concatenated on its own')
+@click.option('--remove', is_flag=True, show_default=True, default=False, help='Remove original images after concat')
+@click.option('--dry-run', is_flag=True, show_default=True, default=False, help='Only list the folders that would be concatenated')
+def concat(src, direction, width, height, columns, recursive, remove, dry_run):
+    '''
+        Concat all images of a folder into one image (per folder).
+
+        Output is stored next to the images of SRC (and each sub-folder with -r).
+    '''
+    click.echo(f'src: {src}, direction: {direction}, width x height: {width}x{height} ratio, columns: {columns}, recursive: {recursive}, remove: {remove}')
+    from image_thumbnail import utils
+    for message in utils.concat_folders_multi(
         Path(src),
-        Path(dst),
-        constants.IMAGE_SUFFIX,
-        'distort_images',
-        config
+        direction == 'horizontal',
+        remove,
+        width,
+        height,
+        columns,
+        recursive,
+        dry_run
     ):
-        print(f'\r{message}', end='')
-    print()
+        click.echo(message)
+
+@click.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.option('-h', '--host', type=str, default='127.0.0.1', show_default=True, help='Address to listen on')
+@click.option('-p', '--port', type=int, default=8080, show_default=True, help='Port to listen on')
+@click.option('-u', '--socket', 'socket_path', type=click.Path(dir_okay=False), default=None, help='Listen on this Unix socket instead of TCP')
+@click.option('-c', '--cache', type=click.Path(file_okay=False, dir_okay=True, writable=True, resolve_path=True), default=None, help='Rendition cache folder [default: ~/.cache/image_thumbnail/renditions]')
+@click.option('-m', '--cache-mb', type=float, default=1024, show_default=True, help='Max total size of the rendition cache in MB')
+@click.option('-w', '--workers', type=int, default=0, help='Worker processes, if 0 then half of the cores')
+def serve(root, host, port, socket_path, cache, cache_mb, workers):
+    '''
+        Serve thumbnails of images under ROOT on demand.
+
+        GET /render?src=<path under ROOT>&op=down_scale&max_dimension=800,
+        GET /render?src=<path under ROOT>&rendition=small, GET /metrics
+    '''
+    from image_thumbnail import service, utils
+    if cache is None:
+        cache = Path.home().joinpath('.cache', 'image_thumbnail', 'renditions')
+    service.serve(
+        Path(root),
+        Path(cache),
+        int(cache_mb * 1024 * 1024),
+        workers or utils.max_process_count(),
+        host,
+        port,
+        socket_path
+    )
+
+@click.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.option('-b', '--db', type=click.Path(dir_okay=False, resolve_path=True), default=None, help='SQLite index file [default: ~/.cache/image_thumbnail/index.sqlite]')
+@click.option('-w', '--workers', type=int, default=0, help='Worker processes, if 0 then half of the cores')
+def index(src, db, workers):
+    '''
+        Build or update a header-only index of images under SRC.
+
+        Only new or changed files are read, pixels are never decoded.
+    '''
+    from image_thumbnail.index import ImageIndex, DEFAULT_INDEX_PATH
+    image_index = ImageIndex(db or DEFAULT_INDEX_PATH)
+    try:
+        for message in image_index.update(Path(src), workers):
+            print(f'\r{message}', end='')
+        print()
+    finally:
+        image_index.close()
+
+@click.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.option('-d', '--distance', type=int, default=6, show_default=True, help='Near-duplicates are at most this many bits apart (of 64, dHash and pHash)')
+@click.option('-b', '--db', type=click.Path(dir_okay=False, resolve_path=True), default=None, help='SQLite index file [default: ~/.cache/image_thumbnail/index.sqlite]')
+@click.option('-w', '--workers', type=int, default=0, help='Worker processes, if 0 then half of the cores')
+def dedupe(src, distance, db, workers):
+    '''
+        List groups of near-duplicate images under SRC (bursts, re-exports, resized copies).
+
+        Hashes are kept in the index, only new or changed files are decoded (small).
+    '''
+    from image_thumbnail.index import ImageIndex, DEFAULT_INDEX_PATH
+    from image_thumbnail.dedupe import find_duplicates
+    image_index = ImageIndex(db or DEFAULT_INDEX_PATH)
+    try:
+        for message in image_index.update_hashes(Path(src), workers):
+            print(f'\r{message}', end='')
+        print()
+        rows = image_index.hashes_under(Path(src))
+    finally:
+        image_index.close()
+
+    groups = {}
+    for duplicate, kept in find_duplicates(rows, distance).items():
+        groups.setdefault(kept, []).append(duplicate)
+    for kept in sorted(groups):
+        click.echo(f'keep: {kept}')
+        for x in sorted(groups[kept]):
+            click.echo(f'    duplicate: {x}')
+    click.echo(f'{sum([len(x) for x in groups.values()])} duplicates in {len(groups)} groups, of {len(rows)} images')
+
+@click.command()
+@click.argument('dst', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), required=True)
+@click.option('--src', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, resolve_path=True), default=None, help='Also check that every image of this SRC folder was in a shard')
+@click.option('--allow-failures', is_flag=True, show_default=True, default=False, help='Images that failed in a shard are not problems')
+def merge_shards(dst, src, allow_failures):
+    '''
+        Check and combine the manifests of a --shard run in DST, print per-shard and total stats.
+
+        Fails if a shard is missing, a file was processed twice, an image failed (unless --allow-failures), or an output is missing.
+    '''
+    from image_thumbnail.shard import merge_manifests
+    lines, ok = merge_manifests(Path(dst), Path(src) if src else None, constants.IMAGE_SUFFIX, allow_failures)
+    for x in lines:
+        click.echo(x)
+    if not ok:
+        raise click.exceptions.Exit(1)
+
+@click.command()
+@click.argument('jobfile', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, resolve_path=True), required=True)
+@executor_option
+@supervise_options
+def run_jobs(jobfile, executor, **options):
+    '''
+        Run the jobs of JOBFILE (JSON or TOML: op, config, src, dst of each) in one worker pool.
+
+        Every job is checked first, then the images of all jobs share the same workers.
+    '''
+    from image_thumbnail.jobs import load_jobs, run_jobs as run_all
+    try:
+        jobs = load_jobs(jobfile)
+    except Exception as e:
+        raise click.BadParameter(str(e))
+    for x in jobs:
+        click.echo(f'job {x["name"]}: {x["op"]} {x["src"]} -> {x["dst"]}, config: {x["config"]}')
+    for message in run_all(jobs, executor, **options):
+        print(f'\r{message}', end='\n' if message.startswith(('Failed', 'Job', 'Done')) else '')
 
 cli.add_command(down_size)
 cli.add_command(down_scale)
@@ -186,6 +540,14 @@ cli.add_command(remove_black_bar)
 cli.add_command(strip_exif)
 cli.add_command(set_exif)
 cli.add_command(distort_images)
+cli.add_command(concat)
+cli.add_command(crop)
+cli.add_command(tiles)
+cli.add_command(serve)
+cli.add_command(index)
+cli.add_command(dedupe)
+cli.add_command(merge_shards)
+cli.add_command(run_jobs)
 
 if __name__ == '__main__':
     cli()